@@ -1,17 +1,23 @@
 #!/usr/bin/env python3
 import os
 import sys
+import functools
 import itertools
+import struct
 import threading
 import time
+import contextvars
 import psycopg2
 import datetime
 
+from concurrent.futures import ThreadPoolExecutor
+
 import structlog
 
 from textwrap import dedent
 
 from .times import (
+    clock_ranges,
     get_start_and_stop,
     get_month_before_retention,
     months_for_year_ahead,
@@ -20,29 +26,46 @@ from .times import (
 )
 
 from .helpers import (
+    ConnectionPool,
+    STATS,
     get_table_name,
+    get_index_name,
+    get_constraint_name,
     archive_connstring,
-    connect_autocommit,
     housekeeper_connstring,
     execute,
-    prelude_execute,
-    prelude_execute_transaction,
     table_exists,
-    prelude_cursor,
     log_and_reset_notices,
 )
+from .batching import get_batch_target
+from .brin import brin_index_sql
+from .dedupe import get_dedupe_engine
+from .explain import EXPLAIN
+from .journal import get_journal, journaled, print_progress
 from .logs import setup_logging, log_state
+from .metrics import METRICS, statement_labels
+from .progress import watch
+from .scheduler import Scheduler, task_key
+from .tracing import TRACER
 
 from .housekeeper import (
+    FAST_WINDOW,
+    HISTORY_TABLES,
+    TRENDS_TABLES,
     ensure_brin_index,
     ensure_btree_index,
     do_cluster_operation,
+    drop_check_constraint,
     clean_duplicate_items,
     clean_old_items,
     clean_expired_items,
-    should_maintain,
+    merge_partitions,
+    past_parts,
 )
 
+# Buffer size for each side of the COPY relay
+COPY_BUFFER = 1024 * 1024
+
 CREATE_ROOT = {
     "history_str": """CREATE TABLE IF NOT EXISTS {tablename} (
                           itemid BIGINT NOT NULL,
@@ -69,6 +92,22 @@ CREATE_ROOT = {
                           clock INTEGER NOT NULL CHECK (clock >= {start} AND clock < {stop}),
                           value NUMERIC(20,0) NOT NULL,
                           ns INTEGER NOT NULL);""",
+
+    "trends": """CREATE TABLE IF NOT EXISTS {tablename} (
+                          itemid BIGINT NOT NULL,
+                          clock INTEGER NOT NULL CHECK (clock >= {start} AND clock < {stop}),
+                          num INTEGER NOT NULL,
+                          value_min NUMERIC(16,4) NOT NULL,
+                          value_avg NUMERIC(16,4) NOT NULL,
+                          value_max NUMERIC(16,4) NOT NULL);""",
+
+    "trends_uint": """CREATE TABLE IF NOT EXISTS {tablename} (
+                          itemid BIGINT NOT NULL,
+                          clock INTEGER NOT NULL CHECK (clock >= {start} AND clock < {stop}),
+                          num INTEGER NOT NULL,
+                          value_min NUMERIC(20,0) NOT NULL,
+                          value_avg NUMERIC(20,0) NOT NULL,
+                          value_max NUMERIC(20,0) NOT NULL);""",
 }
 
 # 2021-07: Spindel
@@ -79,11 +118,18 @@ ALTER_ROOT = {
 }
 
 
+BULK_LOAD_MODES = ("off", "on", "unlogged")
+
+# Prefix of the table comment that set_layout writes
+LAYOUT_MARK = "housekeeper layout: "
+
 FOREIGN_NAMES = {
     "history": "archive",
     "history_str": "archive_str",
     "history_text": "archive_text",
     "history_uint": "archive_uint",
+    "trends": "archive_trends",
+    "trends_uint": "archive_trends_uint",
 }
 
 
@@ -102,6 +148,31 @@ def get_retention():
     return retention
 
 
+def get_trends_retention():
+    """
+    environment variable MODIO_ARCHIVE_TRENDS in days is used to decide on how
+    many days old trends should be before being moved into the ARCHIVE. When
+    it is not set, trends are not archived."""
+    retention = os.environ.get("MODIO_ARCHIVE_TRENDS")
+    if retention is None:
+        return None
+    return int(retention)
+
+
+def archive_months(retention, trends_retention=None, start=None):
+    """(table, date, retention) of the partitions old enough to archive, for
+    the history tables after `retention` days and the trends tables after
+    `trends_retention` days, oldest month first."""
+    units = []
+    for tables, days in ((HISTORY_TABLES, retention), (TRENDS_TABLES, trends_retention)):
+        if days is None:
+            continue
+        end = get_month_before_retention(retention=days)
+        for date in months_between(from_date=start, to_date=end):
+            units.extend((table, date, days) for table in tables)
+    return sorted(units, key=lambda unit: unit[1])
+
+
 def archive_setup(username="example.com", password="0000-0000-0000-0000"):
     username = os.getenv("ARCHIVE_PGUSER", username)
     password = os.getenv("ARCHIVE_PGPASSWORD", password)
@@ -156,6 +227,56 @@ def create_archive_table(table="history", year=2011, month=12):
     yield from ensure_brin_index(table=tname, year=year, month=month)
 
 
+def get_bulk_load():
+    """
+    environment variable ARCHIVE_BULK_LOAD is "off" (the default), "on" to
+    load archive tables without indexes, constraint and autovacuum (see
+    bulk_load_start), or "unlogged" to also load them without WAL."""
+    mode = os.environ.get("ARCHIVE_BULK_LOAD", "off")
+    if mode not in BULK_LOAD_MODES:
+        raise ValueError(f"ARCHIVE_BULK_LOAD must be one of {BULK_LOAD_MODES}")
+    return mode
+
+
+def bulk_load_start(table="archive", year=2011, month=12, unlogged=False):
+    """Get an archive table ready for a COPY with nothing to maintain per row:
+    no BRIN index, no CHECK constraint and no autovacuum, and with
+    `unlogged`, no WAL. Cheapest on an empty table, as SET UNLOGGED rewrites
+    it."""
+    tablename = get_table_name(table=table, year=year, month=month)
+    index = get_index_name(table=table, year=year, month=month, kind="brin")
+    yield f"ALTER TABLE {tablename} SET (autovacuum_enabled = false);"
+    yield f"DROP INDEX IF EXISTS {index};"
+    # The CHECK of CREATE_ROOT, and the one add_check_constraint adds
+    yield f"ALTER TABLE {tablename} DROP CONSTRAINT IF EXISTS {tablename}_clock_check;"
+    yield from drop_check_constraint(table=table, year=year, month=month)
+    if unlogged:
+        yield f"ALTER TABLE {tablename} SET UNLOGGED;"
+
+
+def bulk_load_finish(table="archive", year=2011, month=12, unlogged=False):
+    """Undo bulk_load_start once the data is in. The constraint is added NOT
+    VALID and then validated, which checks all rows in one scan without
+    blocking reads."""
+    tablename = get_table_name(table=table, year=year, month=month)
+    constraint_name = get_constraint_name(table=table, year=year, month=month)
+    index = get_index_name(table=table, year=year, month=month, kind="brin")
+    start, stop = get_start_and_stop(year=year, month=month)
+    if unlogged:
+        yield f"ALTER TABLE {tablename} SET LOGGED;"
+    yield from drop_check_constraint(table=table, year=year, month=month)
+    yield (
+        f"ALTER TABLE {tablename} ADD CONSTRAINT {constraint_name} "
+        f"CHECK (clock >= {start} AND clock < {stop}) NOT VALID;"
+    )
+    yield f"ALTER TABLE {tablename} VALIDATE CONSTRAINT {constraint_name};"
+    # Nothing else writes to the table yet, so it need not be CONCURRENTLY,
+    # which waits for every older transaction in the database.
+    yield brin_index_sql(index, tablename, concurrently=False)
+    yield f"ALTER TABLE {tablename} RESET (autovacuum_enabled);"
+    yield f"ANALYZE {tablename};"
+
+
 def detach_partition(table="history", year=2011, month=12):
     tablename = get_table_name(table=table, year=year, month=month)
     yield f"ALTER TABLE {table} DETACH PARTITION {tablename};"
@@ -182,10 +303,10 @@ def archive_clean_old_items(table="history", year=2011, month=12):
     yield from clean_old_items(table=arname, year=year, month=month)
 
 
-def archive_clean_expired_items(table="history", year=2011, month=12):
+def archive_clean_expired_items(table="history", year=2011, month=12, retention=FAST_WINDOW):
     """Ensure a btree index exists on an archive table. Assumes the table exists"""
     arname = FOREIGN_NAMES[table]
-    yield from clean_expired_items(table=arname, year=year, month=month)
+    yield from clean_expired_items(table=arname, year=year, month=month, retention=retention)
 
 
 def archive_cluster(table="history", year=2011, month=12):
@@ -200,25 +321,413 @@ def archive_dedupe(table="history", year=2011, month=12):
     yield from clean_duplicate_items(table=arname, year=year, month=month)
 
 
-def should_archive_cluster(conn, table="history", year=2011, month=12):
+def archive_table_name(table, date):
+    return get_table_name(table=FOREIGN_NAMES[table], year=date.year, month=date.month)
+
+
+def should_archive_cluster(conn, table="history", year=2011, month=12, catalog=None):
     """Cluster an archive table. Requires a connection to test if the table
     exists"""
     arname = FOREIGN_NAMES[table]
     tablename = get_table_name(table=arname, year=year, month=month)
-    return table_exists(conn, table=tablename)
+    return table_exists(conn, table=tablename, catalog=catalog)
 
 
-def python_migrate_table_to_archive(src_conn, dst_conn, table="history", year=2011, month=12):
+def get_copy_format():
+    """
+    environment variable ARCHIVE_COPY_FORMAT is the COPY format used to move
+    data to the archive, "binary", "text" or "auto" (the default), which uses
+    binary when no column needs a cast."""
+    copy_format = os.environ.get("ARCHIVE_COPY_FORMAT", "auto")
+    if copy_format not in ("auto", "binary", "text"):
+        raise ValueError("ARCHIVE_COPY_FORMAT must be auto, binary or text")
+    return copy_format
+
+
+def get_copy_sorted():
+    """
+    environment variable ARCHIVE_COPY_ORDER is "sorted" (the default) to copy
+    rows to the archive deduplicated and in (itemid, clock) order, or "none"
+    to copy them as they are stored."""
+    order = os.environ.get("ARCHIVE_COPY_ORDER", "sorted")
+    if order not in ("sorted", "none"):
+        raise ValueError("ARCHIVE_COPY_ORDER must be sorted or none")
+    return order == "sorted"
+
+
+def range_select(columns, table, start, stop, unique=False, ordered=False):
+    """The rows of a clock range, in the archive's columns."""
+    distinct = "DISTINCT " if unique else ""
+    order = " ORDER BY itemid, clock" if ordered else ""
+    return f"SELECT {distinct}{columns} FROM {table} WHERE clock >= {start} AND clock < {stop}{order}"
+
+
+def set_layout(table, layout=()):
+    """Remember how a COPY left an archive table, "sorted" and/or "unique"."""
+    words = ",".join(sorted(layout))
+    comment = f"'{LAYOUT_MARK}{words}'" if words else "NULL"
+    yield f"COMMENT ON TABLE {table} IS {comment};"
+
+
+def get_layout(conn, table):
+    """The layout set_layout remembered for a table."""
+    with conn.cursor() as curs:
+        execute(curs, f"SELECT obj_description('{table}'::regclass, 'pg_class');")
+        comment = curs.fetchone()[0] or ""
+    if not comment.startswith(LAYOUT_MARK):
+        return set()
+    return set(comment[len(LAYOUT_MARK):].split(","))
+
+
+def table_columns(conn, table):
+    """[(column, type)] of a table, in order."""
+    with conn.cursor() as curs:
+        curs.execute(
+            "SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum;",
+            (table,),
+        )
+        return curs.fetchall()
+
+
+def copy_columns(src_conn, dst_conn, src_table, dst_table):
+    """The select list that gives the source rows in the destination's columns
+    and types, and the number of columns that need a cast.
+
+    Binary COPY needs the types to match exactly, and the archive tables use
+    NUMERIC where Zabbix doesn't. Columns the source doesn't have are NULL.
+    """
+    src_types = dict(table_columns(src_conn, src_table))
+    select = []
+    casts = 0
+    for column, dst_type in table_columns(dst_conn, dst_table):
+        src_type = src_types.get(column)
+        if src_type is None:
+            select.append(f"NULL::{dst_type} AS {column}")
+        elif src_type != dst_type:
+            select.append(f"{column}::{dst_type} AS {column}")
+            casts += 1
+        else:
+            select.append(column)
+    return ", ".join(select), casts
+
+
+class RateLimit:
+    """A ceiling on bytes per second, shared by all the threads using it.
+
+    Every `take` books its bytes after those booked before it, and sleeps
+    until the ones before it are due."""
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._due = clock()
+
+    def take(self, size):
+        with self._lock:
+            now = self._clock()
+            wait = self._due - now
+            self._due = max(self._due, now) + size / self.rate
+        if wait > 0:
+            self._sleep(wait)
+
+
+FIELDS = struct.Struct("!h")
+FIELD_SIZE = struct.Struct("!i")
+
+
+class DayChecksums:
+    """{day: (rows, checksum)} of the rows of a COPY stream, as they pass.
+
+    Each row is hashed as the bytes COPY sends for it, and the hashes of a
+    day are summed, so the same rows in the same COPY format give the same
+    sums, in whatever order. Python's hash of bytes differs between runs, so
+    only sums of the same run compare. `clock` is the column number of clock."""
+
+    def __init__(self, clock, binary=False):
+        self.clock = clock
+        self.binary = binary
+        self.days = {}
+        self._rest = b""
+        self._header = binary
+        self._layout = None
+        self._lengths = ()
+        self._clock_at = 0
+
+    def update(self, data):
+        data = self._rest + data
+        used = self._binary_rows(data) if self.binary else self._text_rows(data)
+        self._rest = data[used:]
+
+    def write(self, data):
+        """As a file for COPY ... TO STDOUT to write to."""
+        self.update(data)
+        return len(data)
+
+    def _add(self, day, rows, checksum):
+        old_rows, old_checksum = self.days.get(day, (0, 0))
+        self.days[day] = (old_rows + rows, (old_checksum + checksum) & 0xFFFFFFFFFFFFFFFF)
+
+    def _text_rows(self, data):
+        """Rows end in a newline, newlines in values are escaped."""
+        used = data.rfind(b"\n") + 1
+        sums = {}
+        clock = self.clock
+        for row in data[:used].split(b"\n")[:-1]:
+            day = int(row.split(b"\t", clock + 1)[clock]) // 86400
+            rows, checksum = sums.get(day, (0, 0))
+            sums[day] = (rows + 1, checksum + hash(row))
+        for day, (rows, checksum) in sums.items():
+            self._add(day, rows, checksum)
+        return used
+
+    def _binary_rows(self, data):
+        """A header, then rows of a field count and (length, bytes) fields.
+
+        Most rows have the same lengths as the one before, and are read with
+        one struct of that layout."""
+        pos = 0
+        if self._header:
+            if len(data) < 19:
+                return 0
+            pos = 19 + struct.unpack_from("!I", data, 15)[0]
+            if len(data) < pos:
+                return 0
+            self._header = False
+        sums = {}
+        size = len(data)
+        layout = self._layout
+        while size - pos >= 2:
+            if layout is not None and size - pos >= layout.size and layout.unpack_from(data, pos) == self._lengths:
+                end = pos + layout.size
+                day = int.from_bytes(data[pos + self._clock_at:pos + self._clock_at + 4], "big", signed=True) // 86400
+            elif FIELDS.unpack_from(data, pos)[0] < 0:
+                # The trailer
+                pos = size
+                break
+            else:
+                found = self._binary_row(data, pos)
+                if found is None:
+                    # The rest of the row is in the next data
+                    break
+                end, day = found
+                layout = self._layout
+            rows, checksum = sums.get(day, (0, 0))
+            sums[day] = (rows + 1, checksum + hash(data[pos:end]))
+            pos = end
+        for day, (rows, checksum) in sums.items():
+            self._add(day, rows, checksum)
+        return pos
+
+    def _binary_row(self, data, pos):
+        """(end, day) of the row at `pos`, or None if it doesn't end in `data`.
+        Keeps its layout for the rows after it."""
+        size = len(data)
+        fields, = FIELDS.unpack_from(data, pos)
+        end = pos + 2
+        day = 0
+        lengths = [fields]
+        clock_at = 0
+        for n in range(fields):
+            if size - end < 4:
+                return None
+            length, = FIELD_SIZE.unpack_from(data, end)
+            end += 4
+            if n == self.clock:
+                clock_at = end - pos
+                day = int.from_bytes(data[end:end + length], "big", signed=True) // 86400
+            lengths.append(length)
+            end += max(length, 0)
+        if end > size:
+            return None
+        if min(lengths) >= 0 and lengths[self.clock + 1] == 4:
+            self._layout = struct.Struct("!h" + "".join(f"i{length}x" for length in lengths[1:]))
+            self._lengths = tuple(lengths)
+            self._clock_at = clock_at
+        return end, day
+
+
+class CountingReader:
+    """Counts the bytes read through a file object, and passes them to the
+    `checksums`, if any."""
+
+    def __init__(self, fileobj, throttle=None, checksums=None):
+        self.fileobj = fileobj
+        self.throttle = throttle
+        self.checksums = checksums
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes += len(data)
+        if self.throttle is not None:
+            self.throttle.take(len(data))
+        if self.checksums is not None:
+            self.checksums.update(data)
+        return data
+
+
+def copy_relay(src_conn, dst_conn, src_query, dst_query, buffer_size=COPY_BUFFER, throttle=None,
+               checksums=None):
+    """Stream a COPY ... TO STDOUT on one connection into a COPY ... FROM STDIN
+    on the other, as raw bytes through a pipe with `buffer_size` buffers.
+
+    With a `throttle` (a RateLimit), the archive side reads no faster than it
+    allows, and the pipe holds back the source. With `checksums` (a
+    DayChecksums), the rows are summed on the way.
+
+    Returns (rows, bytes, seconds). Errors on either side are raised."""
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, "rb", buffering=buffer_size)
+    writer = os.fdopen(write_fd, "wb", buffering=buffer_size)
+    counted = CountingReader(reader, throttle, checksums)
+    received = {}
+
+    def copy_in():
+        """Internal function for the thread"""
+        try:
+            with dst_conn.cursor() as c, watch(dst_conn, dst_query):
+                c.copy_expert(dst_query, counted, size=buffer_size)
+                received["rows"] = c.rowcount
+        except Exception as exc:
+            received["error"] = exc
+        finally:
+            # Makes the writing side fail, instead of blocking forever
+            reader.close()
+
+    archive_side = threading.Thread(target=copy_in)
+    archive_side.start()
+    start = time.monotonic()
+    source_error = None
+    try:
+        with src_conn.cursor() as c:
+            c.copy_expert(src_query, writer, size=buffer_size)
+    except Exception as exc:
+        source_error = exc
+    finally:
+        try:
+            writer.close()  # Important, otherwise you deadlock
+        except BrokenPipeError:
+            pass
+        archive_side.join()
+    elapsed = time.monotonic() - start
+
+    # When the archive side fails, the source only sees the pipe break, so
+    # the archive's error is the one that says what went wrong.
+    if "error" in received:
+        raise received["error"] from source_error
+    if source_error is not None:
+        raise source_error
+    METRICS.add(statement_labels(dst_query), statements=1, rows=max(received["rows"], 0), seconds=elapsed,
+                copy_bytes=counted.bytes)
+    return received["rows"], counted.bytes, elapsed
+
+
+def get_streams():
+    """
+    environment variable ARCHIVE_STREAMS is how many COPY streams move a
+    partition to the archive at the same time (default 1)."""
+    return max(1, int(os.environ.get("ARCHIVE_STREAMS", "1")))
+
+
+def get_migrate_workers():
+    """
+    environment variable ARCHIVE_WORKERS is how many partitions migrate_data
+    works on at the same time (default 1). ARCHIVE_CLEANUP_WORKERS and
+    ARCHIVE_LOAD_WORKERS cap how many of those are cleaning up on the source
+    side, and loading into the archive. Both default to ARCHIVE_WORKERS.
+
+    Returns (workers, limits) for a scheduler.Scheduler."""
+    workers = int(os.environ.get("ARCHIVE_WORKERS", "1"))
+    limits = {
+        "cleanup": int(os.environ.get("ARCHIVE_CLEANUP_WORKERS", workers)),
+        "load": int(os.environ.get("ARCHIVE_LOAD_WORKERS", workers)),
+    }
+    if min(workers, *limits.values()) < 1:
+        raise ValueError("ARCHIVE_WORKERS, ARCHIVE_CLEANUP_WORKERS and ARCHIVE_LOAD_WORKERS must be 1 or more.")
+    return workers, limits
+
+
+def get_throttle():
+    """
+    environment variable ARCHIVE_MAX_BYTES_PER_SECOND is a ceiling for all
+    COPY streams to the archive together. Unset or 0 is no ceiling.
+
+    Returns a RateLimit, or None."""
+    rate = int(os.environ.get("ARCHIVE_MAX_BYTES_PER_SECOND", "0"))
+    if rate <= 0:
+        return None
+    return RateLimit(rate)
+
+
+def day_checksums(conn, select, options, clock):
+    """{day: (rows, checksum)} of the rows from `select`, COPY'd out with
+    `options` and summed like copy_relay does."""
+    checksums = DayChecksums(clock, binary="binary" in options)
+    with conn.cursor() as curs:
+        curs.copy_expert(f"COPY ({select}) TO STDOUT{options};", checksums, size=COPY_BUFFER)
+    return checksums.days
+
+
+def checksum_mismatches(source, archive):
+    """The days where the archive does not have the rows of the source."""
+    return sorted(day for day in source.keys() | archive.keys() if source.get(day) != archive.get(day))
+
+
+def copy_range_to_archive(src_pool, dst_pool, src_select, dst_table, options, start, stop, clock,
+                          whole=False, throttle=None):
+    """Copy one clock range, replacing whatever the archive has in it, and
+    check that the archive got the same rows as were sent.
+
+    The archive side is one transaction, so a failure on either side leaves
+    the range in the archive as it was, and it can be copied again. The rows
+    are summed as they pass, and only the archive is read again to compare,
+    after the commit. A mismatch raises. When the range is the `whole` table,
+    it is truncated instead, so the rows are stored in the order they are
+    copied. `clock` is the column number of clock."""
+    dst_select = f"SELECT * FROM {dst_table} WHERE clock >= {start} AND clock < {stop}"
+    sent = DayChecksums(clock, binary="binary" in options)
+    if whole:
+        clear = f"TRUNCATE TABLE {dst_table};"
+    else:
+        clear = f"DELETE FROM {dst_table} WHERE clock >= {start} AND clock < {stop};"
+    with src_pool.connection() as src_conn, dst_pool.connection() as dst_conn:
+        with dst_conn:
+            with dst_conn.cursor() as curs:
+                execute(curs, clear)
+            result = copy_relay(src_conn, dst_conn, f"COPY ({src_select}) TO STDOUT{options};",
+                                f"COPY {dst_table} FROM STDIN{options};", throttle=throttle, checksums=sent)
+        log_and_reset_notices(src_conn)
+        mismatches = checksum_mismatches(sent.days, day_checksums(dst_conn, dst_select, options, clock))
+    if mismatches:
+        raise RuntimeError(f"Archive differs from source on {len(mismatches)} days, from day {mismatches[0]}")
+    return result
+
+
+def python_migrate_table_to_archive(src_pool, dst_pool, table="history", year=2011, month=12, streams=1,
+                                    throttle=None):
     """This uses python code and threads to transfer data between tables.
     While the method is generic, there cannot be a transaction for COPY
-    operations (other than read data) and we cannot verify the data exists in
-    the target before deleting it.
+    operations (other than read data), so the data is verified in the target
+    before it is deleted from the source.
 
     Since we use partitions, we know there won't be writing to our source table
     while this code runs, so it's "safe" to forego using transactions.
 
-    This code also assumes that if nothing breaks during the two COPY jobs,
-    it's okay to truncate the source table.
+    The partition is split in `streams` clock ranges, that are copied at the
+    same time over their own connections. All ranges share the `throttle`, if
+    any. Once every range has been committed and has the same rows and
+    checksums per day in the archive, the source table is dropped.
+
+    With ARCHIVE_COPY_ORDER=sorted, duplicates are left out and each range is
+    copied in (itemid, clock) order. As the archive then has no duplicates,
+    and with a single stream is stored in order, it is not deduplicated or
+    clustered again (see set_layout).
+
+    Returns whether the table was moved. If not, the ranges are removed from
+    the archive again, so the FDW transfer can move it all.
     """
 
     arname = FOREIGN_NAMES[table]
@@ -244,84 +753,108 @@ def python_migrate_table_to_archive(src_conn, dst_conn, table="history", year=20
     # doesn't _store_ things in order, so you need to cluster the table
     # _anyhow_
 
-    if not table_exists(conn=src_conn, table=src_table):
-        return
-    if not table_exists(conn=dst_conn, table=dst_table):
-        return
-    src_query = f"COPY (SELECT * FROM {src_table}) TO STDOUT;"
+    # Unless it is a single COPY into an empty table, which appends the rows
+    # in the order they come.
 
-    log = _log.bind(source=src_table, destination=dst_table)
-    log.info("Tables exist. Starting data transfer")
-
-    # a pipe to read/write with, will be wrapped in file handles for the sake
-    # of the API
-    readEnd, writeEnd = os.pipe()
-    threadlog = log.getChild("copy_from")
-    copy_to_failed = copy_from_failed = True
+    with src_pool.connection() as src_conn, dst_pool.connection() as dst_conn:
+        if not table_exists(conn=src_conn, table=src_table, catalog=src_pool.catalog):
+            return False
+        if not table_exists(conn=dst_conn, table=dst_table, catalog=dst_pool.catalog):
+            return False
+        with src_conn.cursor() as curs:
+            execute(curs, f"SELECT EXISTS (SELECT 1 FROM {src_table});")
+            has_rows = curs.fetchone()[0]
+        columns, casts = copy_columns(src_conn, dst_conn, src_table, dst_table)
+        clock = [column for column, _ in table_columns(dst_conn, dst_table)].index("clock")
 
-    def copy_from():
-        """Internal function for the thread"""
-        nonlocal copy_from_failed
+    log = _log.bind(source=src_table, destination=dst_table)
+    if not has_rows:
+        # Copying nothing would empty the archive ranges. An emptied source
+        # is left to the FDW transfer, which drops it.
+        log.info("Source table is empty, not copying")
+        return False
+    log.info("Tables exist. Starting data transfer", streams=streams)
+
+    copy_format = get_copy_format()
+    if copy_format == "auto":
+        # Converting to NUMERIC costs more than the text format does
+        copy_format = "text" if casts else "binary"
+    options = " WITH (FORMAT binary)" if copy_format == "binary" else ""
+
+    ordered = get_copy_sorted()
+    # clean_duplicate_items leaves text tables alone, and so does this
+    unique = ordered and table != "history_text"
+    layout = {"sorted"} if ordered and streams == 1 else set()
+    if unique:
+        layout.add("unique")
+    # Until the copy is done, the archive table is in no known order
+    for x in set_layout(dst_table):
+        dst_pool.execute(x)
+
+    bulk_load = get_bulk_load()
+    unlogged = bulk_load == "unlogged"
+    if bulk_load != "off":
+        for x in bulk_load_start(table=arname, year=year, month=month, unlogged=unlogged):
+            dst_pool.execute(x)
+
+    begin = time.monotonic()
+    with ThreadPoolExecutor(max_workers=streams) as pool:
+        futures = {}
+        for start, stop in clock_ranges(*get_start_and_stop(year=year, month=month), streams):
+            src_select = range_select(columns, src_table, start, stop, unique=unique, ordered=ordered)
+            with log_state(copy_start=start, copy_stop=stop):
+                # Copy the context, so the stream logs its range
+                ctx = contextvars.copy_context()
+                future = pool.submit(ctx.run, copy_range_to_archive, src_pool, dst_pool, src_select, dst_table,
+                                     options, start, stop, clock, streams == 1, throttle)
+            futures[future] = (start, stop)
+
+    rows = size = 0
+    failed = []
+    for future, (start, stop) in futures.items():
         try:
-            start = time.monotonic()
-            sql_file = os.fdopen(readEnd)
-            with dst_conn.cursor() as c:
-                # Copy has no return value, we cannot see how many rows were
-                # transferred
-                c.copy_from(sql_file, dst_table)
-            dst_conn.commit()
-            elapsed = time.monotonic() - start
+            copied, copied_size, elapsed = future.result()
         except Exception:
-            threadlog.exception("Something is wrong in the state of denmark")
-        else:
-            copy_from_failed = False
-            threadlog.info("Spent %ss writing to %s", elapsed, dst_table)
-        finally:
-            sql_file.close()
-
-    archive_side = threading.Thread(target=copy_from)
-    archive_side.start()
-
-    # Explicit write flag on the write side.
-    sql_file = os.fdopen(writeEnd, 'w')
-    start = time.monotonic()
-
-    # If the below fails (disk full, similar) we cannot terminate the
-    # copy_from thread, and will thus leak a db connection until the program
-    # terminates
-    try:
-        with src_conn.cursor() as c:
-            c.copy_expert(src_query, sql_file)
-            sql_file.close()  # Important, otherwise you deadlock
-            elapsed = time.monotonic() - start
-            log.info("Spent %ss reading from %s", elapsed, src_table)
-    except Exception:
-        log.exception("Error reading from table")
-    else:
-        copy_to_failed = False
-    finally:
-        sql_file.close()
-
-    # The read is done, the receiving thread may take longer time to work it
-    # out. Wait for it.
-    try:
-        archive_side.join()
-    except Exception:
-        log.error("Trouble receiving data for some reason. Not cleaning up")
-        return
-
-    if copy_from_failed or copy_to_failed:
-        return
-
-    # We now have a clean copy of the detached table. Time to empty it
-    with src_conn.cursor() as c:
-        execute(c, f"TRUNCATE TABLE {src_table};")
+            log.exception("Error transferring data", copy_start=start, copy_stop=stop)
+            failed.append((start, stop))
+            continue
+        rows += copied
+        size += copied_size
+        log.info("Transferred range", copy_start=start, copy_stop=stop, rows=copied, bytes=copied_size,
+                 seconds=round(elapsed, 2))
+
+    if failed:
+        log.error("Not dropping source, ranges failed", failed=failed, succeeded=len(futures) - len(failed))
+        # A range that failed its checksums has been committed as well
+        for start, stop in futures.values():
+            dst_pool.execute(f"DELETE FROM {dst_table} WHERE clock >= {start} AND clock < {stop};")
+        if bulk_load != "off":
+            for x in bulk_load_finish(table=arname, year=year, month=month, unlogged=unlogged):
+                dst_pool.execute(x)
+        return False
+
+    elapsed = max(time.monotonic() - begin, 0.001)
+    log.info("Transferred and verified data", format=copy_format, streams=streams, rows=rows, bytes=size,
+             seconds=round(elapsed, 2), rows_per_second=round(rows / elapsed),
+             bytes_per_second=round(size / elapsed), layout=sorted(layout))
+
+    if bulk_load != "off":
+        # Before the source is gone, as an unlogged table is lost in a crash
+        for x in bulk_load_finish(table=arname, year=year, month=month, unlogged=unlogged):
+            dst_pool.execute(x)
+
+    for x in set_layout(dst_table, layout):
+        dst_pool.execute(x)
+
+    # We now have a verified copy of the detached table, so it can go
+    src_pool.execute(f"DROP TABLE {src_table};")
 
     # And then we need to cluster the table on the archive side to
     # get it in-order
-    with dst_conn.cursor() as curs:
+    if "sorted" not in layout:
         for x in archive_cluster(table=table, year=year, month=month):
-            execute(curs, x)
+            dst_pool.execute(x)
+    return True
 
 
 def sql_if_tables_exist(tables, query_iter):
@@ -367,89 +900,178 @@ def migrate_table_to_archive(table="history", year=2011, month=12):
     yield from sql_if_tables_exist(tables=tables, query_iter=query_iter())
 
 
-def archive_maintenance(connstr):
-    tables = ("history", "history_uint", "history_text", "history_str")
-
-    with connect_autocommit(connstr) as c:
-        with log_state(stage="archive_maintenance"):
-            for date in months_for_year_ahead():
-                for table in tables:
-                    for x in create_archive_table(table=table, year=date.year, month=date.month):
-                        with prelude_cursor(c) as curs:
-                            execute(curs, x)
-
-            for date in months_for_year_past():
-                for table in tables:
-                    for x in create_archive_table(table=table, year=date.year, month=date.month):
-                        with prelude_cursor(c) as curs:
-                            execute(curs, x)
-
-
-def connect_check(connstr):
-    """Tests that a connection string works."""
-    with connect_autocommit(connstr) as conn:
-        # Make a select to test that we can connect
-        with prelude_cursor(conn) as curs:
-            execute(curs, "SELECT 1;")
-
-
-def migrate_data(source_connstr, dest_connstr):
-    tables = ("history",  "history_uint", "history_text", "history_str")
-
-    retention = get_retention()
-    end = get_month_before_retention(retention=retention)
-
-    connect_check(source_connstr)
-    connect_check(dest_connstr)
-
-    for date in months_between(to_date=end):
-        for table in tables:
-            with connect_autocommit(source_connstr) as source:
-                # Should_maintain checks that the table exists first
-                if should_maintain(conn=source, table=table, year=date.year, month=date.month):
-                    # First clean up old (deleted) items
-                    for x in clean_old_items(table=table, year=date.year, month=date.month):
-                        with prelude_cursor(source) as curs:
-                            execute(curs, x)
-                    # Then clean out expired items (should be deleted)
-                    for x in clean_expired_items(table=table, year=date.year, month=date.month, retention=retention):
-                        with prelude_cursor(source) as curs:
-                            execute(curs, x)
-
-                    # Then clean up duplicate data ( warning, slow)
-                    for x in clean_duplicate_items(table=table, year=date.year, month=date.month):
-                        with prelude_cursor(source) as curs:
-                            execute(curs, x)
-
-            with connect_autocommit(source_connstr) as source, connect_autocommit(dest_connstr) as dest:
-                # It's important to use try/catch outside the "with" statement,
-                # otherwise psycopg2 does not call rollback() on the
-                # transaction, leaving us in a broken state.
-                try:
-                    # by using "with <connection>" we explicitly open a transaction
-                    with source:
-                        with prelude_cursor(source) as curs:
-                            for x in swap_live_and_archive_tables(table=table, year=date.year, month=date.month):
-                                execute(curs, x)
-                except psycopg2.ProgrammingError as exc:
-                    _log.warning("Error swapping table. Maybe already done?", exc=exc)
-
-                # First we do the high performance COPY operation
-                python_migrate_table_to_archive(src_conn=source, dst_conn=dest,
-                                                table=table, year=date.year, month=date.month)
-                log_and_reset_notices(conn=source)
-                log_and_reset_notices(conn=dest)
-                # Then we do the slow performance one that also cleans out the
-                # tables.
-
-                # Explicitly open a transaction
-                with source:
-                    with prelude_cursor(source) as curs:
-                        for x in migrate_table_to_archive(table=table, year=date.year, month=date.month):
-                            execute(curs, x)
-
-
-def oneshot_prune(archive_connstr, source_connstr):
+def archive_maintenance(pool):
+    tables = HISTORY_TABLES
+    if get_trends_retention() is not None:
+        tables += TRENDS_TABLES
+
+    with log_state(stage="archive_maintenance"):
+        for date in months_for_year_ahead():
+            for table in tables:
+                for x in create_archive_table(table=table, year=date.year, month=date.month):
+                    pool.execute(x)
+
+        for date in months_for_year_past():
+            for table in tables:
+                for x in create_archive_table(table=table, year=date.year, month=date.month):
+                    pool.execute(x)
+
+
+def connect_check(pool):
+    """Tests that a connection pool works."""
+    # Make a select to test that we can connect
+    pool.execute("SELECT 1;")
+
+
+def migrate_cleanup(table="history", year=2011, month=12, retention=FAST_WINDOW, target_seconds=None,
+                    engine="legacy"):
+    """The clean up migrate_data does on the source table before moving it."""
+    # First clean up old (deleted) items
+    yield from clean_old_items(table=table, year=year, month=month, target_seconds=target_seconds)
+    # Then clean out expired items (should be deleted)
+    yield from clean_expired_items(table=table, year=year, month=month, retention=retention,
+                                   target_seconds=target_seconds)
+    # Then clean up duplicate data ( warning, slow)
+    yield from clean_duplicate_items(table=table, year=year, month=month, target_seconds=target_seconds,
+                                     engine=engine)
+
+
+def migrate_statements(catalog, table, date, retention, target=None, engine="legacy"):
+    """The statements that clean up a partition on the source side, before
+    it is moved, or None if it doesn't exist.
+
+    The archive is monthly, so a month split in weeks or days is merged
+    first."""
+    parts = [p for p in past_parts(catalog, table, date) if p]
+    if not parts and not catalog.table_exists(get_table_name(table=table, year=date.year, month=date.month)):
+        return None
+    statements = migrate_cleanup(table=table, year=date.year, month=date.month, retention=retention,
+                                 target_seconds=target, engine=engine)
+    if parts:
+        merge = merge_partitions(table=table, year=date.year, month=date.month, parts=parts)
+        statements = itertools.chain(merge, statements)
+    return statements
+
+
+def migrate_units(catalog):
+    """(table, date, statements) of every partition migrate_data cleans up."""
+    target = get_batch_target()
+    engine = get_dedupe_engine()
+    for table, date, retention in archive_months(get_retention(), get_trends_retention()):
+        statements = migrate_statements(catalog, table, date, retention, target=target, engine=engine)
+        if statements is not None:
+            yield table, date, statements
+
+
+def migrate_partition_cleanup(pool, table, date, retention, target, engine, journal=None):
+    """Clean up a partition on the source side, before it is moved."""
+    statements = migrate_statements(pool.catalog, table, date, retention, target=target, engine=engine)
+    if statements is not None:
+        # With a journal, a rerun skips what is already done
+        for x in journaled(journal, "migrate", table, date.year, date.month, statements):
+            pool.execute(x)
+
+
+def migrate_partition_load(source_pool, dest_pool, table, date, streams=1, throttle=None):
+    """Move a cleaned up partition into the archive."""
+    with source_pool.connection() as source:
+        # It's important to use try/catch outside the "with" statement,
+        # otherwise psycopg2 does not call rollback() on the
+        # transaction, leaving us in a broken state.
+        try:
+            # by using "with <connection>" we explicitly open a transaction
+            with source:
+                with source.cursor() as curs:
+                    for x in swap_live_and_archive_tables(table=table, year=date.year, month=date.month):
+                        execute(curs, x, catalog=source_pool.catalog)
+        except psycopg2.ProgrammingError as exc:
+            _log.warning("Error swapping table. Maybe already done?", exc=exc)
+
+    # First we do the high performance COPY operation
+    moved = python_migrate_table_to_archive(src_pool=source_pool, dst_pool=dest_pool,
+                                            table=table, year=date.year, month=date.month,
+                                            streams=streams, throttle=throttle)
+    if moved:
+        return
+
+    with source_pool.connection() as source:
+        # Then, as a fallback, we do the slow performance one that also
+        # cleans out the tables. It does nothing if the table is gone.
+
+        # Explicitly open a transaction
+        with source:
+            with source.cursor() as curs:
+                for x in migrate_table_to_archive(table=table, year=date.year, month=date.month):
+                    execute(curs, x, catalog=source_pool.catalog)
+
+
+def migrate_data(source_pool, dest_pool, journal=None):
+    """Clean up and move every partition older than the retention.
+
+    Each partition is a cleanup task and a load task after it. With
+    ARCHIVE_WORKERS above 1, several partitions are worked on at once (see
+    get_migrate_workers), the oldest first."""
+    months = archive_months(get_retention(), get_trends_retention())
+    target = get_batch_target()
+    engine = get_dedupe_engine()
+    streams = get_streams()
+    throttle = get_throttle()
+    workers, limits = get_migrate_workers()
+
+    connect_check(source_pool)
+    connect_check(dest_pool)
+
+    sched = Scheduler(source_pool, workers=workers, limits=limits)
+    for table, date, retention in months:
+        cleanup = sched.add(
+            task_key(table, date, "cleanup"),
+            functools.partial(migrate_partition_cleanup, source_pool, table, date, retention, target, engine,
+                              journal),
+            group="cleanup",
+        )
+        sched.add(
+            task_key(table, date, "load"),
+            functools.partial(migrate_partition_load, source_pool, dest_pool, table, date, streams, throttle),
+            requires=[cleanup],
+            group="load",
+        )
+    sched.run()
+
+
+def prune_source(table="history", year=2011, month=12, retention=FAST_WINDOW):
+    """The clean up oneshot_prune does through the main db"""
+    # First clean up old (deleted) items
+    yield from archive_clean_old_items(table=table, year=year, month=month)
+    # Then clean out expired items (should be deleted)
+    yield from archive_clean_expired_items(table=table, year=year, month=month, retention=retention)
+
+
+def prune_archive(table="history", year=2011, month=12, layout=()):
+    """The clean up oneshot_prune does on the archive machine, less what the
+    `layout` of a sorted COPY (see get_layout) makes unneeded"""
+    # clean up duplicate data (warning, slow) (must not be in transaction)
+    if "unique" not in layout:
+        yield from archive_dedupe(table=table, year=year, month=month)
+    # run "cluster" on the table (warning, slow)
+    if "sorted" not in layout:
+        yield from archive_cluster(table=table, year=year, month=month)
+
+
+def prune_units(source_catalog, archive_pool):
+    """(job, table, date, statements) of every partition oneshot_prune handles."""
+    start = datetime.date(2021, 1, 1)
+    for table, date, retention in archive_months(get_retention(), get_trends_retention(), start=start):
+        arname = get_table_name(table=FOREIGN_NAMES[table], year=date.year, month=date.month)
+        kws = dict(table=table, year=date.year, month=date.month)
+        if source_catalog.table_exists(arname):
+            yield "prune_source", table, date, prune_source(retention=retention, **kws)
+        if archive_pool.catalog.table_exists(arname):
+            with archive_pool.connection() as archive:
+                layout = get_layout(archive, arname)
+            yield "prune_archive", table, date, prune_archive(**kws, layout=layout)
+
+
+def oneshot_prune(archive_pool, source_pool, journal=None):
     """Cleans out archived data-tables from the following:
 
         - Deleted items
@@ -458,104 +1080,79 @@ def oneshot_prune(archive_connstr, source_connstr):
 
     And fter that, it clusters the table."""
 
-    tables = ("history", "history_uint", "history_text", "history_str")
-    retention = get_retention()
     start = datetime.date(2021, 1, 1)
-    end = get_month_before_retention(retention=retention)
-
-    connect_check(archive_connstr)
-    connect_check(source_connstr)
-
-    for date in months_between(from_date=start, to_date=end):
-        for table in tables:
-            # First we ensure that the table has a btree index.
-            # This needs to happen on the remote database.
-            with connect_autocommit(archive_connstr) as archive:
-                # Check that it exists first.
-                if should_archive_cluster(conn=archive, table=table, year=date.year, month=date.month):
-                    # Note that this must not be run inside a transaction
-                    for x in alter_archive_table(table=table, year=date.year, month=date.month):
-                        prelude_execute(archive, x)
-                    for x in archive_btree_index(table=table, year=date.year, month=date.month):
-                        prelude_execute(archive, x)
-
-            # Now on the main db to remove the old items
-            with connect_autocommit(source_connstr) as source:
-                # Should_maintain checks that the table exists first
-                if should_archive_cluster(conn=source, table=table, year=date.year, month=date.month):
-                    # First clean up old (deleted) items
-                    for x in archive_clean_old_items(table=table, year=date.year, month=date.month):
-                        prelude_execute_transaction(source, x)
-
-                    # Then clean out expired items (should be deleted)
-                    for x in archive_clean_expired_items(table=table, year=date.year,
-                                                         month=date.month, retention=retention):
-                        prelude_execute_transaction(source, x)
-
-            # Now we can do the rest on the archive machine
-            with connect_autocommit(archive_connstr) as archive:
-                # Check that it exists first.
-                if should_archive_cluster(conn=archive, table=table, year=date.year, month=date.month):
-                    # clean up duplicate data (warning, slow) (must not be in
-                    # transaction)
-                    for x in archive_dedupe(table=table, year=date.year, month=date.month):
-                        prelude_execute(archive, x)
-
-                    # run "cluster" on the table (warning, slow)
-                    for x in archive_cluster(table=table, year=date.year, month=date.month):
-                        prelude_execute(archive, x)
-
-
-def oneshot_cluster(connstr):
-    tables = ("history", "history_uint", "history_text", "history_str")
-    retention = get_retention()
-    end = get_month_before_retention(retention=retention)
-
-    with connect_autocommit(connstr) as conn:
-        for date in months_between(to_date=end):
-            for table in tables:
-                if should_archive_cluster(conn, table=table, year=date.year, month=date.month):
-                    for x in archive_cluster(table=table, year=date.year, month=date.month):
-                        with prelude_cursor(conn) as curs:
-                            execute(curs, x)
 
-
-def oneshot_dedupe(connstr):
-    tables = ("history", "history_uint", "history_text", "history_str")
-    retention = get_retention()
-    end = get_month_before_retention(retention=retention)
-
-    with connect_autocommit(connstr) as conn:
-        for date in months_between(to_date=end):
-            for table in tables:
-                if should_archive_cluster(conn, table=table, year=date.year, month=date.month):
-                    for x in archive_dedupe(table=table, year=date.year, month=date.month):
-                        with prelude_cursor(conn) as curs:
-                            execute(curs, x)
-
-
-def oneshot_archive(connstr):
-    tables = ("history", "history_uint", "history_text", "history_str")
-    retention = get_retention()
-    end = get_month_before_retention(retention=retention)
-
-    with connect_autocommit(connstr) as conn:
-        for date in months_between(to_date=end):
-            for table in tables:
-                for x in create_archive_table(table=table, year=date.year, month=date.month):
-                    with prelude_cursor(conn) as curs:
-                        execute(curs, x)
+    connect_check(archive_pool)
+    connect_check(source_pool)
+
+    for table, date, retention in archive_months(get_retention(), get_trends_retention(), start=start):
+        # First we ensure that the table has a btree index.
+        # This needs to happen on the remote database.
+        with archive_pool.connection() as archive:
+            # Check that it exists first.
+            archived = should_archive_cluster(conn=archive, table=table, year=date.year, month=date.month,
+                                              catalog=archive_pool.catalog)
+        if archived:
+            # Note that this must not be run inside a transaction
+            for x in alter_archive_table(table=table, year=date.year, month=date.month):
+                archive_pool.execute(x)
+            for x in archive_btree_index(table=table, year=date.year, month=date.month):
+                archive_pool.execute(x)
+
+        # Now on the main db to remove the old items
+        with source_pool.connection() as source:
+            # Should_maintain checks that the table exists first
+            linked = should_archive_cluster(conn=source, table=table, year=date.year, month=date.month,
+                                            catalog=source_pool.catalog)
+        if linked:
+            statements = prune_source(table=table, year=date.year, month=date.month, retention=retention)
+            for x in journaled(journal, "prune_source", table, date.year, date.month, statements):
+                source_pool.execute_transaction(x)
+
+        # Now we can do the rest on the archive machine
+        if archived:
+            with archive_pool.connection() as archive:
+                # A sorted COPY left it in order and without duplicates
+                layout = get_layout(archive, archive_table_name(table, date))
+            statements = prune_archive(table=table, year=date.year, month=date.month, layout=layout)
+            for x in journaled(journal, "prune_archive", table, date.year, date.month, statements):
+                archive_pool.execute(x)
+
+
+def oneshot_cluster(pool):
+    for table, date, _ in archive_months(get_retention(), get_trends_retention()):
+        with pool.connection() as conn:
+            archived = should_archive_cluster(conn, table=table, year=date.year, month=date.month,
+                                              catalog=pool.catalog)
+            # A sorted COPY left it in order already
+            archived = archived and "sorted" not in get_layout(conn, archive_table_name(table, date))
+        if archived:
+            for x in archive_cluster(table=table, year=date.year, month=date.month):
+                pool.execute(x)
+
+
+def oneshot_dedupe(pool):
+    for table, date, _ in archive_months(get_retention(), get_trends_retention()):
+        with pool.connection() as conn:
+            archived = should_archive_cluster(conn, table=table, year=date.year, month=date.month,
+                                              catalog=pool.catalog)
+            # A sorted COPY left out the duplicates already
+            archived = archived and "unique" not in get_layout(conn, archive_table_name(table, date))
+        if archived:
+            for x in archive_dedupe(table=table, year=date.year, month=date.month):
+                pool.execute(x)
+
+
+def oneshot_archive(pool):
+    for table, date, _ in archive_months(get_retention(), get_trends_retention()):
+        for x in create_archive_table(table=table, year=date.year, month=date.month):
+            pool.execute(x)
 
 
 def oneshot_migrate():
-    tables = ("history", "history_uint", "history_text", "history_str")
-    retention = get_retention()
-    end = get_month_before_retention(retention=retention)
-
-    for date in months_between(to_date=end):
-        for table in tables:
-            for x in migrate_table_to_archive(table=table, year=date.year, month=date.month):
-                print(x)
+    for table, date, _ in archive_months(get_retention(), get_trends_retention()):
+        for x in migrate_table_to_archive(table=table, year=date.year, month=date.month):
+            print(x)
 
 
 def main():
@@ -563,7 +1160,8 @@ def main():
 
     if len(sys.argv) != 2:
         print(f"Usage: {sys.argv[0]} {{ COMMAND }}")
-        print("where COMMAND := { setup_archive | setup_migrate | oneshot_archive | oneshot_cluster | cron | dedupe }")
+        print("where COMMAND := { setup_archive | setup_migrate | oneshot_archive | oneshot_cluster | cron | dedupe "
+              "| progress }")
         print()
         print("Setup commands are to be run first on either system.")
         print("oneshot_archive sets up the archive tables on the archive server")
@@ -573,33 +1171,71 @@ def main():
         print("Then it migrates all tables older than MODIO_ARCHIVE days from"
               "the source to the archive db, finally cleaning out the old tables")
         print("dedupe: Iterates over all tables, removing duplicated rows.")
+        print("progress: Lists what is left of cron and oneshot_prune in the journal.")
+        print()
+        print("Set HOUSEKEEPER_JOURNAL to the path of a journal, to let cron and oneshot_prune resume")
         sys.exit(1)
     command = sys.argv[1]
+    journal = get_journal()
+    if command == "progress" and journal is None:
+        print("Set HOUSEKEEPER_JOURNAL to the journal of the run")
+        sys.exit(1)
 
-    if command == "setup_archive":
-        archive_setup()
-    elif command == "setup_migrate":
-        migrate_setup()
-    elif command == "oneshot_archive":
-        archive_connstr = archive_connstring()
-        oneshot_archive(archive_connstr)
-    elif command == "oneshot_cluster":
-        archive_connstr = archive_connstring()
-        oneshot_cluster(archive_connstr)
-    elif command == "oneshot_prune":
-        archive_connstr = archive_connstring()
-        source_connstr = housekeeper_connstring()
-        oneshot_prune(archive_connstr=archive_connstr,
-                      source_connstr=source_connstr)
-    elif command == "dedupe":
-        archive_connstr = archive_connstring()
-        oneshot_dedupe(archive_connstr)
-    elif command == "cron":
-        archive_connstr = archive_connstring()
-        archive_maintenance(connstr=archive_connstr)
-        source_connstr = housekeeper_connstring()
-        migrate_data(source_connstr=source_connstr,
-                     dest_connstr=archive_connstr)
+    success = False
+    try:
+        if command == "setup_archive":
+            archive_setup()
+        elif command == "setup_migrate":
+            migrate_setup()
+        elif command == "oneshot_archive":
+            with ConnectionPool(archive_connstring()) as archive_pool:
+                archive_pool.load_catalog()
+                oneshot_archive(archive_pool)
+        elif command == "oneshot_cluster":
+            with ConnectionPool(archive_connstring()) as archive_pool:
+                archive_pool.load_catalog()
+                oneshot_cluster(archive_pool)
+        elif command == "oneshot_prune":
+            with ConnectionPool(archive_connstring()) as archive_pool, \
+                    ConnectionPool(housekeeper_connstring()) as source_pool:
+                archive_pool.load_catalog()
+                source_pool.load_catalog()
+                oneshot_prune(archive_pool=archive_pool,
+                              source_pool=source_pool,
+                              journal=journal)
+        elif command == "dedupe":
+            with ConnectionPool(archive_connstring()) as archive_pool:
+                archive_pool.load_catalog()
+                oneshot_dedupe(archive_pool)
+        elif command == "cron":
+            # The same archive connection is used for both steps, and one
+            # connection per COPY stream on either side, for every worker.
+            maxconn = get_streams() * get_migrate_workers()[0]
+            with ConnectionPool(archive_connstring(), maxconn=maxconn) as archive_pool, \
+                    ConnectionPool(housekeeper_connstring(), maxconn=maxconn) as source_pool:
+                archive_pool.load_catalog()
+                source_pool.load_catalog()
+                archive_maintenance(pool=archive_pool)
+                migrate_data(source_pool=source_pool,
+                             dest_pool=archive_pool,
+                             journal=journal)
+        elif command == "progress":
+            with ConnectionPool(archive_connstring()) as archive_pool, \
+                    ConnectionPool(housekeeper_connstring()) as source_pool:
+                archive_pool.load_catalog()
+                source_catalog = source_pool.load_catalog()
+                print_progress(journal, "migrate", migrate_units(source_catalog))
+                for job in ("prune_source", "prune_archive"):
+                    units = ((t, d, x) for j, t, d, x in prune_units(source_catalog, archive_pool) if j == job)
+                    print_progress(journal, job, units)
+        success = True
+    finally:
+        EXPLAIN.save(journal)
+        if journal is not None:
+            journal.close()
+        STATS.log()
+        METRICS.write("archiver", success=success)
+        TRACER.write("archiver")
     print("/* All operations succesful! */")
 
 
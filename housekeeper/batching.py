@@ -0,0 +1,144 @@
+"""Adaptive batch sizing for the clean up DELETE statements.
+
+The clean_* generators in housekeeper.py split a month into fixed clock
+windows. How long a window takes depends on how dense the partition is, so
+some batches finish in seconds while others block for hours.
+
+AdaptiveDelete instead measures each batch, and grows or shrinks the clock
+window towards a target duration. When a batch is cancelled by
+`statement_timeout`, the window is halved and the same range is retried.
+
+An AdaptiveDelete is yielded by the generators in place of a SQL string, and
+helpers.execute runs it on the cursor, as it needs the result of each batch
+before it can size the next.
+"""
+import copy
+import os
+import time
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import structlog
+
+from .explain import Plan
+from .helpers import execute
+from .logs import log_state
+
+_log = structlog.get_logger(__name__)
+
+MINUTE = 60
+DAY = 86400
+
+
+def get_batch_target():
+    """
+    environment variable HOUSEKEEPER_BATCH_TARGET is the number of seconds a
+    clean up batch should take. When it is not set, fixed batches are used."""
+    target = os.environ.get("HOUSEKEEPER_BATCH_TARGET")
+    if not target:
+        return None
+    return float(target)
+
+
+class AdaptiveBatcher:
+    """Sizes clock windows so each batch takes about `target` seconds.
+
+    The window changes by at most a factor of two per batch, so a single odd
+    batch doesn't swing it from one extreme to the other.
+    """
+
+    def __init__(self, target, window=DAY, minimum=MINUTE, maximum=31 * DAY):
+        self.target = target
+        self.window = window
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def _clamp(self, window):
+        return int(min(max(window, self.minimum), self.maximum))
+
+    def record(self, seconds, rows=None):
+        """Adjust the window after a batch that took `seconds`."""
+        ratio = self.target / max(seconds, 0.001)
+        ratio = min(max(ratio, 0.5), 2.0)
+        self.window = self._clamp(self.window * ratio)
+        return self.window
+
+    def timed_out(self):
+        """Halve the window after a timeout. False if it can't get smaller."""
+        if self.window <= self.minimum:
+            return False
+        self.window = self._clamp(self.window // 2)
+        return True
+
+
+class AdaptiveDelete:
+    """A DELETE over [start, stop) run in adaptively sized batches.
+
+    `template(start, stop)` returns the SQL for one batch. If `vacuum` is
+    given, it is run before every `vacuum_every` batch, like
+    clean_duplicate_items does for its fixed batches.
+
+    `done(start, stop)`, if given, is called after each batch that is
+    committed, see journal.JournaledStatement.
+    """
+
+    def __init__(self, template, start, stop, batcher, step, where, vacuum=None, vacuum_every=11, done=None):
+        self.template = template
+        self.start = start
+        self.stop = stop
+        self.batcher = batcher
+        self.step = step
+        self.where = where
+        self.vacuum = vacuum
+        self.vacuum_every = vacuum_every
+        self.done = done
+
+    def __str__(self):
+        return f"-- {self.step} on {self.where} from {self.start} to {self.stop}, adaptive batches"
+
+    def resume(self, start, done):
+        """The same DELETE, from `start` on, calling `done` after each batch."""
+        resumed = copy.copy(self)
+        resumed.start = max(start, self.start)
+        resumed.done = done
+        return resumed
+
+    def __call__(self, cursor, catalog=None):
+        start = self.start
+        count = 0
+        total = 0
+        while start < self.stop:
+            stop = min(start + self.batcher.window, self.stop)
+            with log_state(step=self.step, where=self.where, batch_start=start,
+                           batch_stop=stop, iteration=count):
+                if self.vacuum is not None and count % self.vacuum_every == 0:
+                    execute(cursor, self.vacuum, catalog=catalog)
+
+                begin = time.monotonic()
+                try:
+                    result = execute(cursor, self.template(start, stop), catalog=catalog)
+                except psycopg2.errors.QueryCanceled:
+                    status = cursor.connection.info.transaction_status
+                    # Inside a transaction we cannot retry, the caller has
+                    # to roll back first.
+                    if status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                        raise
+                    if not self.batcher.timed_out():
+                        raise
+                    _log.warning("Batch timed out, retrying a smaller range", window=self.batcher.window)
+                    continue
+
+                elapsed = time.monotonic() - begin
+                rows = result.rows if isinstance(result, Plan) else max(cursor.rowcount, 0)
+                window = self.batcher.record(elapsed, rows)
+                _log.info("Batch done", rows=rows, rows_per_second=round(rows / max(elapsed, 0.001)),
+                          next_window=window)
+                status = cursor.connection.info.transaction_status
+                if self.done is not None and status == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    self.done(start, stop)
+            total += rows
+            count += 1
+            start = stop
+        _log.info("Adaptive batches done", step=self.step, where=self.where, batches=count, rows=total)
+        return total
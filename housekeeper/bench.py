@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""Benchmarks on synthetic partitions in a scratch database.
+
+Connects with the BENCH_PG* environment variables (see
+helpers.env_connstring), creates its own `bench_*` tables and drops them
+afterwards. Never point this at a production database.
+
+    python -m housekeeper.bench dedupe [ROWS ...]
+    python -m housekeeper.bench copy [ROWS ...]
+    python -m housekeeper.bench load [ROWS ...]
+
+dedupe: Each engine runs on a freshly generated partition of ROWS rows, where
+1% of the rows are duplicated.
+
+copy: Moves a partition of ROWS rows into an archive table (with the archive's
+NUMERIC value column) over a second connection, with text and binary COPY.
+Binary COPY casts the values to NUMERIC on the source side.
+
+load: Copies a partition of ROWS rows into an archive table created as
+create_archive_table does, once for every ARCHIVE_BULK_LOAD mode. The time
+includes rebuilding the index and an ANALYZE, and the WAL written is counted.
+
+BENCH_TIMEOUT (seconds, default 4 hours) sets the statement_timeout for each
+dedupe run, so a run that does not finish can give up.
+HOUSEKEEPER_ROLE must be set, as for the other tools.
+"""
+import os
+import sys
+import time
+
+import psycopg2.extensions
+import structlog
+
+from .archiver import (
+    BULK_LOAD_MODES,
+    CREATE_ROOT,
+    bulk_load_finish,
+    bulk_load_start,
+    copy_columns,
+    copy_relay,
+    range_select,
+)
+from .dedupe import ENGINES
+from .helpers import ConnectionPool, env_connstring, execute, get_table_name
+from .housekeeper import clean_duplicate_items, ensure_brin_index
+from .logs import log_state, setup_logging
+from .times import get_start_and_stop
+
+_log = structlog.get_logger(__name__)
+
+BENCH_TABLE = "bench_history"
+BENCH_ARCHIVE = "bench_archive"
+YEAR, MONTH = 2018, 2
+DEFAULT_ROWS = (1_000_000, 10_000_000, 100_000_000)
+
+
+def create_synthetic_partition(partition, rows, items=10000):
+    """A month of float history for `items` items, with 1% duplicated rows.
+
+    The data is the same on every run, so all engines should delete the same
+    number of rows. It has the brin index that maintenance creates.
+    """
+    start, stop = get_start_and_stop(year=YEAR, month=MONTH)
+    yield f"DROP TABLE IF EXISTS {partition};"
+    yield f"""CREATE UNLOGGED TABLE {partition} AS
+SELECT (n % {items})::bigint AS itemid,
+       ({start} + (n::bigint * {stop - start}) / {rows})::integer AS clock,
+       ((n::bigint * 7919) % 100000) / 100.0::double precision AS value,
+       (n % 1000000000)::integer AS ns
+FROM generate_series(0, {rows - 1}) AS n;"""
+    yield f"INSERT INTO {partition} SELECT * FROM {partition} WHERE ns % 100 = 0;"
+    yield from ensure_brin_index(table=BENCH_TABLE, year=YEAR, month=MONTH)
+    yield f"VACUUM ANALYZE {partition};"
+
+
+def count_rows(pool, partition):
+    with pool.cursor() as curs:
+        curs.execute(f"SELECT COUNT(*) FROM {partition};")
+        return curs.fetchone()[0]
+
+
+def bench_dedupe(pool, sizes=DEFAULT_ROWS):
+    partition = get_table_name(table=BENCH_TABLE, year=YEAR, month=MONTH)
+    timeout = int(os.environ.get("BENCH_TIMEOUT", 4 * 3600))
+    results = []
+    for rows in sizes:
+        for engine in ENGINES:
+            with log_state(bench="dedupe", rows=rows, engine=engine):
+                for x in create_synthetic_partition(partition, rows):
+                    pool.execute(x)
+                before = count_rows(pool, partition)
+
+                statements = clean_duplicate_items(table=BENCH_TABLE, year=YEAR, month=MONTH, engine=engine)
+
+                start = time.monotonic()
+                try:
+                    with pool.cursor() as curs:
+                        # The VACUUMs can't run in a transaction, so no SET
+                        # LOCAL, and the pooled connection is reset instead.
+                        execute(curs, f"SET statement_timeout = '{timeout}s';")
+                        try:
+                            for x in statements:
+                                execute(curs, x)
+                        finally:
+                            status = curs.connection.info.transaction_status
+                            if status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                                execute(curs, "ROLLBACK;")
+                            execute(curs, "RESET statement_timeout;")
+                except Exception:
+                    _log.exception("Benchmark run failed")
+                    elapsed = None
+                else:
+                    elapsed = time.monotonic() - start
+                after = count_rows(pool, partition)
+            results.append((rows, engine, elapsed, before - after))
+    pool.execute(f"DROP TABLE IF EXISTS {partition};")
+
+    print(f"{'rows':>12} {'engine':<8} {'seconds':>10} {'deleted':>10}")
+    for rows, engine, elapsed, deleted in results:
+        seconds = "failed" if elapsed is None else f"{elapsed:.1f}"
+        print(f"{rows:>12} {engine:<8} {seconds:>10} {deleted:>10}")
+    return results
+
+
+def bench_copy(pool, sizes=DEFAULT_ROWS):
+    src_table = get_table_name(table=BENCH_TABLE, year=YEAR, month=MONTH)
+    dst_table = get_table_name(table=BENCH_ARCHIVE, year=YEAR, month=MONTH)
+    start, stop = get_start_and_stop(year=YEAR, month=MONTH)
+    results = []
+    for rows in sizes:
+        for x in create_synthetic_partition(src_table, rows):
+            pool.execute(x)
+        for copy_format in ("text", "binary"):
+            with log_state(bench="copy", rows=rows, format=copy_format):
+                pool.execute(f"DROP TABLE IF EXISTS {dst_table};")
+                pool.execute(CREATE_ROOT["history"].format(tablename=dst_table, start=start, stop=stop))
+                with pool.connection() as src, pool.connection() as dst:
+                    columns, _ = copy_columns(src, dst, src_table, dst_table)
+                    options = " WITH (FORMAT binary)" if copy_format == "binary" else ""
+                    with dst:
+                        copied, size, elapsed = copy_relay(
+                            src, dst,
+                            f"COPY (SELECT {columns} FROM {src_table}) TO STDOUT{options};",
+                            f"COPY {dst_table} FROM STDIN{options};",
+                        )
+            results.append((copied, copy_format, elapsed, size))
+    pool.execute(f"DROP TABLE IF EXISTS {src_table};")
+    pool.execute(f"DROP TABLE IF EXISTS {dst_table};")
+
+    print(f"{'rows':>12} {'format':<8} {'seconds':>10} {'MB':>10} {'MB/s':>10} {'rows/s':>12}")
+    for rows, copy_format, elapsed, size in results:
+        elapsed = max(elapsed, 0.001)
+        print(f"{rows:>12} {copy_format:<8} {elapsed:>10.1f} {size / 1e6:>10.1f} {size / 1e6 / elapsed:>10.1f} "
+              f"{rows / elapsed:>12.0f}")
+    return results
+
+
+def wal_position(pool):
+    with pool.cursor() as curs:
+        curs.execute("SELECT pg_current_wal_lsn();")
+        return curs.fetchone()[0]
+
+
+def wal_since(pool, lsn):
+    with pool.cursor() as curs:
+        curs.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s);", (lsn,))
+        return int(curs.fetchone()[0])
+
+
+def bench_load(pool, sizes=DEFAULT_ROWS):
+    src_table = get_table_name(table=BENCH_TABLE, year=YEAR, month=MONTH)
+    dst_table = get_table_name(table=BENCH_ARCHIVE, year=YEAR, month=MONTH)
+    start, stop = get_start_and_stop(year=YEAR, month=MONTH)
+    results = []
+    for rows in sizes:
+        for x in create_synthetic_partition(src_table, rows):
+            pool.execute(x)
+        for mode in BULK_LOAD_MODES:
+            unlogged = mode == "unlogged"
+            with log_state(bench="load", rows=rows, mode=mode):
+                pool.execute(f"DROP TABLE IF EXISTS {dst_table};")
+                pool.execute(CREATE_ROOT["history"].format(tablename=dst_table, start=start, stop=stop))
+                for x in ensure_brin_index(table=BENCH_ARCHIVE, year=YEAR, month=MONTH):
+                    pool.execute(x)
+                lsn = wal_position(pool)
+                began = time.monotonic()
+                if mode != "off":
+                    for x in bulk_load_start(table=BENCH_ARCHIVE, year=YEAR, month=MONTH, unlogged=unlogged):
+                        pool.execute(x)
+                with pool.connection() as src, pool.connection() as dst:
+                    columns, _ = copy_columns(src, dst, src_table, dst_table)
+                    select = range_select(columns, src_table, start, stop, unique=True, ordered=True)
+                    with dst:
+                        copied, _, _ = copy_relay(src, dst, f"COPY ({select}) TO STDOUT;",
+                                                  f"COPY {dst_table} FROM STDIN;")
+                loaded = time.monotonic()
+                if mode == "off":
+                    # The same statistics as bulk_load_finish leaves
+                    pool.execute(f"ANALYZE {dst_table};")
+                else:
+                    for x in bulk_load_finish(table=BENCH_ARCHIVE, year=YEAR, month=MONTH, unlogged=unlogged):
+                        pool.execute(x)
+                done = time.monotonic()
+                wal = wal_since(pool, lsn)
+            results.append((copied, mode, loaded - began, done - loaded, wal))
+    pool.execute(f"DROP TABLE IF EXISTS {src_table};")
+    pool.execute(f"DROP TABLE IF EXISTS {dst_table};")
+
+    print(f"{'rows':>12} {'mode':<8} {'load s':>10} {'finish s':>10} {'total s':>10} {'WAL MB':>10}")
+    for rows, mode, load, finish, wal in results:
+        print(f"{rows:>12} {mode:<8} {load:>10.1f} {finish:>10.1f} {load + finish:>10.1f} {wal / 1e6:>10.1f}")
+    return results
+
+
+BENCHMARKS = {
+    "dedupe": bench_dedupe,
+    "copy": bench_copy,
+    "load": bench_load,
+}
+
+
+def main():
+    setup_logging()
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Usage: {sys.argv[0]} {{ {' | '.join(BENCHMARKS)} }} [ROWS ...]")
+        sys.exit(1)
+    sizes = tuple(int(x) for x in sys.argv[2:]) or DEFAULT_ROWS
+    with ConnectionPool(env_connstring(prefix="BENCH"), maxconn=2) as pool:
+        BENCHMARKS[sys.argv[1]](pool, sizes)
+
+
+if __name__ == "__main__":
+    main()
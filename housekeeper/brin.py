@@ -0,0 +1,313 @@
+"""Choosing the BRIN index of a partition from its statistics.
+
+A BRIN index keeps the min and max of (itemid, clock) for every range of
+`pages_per_range` pages. Zabbix asks for one item over a clock range, and
+such a query reads all of the index, and then every range that might match.
+Small ranges read less of the table, but make a larger index, so the range
+is chosen to make the two together smallest, from the pages of the partition
+and how many ranges fit on an index page.
+
+Which operator class to use depends on how the partition is laid out:
+
+clustered:   After cluster day, the rows are in (itemid, clock) order, and
+             a range holds a few items. Plain minmax fits this best.
+
+clock order: The current month, and months never clustered, are in insert
+             order, which is clock order but for late rows from proxies.
+             Where the server has them (PostgreSQL 14), the minmax-multi
+             operator class on clock keeps the late rows from widening the
+             whole range, at the price of a larger index. How many late
+             rows there are doesn't show in the statistics, so both it and
+             plain minmax are tried.
+
+other:       Neither order helps, and the index keeps the default.
+
+The layout is read from pg_stats.correlation, and the pages from relpages,
+or from reltuples and the row width before the partition was vacuumed.
+
+The index in use and the choices are compared on a sample of item and clock
+range queries, counting the blocks each reads. They are built and measured on
+a temporary copy of the first SAMPLE_PAGES pages of the partition, in the
+order they are in, so no lock is taken on the partition itself. As the index
+of the copy is smaller, its blocks are scaled up to the whole partition.
+
+Only the one that reads the fewest is built on the partition. It gets a
+comment with the choices it was measured against, and as long as the
+statistics call for the same choices, the partition is not tried again.
+"""
+import json
+import os
+import re
+
+import structlog
+
+from .helpers import execute
+from .logs import log_state
+
+_log = structlog.get_logger(__name__)
+
+TUNE_MODES = ("off", "on")
+DEFAULT_PAGES_PER_RANGE = 16
+MIN_PAGES_PER_RANGE = 4
+MAX_PAGES_PER_RANGE = 128
+# |correlation| from which a column counts as in order
+ORDERED = 0.9
+MULTI_MINMAX_VERSION = 140000
+CLOCK_MULTI_OPS = "int4_minmax_multi_ops"
+# Ranges summarized per index page, measured on (itemid, clock) indexes
+RANGES_PER_PAGE = {None: 190, CLOCK_MULTI_OPS: 60}
+# Pages of the partition copied to measure the choices on, 32 MiB
+SAMPLE_PAGES = 4096
+TUNED = "housekeeper brin tuned for "
+
+STATS_SQL = """SELECT c.relpages,
+       c.reltuples,
+       current_setting('server_version_num')::integer,
+       (SELECT correlation FROM pg_stats s
+        WHERE s.schemaname = n.nspname AND s.tablename = c.relname AND s.attname = 'itemid'),
+       (SELECT correlation FROM pg_stats s
+        WHERE s.schemaname = n.nspname AND s.tablename = c.relname AND s.attname = 'clock'),
+       (SELECT SUM(avg_width) FROM pg_stats s
+        WHERE s.schemaname = n.nspname AND s.tablename = c.relname)
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relname = %s
+AND n.nspname = ANY(current_schemas(false));"""
+
+
+def get_brin_tune():
+    """
+    environment variable HOUSEKEEPER_BRIN_TUNE is "on" to choose the BRIN
+    index of past partitions from their statistics, or "off" (the default)
+    to keep pages_per_range 16 everywhere."""
+    mode = os.environ.get("HOUSEKEEPER_BRIN_TUNE", "off")
+    if mode not in TUNE_MODES:
+        raise ValueError(f"HOUSEKEEPER_BRIN_TUNE must be one of {TUNE_MODES}")
+    return mode == "on"
+
+
+def brin_index_sql(index, table, pages_per_range=DEFAULT_PAGES_PER_RANGE, clock_ops=None, concurrently=True):
+    conc = "CONCURRENTLY " if concurrently else ""
+    clock = f"clock {clock_ops}" if clock_ops else "clock"
+    return (
+        f"CREATE INDEX {conc}IF NOT EXISTS {index} on {table} "
+        f"USING brin (itemid, {clock}) WITH (pages_per_range='{pages_per_range}');"
+    )
+
+
+class BrinStats:
+    def __init__(self, pages=0, rows=0, version=0, itemid_correlation=None, clock_correlation=None,
+                 width=None):
+        self.pages = pages
+        self.rows = rows
+        self.version = version
+        self.itemid_correlation = itemid_correlation
+        self.clock_correlation = clock_correlation
+        self.width = width
+
+    @classmethod
+    def load(cls, cursor, partition):
+        cursor.execute(STATS_SQL, (partition,))
+        row = cursor.fetchone()
+        return cls(*row) if row else cls()
+
+    @property
+    def table_pages(self):
+        if self.pages > 0:
+            return self.pages
+        if self.rows > 0 and self.width:
+            # Tuple header and line pointer, on pages that are 90% full
+            return self.rows * (self.width + 28) / (8192 * 0.9)
+        return 0
+
+
+def brin_cost(pages, pages_per_range, clock_ops=None):
+    """Blocks a query for one item reads: all of the index, and about one
+    range of the table."""
+    return pages_per_range + pages / pages_per_range / RANGES_PER_PAGE[clock_ops]
+
+
+def best_pages_per_range(pages, clock_ops=None):
+    choices = []
+    pages_per_range = MIN_PAGES_PER_RANGE
+    while pages_per_range <= MAX_PAGES_PER_RANGE:
+        choices.append(pages_per_range)
+        pages_per_range *= 2
+    return min(choices, key=lambda ppr: brin_cost(pages, ppr, clock_ops))
+
+
+def choose_brin(stats):
+    """The (pages_per_range, clock operator class or None) to try on a
+    partition, the likely best first."""
+    pages = stats.table_pages
+    if not pages:
+        return [(DEFAULT_PAGES_PER_RANGE, None)]
+    minmax = (best_pages_per_range(pages), None)
+    if abs(stats.itemid_correlation or 0) >= ORDERED:
+        return [minmax]
+    if abs(stats.clock_correlation or 0) >= ORDERED:
+        if stats.version >= MULTI_MINMAX_VERSION:
+            return [(best_pages_per_range(pages, CLOCK_MULTI_OPS), CLOCK_MULTI_OPS), minmax]
+        return [minmax]
+    return [(DEFAULT_PAGES_PER_RANGE, None)]
+
+
+def current_brin(indexdef):
+    """(pages_per_range, clock operator class or None) from pg_get_indexdef."""
+    m = re.search(r"pages_per_range='?(\d+)", indexdef)
+    pages_per_range = int(m.group(1)) if m else 128
+    m = re.search(r"clock (\w+_ops)", indexdef)
+    return pages_per_range, m.group(1) if m else None
+
+
+def tuned_comment(choices):
+    """The comment of an index that was measured against `choices`."""
+    return TUNED + ", ".join(f"{ppr} {ops or 'minmax'}" for ppr, ops in choices)
+
+
+def sample_queries(partition, itemids, start, stop, hours=6):
+    """Zabbix style reads of one item over a few hours, spread over the month."""
+    step = max((stop - start - hours * 3600) // max(len(itemids), 1), 1)
+    for n, itemid in enumerate(itemids):
+        begin = start + n * step
+        yield (
+            f"SELECT * FROM {partition} WHERE itemid = {itemid} "
+            f"AND clock >= {begin} AND clock < {begin + hours * 3600}"
+        )
+
+
+def _plan_blocks(plan):
+    """Blocks a plan node read, of tables or temporary tables."""
+    return sum(plan.get(f"{kind} {how} Blocks", 0) for kind in ("Shared", "Local") for how in ("Hit", "Read"))
+
+
+def _index_blocks(plan):
+    if plan["Node Type"] == "Bitmap Index Scan":
+        return _plan_blocks(plan)
+    return sum(_index_blocks(child) for child in plan.get("Plans", ()))
+
+
+def query_blocks(cursor, queries, index_scale=1.0):
+    """The blocks the queries read together, forced to use an index, with
+    the blocks of the index times `index_scale`."""
+    total = 0.0
+    execute(cursor, "SET LOCAL enable_seqscan = off;")
+    for query in queries:
+        cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}")
+        result = cursor.fetchone()[0]
+        if isinstance(result, str):
+            result = json.loads(result)
+        plan = result[0]["Plan"]
+        index = _index_blocks(plan)
+        total += _plan_blocks(plan) - index + index * index_scale
+    return round(total)
+
+
+class BrinTune:
+    """Give a partition the BRIN index its statistics call for, see the
+    module docstring. Leaves partitions with a btree index alone, as the
+    btree is what their queries use."""
+
+    def __init__(self, table, index, samples=20, lock_timeout=5):
+        self.table = table
+        self.index = index
+        self.samples = samples
+        self.lock_timeout = lock_timeout
+
+    def __str__(self):
+        return f"-- tune {self.index} on {self.table}"
+
+    @property
+    def copy(self):
+        return f"{self.table}_tune"
+
+    def _indexdefs(self, cursor):
+        cursor.execute(
+            "SELECT i.relname, am.amname, pg_get_indexdef(i.oid), obj_description(i.oid, 'pg_class') "
+            "FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid JOIN pg_am am ON am.oid = i.relam "
+            "WHERE x.indrelid = to_regclass(%s);",
+            (self.table,),
+        )
+        return {name: (am, indexdef, comment) for name, am, indexdef, comment in cursor.fetchall()}
+
+    def _copy(self, cursor, candidates):
+        """Copy the first pages of the partition, and build the candidates on
+        the copy. Returns how many times larger the partition is."""
+        execute(cursor, f"DROP TABLE IF EXISTS pg_temp.{self.copy};")
+        execute(cursor, "BEGIN TRANSACTION;")
+        # A synchronized scan may start halfway, and copy the pages out of order
+        execute(cursor, "SET LOCAL synchronize_seqscans = off;")
+        execute(cursor, f"CREATE TEMPORARY TABLE {self.copy} AS "
+                        f"SELECT * FROM {self.table} WHERE ctid < '({SAMPLE_PAGES},0)'::tid;")
+        execute(cursor, "COMMIT;")
+        for candidate, (pages_per_range, clock_ops) in candidates.items():
+            execute(cursor, brin_index_sql(candidate, self.copy, pages_per_range, clock_ops, concurrently=False))
+        execute(cursor, f"ANALYZE {self.copy};")
+        cursor.execute("SELECT pg_relation_size(%s::regclass), pg_relation_size(%s::regclass);",
+                       (self.table, f"pg_temp.{self.copy}"))
+        table_size, copy_size = cursor.fetchone()
+        return max(table_size / max(copy_size, 1), 1.0)
+
+    def _measure(self, cursor, keep, indexes, queries, index_scale):
+        """Blocks read by `queries` with only the index `keep` of `indexes`.
+        The others are dropped in a transaction that is rolled back, which
+        only hides them from the planner. They are on the copy, so that
+        locks nothing others use."""
+        execute(cursor, "BEGIN TRANSACTION;")
+        try:
+            for index in indexes:
+                if index != keep:
+                    execute(cursor, f"DROP INDEX pg_temp.{index};")
+            return query_blocks(cursor, queries, index_scale)
+        finally:
+            execute(cursor, "ROLLBACK;")
+
+    def _queries(self, cursor):
+        cursor.execute(f"SELECT DISTINCT itemid FROM {self.copy} TABLESAMPLE SYSTEM (10) LIMIT {self.samples};")
+        itemids = sorted(itemid for itemid, in cursor.fetchall())
+        cursor.execute(f"SELECT MIN(clock), MAX(clock) + 1 FROM {self.copy};")
+        start, stop = cursor.fetchone()
+        return list(sample_queries(self.copy, itemids, start or 0, stop or 0))
+
+    def __call__(self, cursor, catalog=None):
+        with log_state(step="tune_brin", index=self.index):
+            indexes = self._indexdefs(cursor)
+            if self.index not in indexes or any(am == "btree" for am, _, _ in indexes.values()):
+                _log.info("Not tuning, no brin index or a btree index in use")
+                return None
+            choices = choose_brin(BrinStats.load(cursor, self.table))
+            _, indexdef, comment = indexes[self.index]
+            have = current_brin(indexdef)
+            if have in choices or comment == tuned_comment(choices):
+                _log.info("BRIN index already tuned", pages_per_range=have[0], clock_ops=have[1])
+                return have
+
+            candidates = {f"{self.copy}_idx": have}
+            for n, choice in enumerate(choices):
+                candidates[f"{self.copy}_idx{n}"] = choice
+            try:
+                index_scale = self._copy(cursor, candidates)
+                queries = self._queries(cursor)
+                blocks = {index: self._measure(cursor, index, candidates, queries, index_scale)
+                          for index in candidates}
+            finally:
+                execute(cursor, f"DROP TABLE IF EXISTS pg_temp.{self.copy};")
+            # The index in use wins ties, it needs no rebuild
+            best = min(candidates, key=lambda index: (blocks[index], candidates[index] != have))
+            for index, (pages_per_range, clock_ops) in candidates.items():
+                _log.info("Measured BRIN index", queries=len(queries), blocks=blocks[index],
+                          pages_per_range=pages_per_range, clock_ops=clock_ops, best=index == best)
+
+            if candidates[best] != have:
+                pages_per_range, clock_ops = candidates[best]
+                tuned = f"{self.index}_tuned"
+                execute(cursor, f"DROP INDEX CONCURRENTLY IF EXISTS {tuned};")
+                execute(cursor, brin_index_sql(tuned, self.table, pages_per_range, clock_ops))
+                execute(cursor, "BEGIN TRANSACTION;")
+                execute(cursor, f"SET LOCAL lock_timeout = '{self.lock_timeout}s';")
+                execute(cursor, f"DROP INDEX {self.index};")
+                execute(cursor, f"ALTER INDEX {tuned} RENAME TO {self.index};")
+                execute(cursor, "COMMIT;")
+            # Remember the choices, so the same are not measured again
+            execute(cursor, f"COMMENT ON INDEX {self.index} IS '{tuned_comment(choices)}';")
+            return candidates[best]
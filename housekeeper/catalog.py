@@ -0,0 +1,223 @@
+"""A snapshot of the tables, partitions, indexes and constraints in a database.
+
+The snapshot is loaded with a single query at the start of a run, and is
+then kept up to date from the DDL we execute ourselves. That lets us answer
+"does this table exist" without a query per table and month, and skip
+statements that would not change anything, like `CREATE INDEX IF NOT EXISTS`
+on an index that is already there.
+
+Statements inside `DO $$ ... $$` blocks are conditional, and are not tracked.
+"""
+import re
+import threading
+
+import structlog
+
+_log = structlog.get_logger(__name__)
+
+
+CATALOG_QUERY = """
+SELECT c.relname,
+       c.relkind,
+       p.relname AS parent,
+       CASE WHEN c.relkind = 'r' THEN pg_total_relation_size(c.oid) ELSE 0 END AS bytes,
+       c.reltuples::bigint AS rows,
+       ARRAY(SELECT i.relname || ':' || am.amname
+             FROM pg_index x
+             JOIN pg_class i ON i.oid = x.indexrelid
+             JOIN pg_am am ON am.oid = i.relam
+             WHERE x.indrelid = c.oid) AS indexes,
+       ARRAY(SELECT conname FROM pg_constraint WHERE conrelid = c.oid) AS constraints
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_inherits inh ON inh.inhrelid = c.oid
+LEFT JOIN pg_class p ON p.oid = inh.inhparent
+WHERE c.relkind IN ('r', 'p', 'f')
+AND n.nspname = ANY(current_schemas(false));"""
+
+_FLAGS = re.IGNORECASE | re.DOTALL
+CREATE_INDEX = re.compile(
+    r"CREATE INDEX\s+(?:CONCURRENTLY\s+)?IF NOT EXISTS\s+(\w+)\s+on\s+(\w+)\s+using\s+(\w+)", _FLAGS)
+DROP_INDEX = re.compile(r"DROP INDEX\s+(?:CONCURRENTLY\s+)?IF EXISTS\s+(\w+)", _FLAGS)
+CREATE_PARTITION = re.compile(
+    r"CREATE (FOREIGN )?TABLE IF NOT EXISTS\s+(\w+)\s+PARTITION OF\s+(\w+)", _FLAGS)
+CREATE_TABLE = re.compile(r"CREATE TABLE IF NOT EXISTS\s+(\w+)\s*\(", _FLAGS)
+DROP_TABLE = re.compile(r"DROP TABLE\s+(?:IF EXISTS\s+)?(\w+)", _FLAGS)
+DETACH = re.compile(r"ALTER TABLE\s+(\w+)\s+DETACH PARTITION\s+(\w+)", _FLAGS)
+ATTACH = re.compile(r"ALTER TABLE\s+(\w+)\s+ATTACH PARTITION\s+(\w+)", _FLAGS)
+ADD_CONSTRAINT = re.compile(r"ALTER TABLE\s+(\w+)\s+ADD CONSTRAINT\s+(\w+)", _FLAGS)
+DROP_CONSTRAINT = re.compile(r"ALTER TABLE\s+(\w+)\s+DROP CONSTRAINT IF EXISTS\s+(\w+)", _FLAGS)
+RENAME_TABLE = re.compile(r"ALTER TABLE\s+(\w+)\s+RENAME TO\s+(\w+)", _FLAGS)
+# What follows the month in the name of a week or day partition
+PART_SUFFIX = re.compile(r"w\d|d\d\d")
+
+
+def _single(statement):
+    """The statement without the final ";", or None if there are several."""
+    stmt = statement.strip().rstrip(";")
+    if ";" in stmt:
+        return None
+    return stmt
+
+
+class Relation:
+    """A table, partitioned table or foreign table."""
+
+    def __init__(self, name, kind="r", parent=None, size=0, rows=0, indexes=None, constraints=None):
+        self.name = name
+        self.kind = kind
+        self.parent = parent
+        self.size = size
+        self.rows = rows
+        # index name: access method (btree, brin, ...)
+        self.indexes = dict(indexes or {})
+        self.constraints = set(constraints or ())
+
+    @property
+    def archived(self):
+        """Archived partitions are foreign tables on the archive server."""
+        return self.kind == "f"
+
+
+class Catalog:
+    def __init__(self, rows=()):
+        self._lock = threading.Lock()
+        self.relations = {}
+        for name, kind, parent, size, reltuples, indexes, constraints in rows:
+            indexes = dict(i.split(":", 1) for i in indexes)
+            self.relations[name] = Relation(name, kind, parent, size, reltuples, indexes, constraints)
+
+    @classmethod
+    def load(cls, conn):
+        with conn.cursor() as curs:
+            curs.execute(CATALOG_QUERY)
+            rows = curs.fetchall()
+        catalog = cls(rows)
+        _log.info("Loaded catalog", relations=len(catalog.relations))
+        return catalog
+
+    def copy(self):
+        """A copy to observe statements on, leaving this one as it is."""
+        with self._lock:
+            rows = [
+                (r.name, r.kind, r.parent, r.size, r.rows, [f"{i}:{am}" for i, am in r.indexes.items()],
+                 r.constraints)
+                for r in self.relations.values()
+            ]
+        return Catalog(rows)
+
+    def table_exists(self, table):
+        """Same as helpers.table_exists, which only looks at pg_tables."""
+        with self._lock:
+            rel = self.relations.get(table)
+            return rel is not None and rel.kind in ("r", "p")
+
+    def _index_table(self, index):
+        for rel in self.relations.values():
+            if index in rel.indexes:
+                return rel
+        return None
+
+    def has_index(self, index):
+        with self._lock:
+            return self._index_table(index) is not None
+
+    def partitions(self, parent):
+        with self._lock:
+            found = [r for r in self.relations.values() if r.parent == parent]
+        return sorted(found, key=lambda r: r.name)
+
+    def is_partitioned(self, table):
+        with self._lock:
+            rel = self.relations.get(table)
+            return rel is not None and rel.kind == "p"
+
+    def parts(self, table, year, month):
+        """Suffixes of the partitions a month has, "" when it is a single
+        partition, or [] when it has none. See times.month_parts."""
+        prefix = f"{table}_y{year}m{month:02d}"
+        with self._lock:
+            names = [n for n, r in self.relations.items() if n.startswith(prefix) and r.kind in ("r", "p")]
+        suffixes = (n[len(prefix):] for n in names)
+        return sorted(x for x in suffixes if x == "" or PART_SUFFIX.fullmatch(x))
+
+    def is_noop(self, statement):
+        """True if the statement is known to not change anything."""
+        stmt = _single(statement)
+        if stmt is None:
+            return False
+        with self._lock:
+            m = CREATE_INDEX.match(stmt)
+            if m:
+                return self._index_table(m.group(1)) is not None
+            m = DROP_INDEX.match(stmt)
+            if m:
+                return self._index_table(m.group(1)) is None
+            m = CREATE_PARTITION.match(stmt)
+            if m:
+                return m.group(2) in self.relations
+            m = CREATE_TABLE.match(stmt)
+            if m:
+                return m.group(1) in self.relations
+            m = DROP_CONSTRAINT.match(stmt)
+            if m:
+                rel = self.relations.get(m.group(1))
+                return rel is not None and m.group(2) not in rel.constraints
+        return False
+
+    def observe(self, statement):
+        """Update the snapshot from a statement that has been executed.
+
+        The parts of a compound statement are applied in order, so a table
+        can be dropped and another one renamed in its place."""
+        if statement.lstrip().upper().startswith("DO "):
+            return
+        with self._lock:
+            for part in statement.split(";"):
+                self._observe(part.strip())
+
+    def _observe(self, stmt):
+        m = CREATE_PARTITION.match(stmt)
+        if m:
+            foreign, name, parent = m.groups()
+            self.relations.setdefault(name, Relation(name, "f" if foreign else "r", parent))
+        m = CREATE_TABLE.match(stmt)
+        if m:
+            self.relations.setdefault(m.group(1), Relation(m.group(1)))
+        m = CREATE_INDEX.match(stmt)
+        if m:
+            index, table, method = m.groups()
+            rel = self.relations.setdefault(table, Relation(table))
+            rel.indexes[index] = method.lower()
+        m = DROP_INDEX.match(stmt)
+        if m:
+            rel = self._index_table(m.group(1))
+            if rel is not None:
+                del rel.indexes[m.group(1)]
+        m = DETACH.match(stmt)
+        if m:
+            rel = self.relations.get(m.group(2))
+            if rel is not None:
+                rel.parent = None
+        m = ATTACH.match(stmt)
+        if m:
+            rel = self.relations.setdefault(m.group(2), Relation(m.group(2)))
+            rel.parent = m.group(1)
+        m = ADD_CONSTRAINT.match(stmt)
+        if m:
+            rel = self.relations.setdefault(m.group(1), Relation(m.group(1)))
+            rel.constraints.add(m.group(2))
+        m = DROP_CONSTRAINT.match(stmt)
+        if m:
+            rel = self.relations.get(m.group(1))
+            if rel is not None:
+                rel.constraints.discard(m.group(2))
+        m = RENAME_TABLE.match(stmt)
+        if m:
+            rel = self.relations.pop(m.group(1), None)
+            if rel is not None:
+                rel.name = m.group(2)
+                self.relations[rel.name] = rel
+        m = DROP_TABLE.match(stmt)
+        if m:
+            self.relations.pop(m.group(1), None)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""Partition a Zabbix database that already has history, while it runs.
+
+partition.py converts a pristine database by dropping the history tables.
+This converts them with their data instead:
+
+1. A BRIN index on clock is built on the unpartitioned table, so that a
+   batch finds its clock range without reading the whole table.
+2. A partitioned `{table}_part` is created next to it, with its monthly
+   partitions (named as they will be once it takes the table's place) from
+   2014 to a year ahead.
+3. A trigger copies the rows of every INSERT into the table to `{table}_part`.
+   Zabbix updates trends rows, so for the trends tables, a second trigger
+   records the (itemid, clock) of updated rows, which the swap copies again.
+4. Every month is copied in batches of a day, several months at a time with
+   HOUSEKEEPER_WORKERS. A batch deletes its range from the partition and
+   copies it again from the table, in one REPEATABLE READ transaction, so
+   rows the trigger copied are neither lost nor copied twice, and any batch
+   can be run again. With HOUSEKEEPER_JOURNAL set, a rerun skips the batches
+   that are done.
+5. The swap renames `{table}_part` in place of the table, waiting at most
+   `lock_timeout` seconds for its lock. The old table is kept as
+   `{table}_unpartitioned`, to drop once the result is checked.
+
+Every batch logs its rows and rows per second, and the running total for
+its table. Rows with a clock before 2014 or beyond the last partition are
+not copied, and stay in the old table, as do rows deleted from it during
+the copy (only Zabbix's own housekeeper deletes, keep it off).
+
+Until the swap, the database holds two copies of the history, so it needs
+the free space for that.
+"""
+import datetime
+import sys
+import threading
+import time
+from functools import partial
+
+import psycopg2.errors
+import structlog
+
+from .helpers import ConnectionPool, execute, get_table_name, housekeeper_connstring
+from .housekeeper import (
+    HISTORY_TABLES,
+    TRENDS_TABLES,
+    create_table_partition,
+    ensure_brin_index,
+    ensure_btree_index,
+    is_trends,
+    role_msg,
+)
+from .journal import get_journal, journaled, print_progress
+from .logs import log_state, setup_logging
+from .metrics import METRICS
+from .scheduler import Scheduler, get_workers, task_key
+from .times import get_start_and_stop, months_between, months_for_year_ahead, next_month, this_day
+from .tracing import TRACER
+
+_log = structlog.get_logger(__name__)
+
+BATCH_SECONDS = 86400
+FIRST_MONTH = datetime.date(2014, 1, 1)
+
+
+def backfill_months(start=None):
+    """The months with data to copy, from 2014 to the current month."""
+    if start is None:
+        start = this_day()
+    return list(months_between(from_date=FIRST_MONTH, to_date=next_month(start)))
+
+
+def future_months(start=None):
+    """The months after the current one, which only the trigger fills."""
+    return list(months_for_year_ahead(start))[1:]
+
+
+def clock_bounds(months):
+    """The clock range the partitions of `months` cover."""
+    first, _ = get_start_and_stop(year=months[0].year, month=months[0].month)
+    _, last = get_start_and_stop(year=months[-1].year, month=months[-1].month)
+    return first, last
+
+
+def convert_setup(table, months):
+    """The partitioned table and the triggers that feed it new rows."""
+    parent = f"{table}_part"
+    first, last = clock_bounds(months)
+
+    with log_state(step="convert_index"):
+        yield f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_convert_idx ON {table} USING brin (clock);"
+
+    def query_create():
+        yield "BEGIN TRANSACTION;"
+        yield f"CREATE TABLE IF NOT EXISTS {parent} (LIKE {table}) PARTITION BY RANGE (clock);"
+        for date in months:
+            yield from create_table_partition(table=table, year=date.year, month=date.month, parent=parent)
+        yield "COMMIT;"
+
+    with log_state(step="convert_create", partitions=len(months)):
+        yield "\n".join(query_create())
+
+    # Statement triggers handle a multi row INSERT in one statement
+    def query_trigger():
+        yield "BEGIN TRANSACTION;"
+        yield f"""CREATE OR REPLACE FUNCTION {table}_convert() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO {parent} SELECT * FROM new_rows WHERE clock >= {first} AND clock < {last};
+    RETURN NULL;
+END $$;"""
+        yield f"DROP TRIGGER IF EXISTS {table}_convert ON {table};"
+        yield f"""CREATE TRIGGER {table}_convert AFTER INSERT ON {table}
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE {table}_convert();"""
+        if is_trends(table):
+            yield f"CREATE TABLE IF NOT EXISTS {table}_touched (itemid BIGINT NOT NULL, clock INTEGER NOT NULL);"
+            yield f"""CREATE OR REPLACE FUNCTION {table}_touch() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO {table}_touched SELECT itemid, clock FROM new_rows;
+    RETURN NULL;
+END $$;"""
+            yield f"DROP TRIGGER IF EXISTS {table}_touch ON {table};"
+            yield f"""CREATE TRIGGER {table}_touch AFTER UPDATE ON {table}
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE {table}_touch();"""
+        yield "COMMIT;"
+
+    with log_state(step="convert_trigger"):
+        yield "\n".join(query_trigger())
+
+
+class Progress:
+    """Rows copied for a table so far, against the planner's row estimate."""
+
+    def __init__(self, table, estimate=0):
+        self.table = table
+        self.estimate = estimate
+        self.rows = 0
+        self.began = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, rows):
+        with self._lock:
+            self.rows += rows
+            elapsed = max(time.monotonic() - self.began, 0.001)
+            percent = round(100 * self.rows / self.estimate, 1) if self.estimate > 0 else None
+            _log.info("Backfill progress", table=self.table, rows=self.rows, percent=percent,
+                      rows_per_second=round(self.rows / elapsed))
+
+
+class BackfillBatch:
+    """Copy one clock range of `source` into the partition `dest`, replacing
+    what it has in that range."""
+
+    def __init__(self, source, dest, start, stop, progress=None):
+        self.source = source
+        self.dest = dest
+        self.start = start
+        self.stop = stop
+        self.progress = progress
+
+    def __str__(self):
+        # Also what the journal recognises the batch by
+        return f"-- backfill {self.dest} from {self.source} {self.start}-{self.stop}"
+
+    def __call__(self, cursor, catalog=None):
+        where = f"clock >= {self.start} AND clock < {self.stop}"
+        with log_state(step="convert_backfill", backfill_start=self.start, backfill_stop=self.stop):
+            begin = time.monotonic()
+            # One snapshot for both statements: the rows the trigger copies
+            # after it are neither deleted nor copied again.
+            execute(cursor, "BEGIN TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+            execute(cursor, f"DELETE FROM {self.dest} WHERE {where};")
+            execute(cursor, f"INSERT INTO {self.dest} SELECT * FROM {self.source} WHERE {where};")
+            rows = max(cursor.rowcount, 0)
+            execute(cursor, "COMMIT;")
+            elapsed = max(time.monotonic() - begin, 0.001)
+            _log.info("Copied batch", rows=rows, seconds=round(elapsed, 3), rows_per_second=round(rows / elapsed))
+        if self.progress is not None:
+            self.progress.add(rows)
+        return rows
+
+
+def backfill_batches(table, date, progress=None, batch_seconds=BATCH_SECONDS):
+    partition = get_table_name(table=table, year=date.year, month=date.month)
+    start_time, end_time = get_start_and_stop(year=date.year, month=date.month)
+    for start in range(start_time, end_time, batch_seconds):
+        yield BackfillBatch(table, partition, start, min(start + batch_seconds, end_time), progress=progress)
+
+
+class ConvertSwap:
+    """Put the partitioned table in place of the table, in one short
+    transaction. Waits at most `lock_timeout` seconds for the lock,
+    `attempts` times.
+
+    For the trends tables, the rows updated since the copy began are copied
+    again first, from the locked table."""
+
+    def __init__(self, table, first, last, lock_timeout=5, attempts=10, pause=10):
+        self.table = table
+        self.first = first
+        self.last = last
+        self.lock_timeout = lock_timeout
+        self.attempts = attempts
+        self.pause = pause
+
+    def __str__(self):
+        return f"-- swap {self.table}_part into {self.table}"
+
+    def statements(self):
+        table = self.table
+        if is_trends(table):
+            touched = f"(SELECT DISTINCT itemid, clock FROM {table}_touched)"
+            yield f"""DELETE FROM {table}_part p USING {touched} t
+WHERE p.itemid = t.itemid AND p.clock = t.clock;"""
+            yield f"""INSERT INTO {table}_part SELECT s.* FROM {table} s JOIN {touched} t USING (itemid, clock)
+WHERE s.clock >= {self.first} AND s.clock < {self.last};"""
+            yield f"DROP TRIGGER {table}_touch ON {table};"
+            yield f"DROP FUNCTION {table}_touch();"
+            yield f"DROP TABLE {table}_touched;"
+        yield f"DROP TRIGGER {table}_convert ON {table};"
+        yield f"DROP FUNCTION {table}_convert();"
+        yield f"ALTER TABLE {table} RENAME TO {table}_unpartitioned;"
+        yield f"ALTER TABLE {table}_part RENAME TO {table};"
+        # Maintenance creates it again on the partitioned table
+        yield f"DROP STATISTICS IF EXISTS s_{table};"
+
+    def __call__(self, cursor, catalog=None):
+        for attempt in range(1, self.attempts + 1):
+            with log_state(step="convert_swap", attempt=attempt):
+                begin = time.monotonic()
+                try:
+                    execute(cursor, "BEGIN TRANSACTION;")
+                    execute(cursor, f"SET LOCAL lock_timeout = '{self.lock_timeout}s';")
+                    execute(cursor, f"LOCK TABLE {self.table} IN ACCESS EXCLUSIVE MODE;")
+                except psycopg2.errors.LockNotAvailable:
+                    execute(cursor, "ROLLBACK;")
+                    _log.warning("Could not lock, retrying", timeout=self.lock_timeout, pause=self.pause)
+                    time.sleep(self.pause)
+                    continue
+                for statement in self.statements():
+                    execute(cursor, statement, catalog=catalog)
+                execute(cursor, "COMMIT;")
+                _log.info("Swapped in partitioned table", lock_seconds=round(time.monotonic() - begin, 3))
+                return
+        raise RuntimeError(f"Could not lock {self.table} in {self.attempts} attempts")
+
+
+def convert_swap(table, months):
+    yield ConvertSwap(table, *clock_bounds(months))
+
+
+def unpartitioned_tables(catalog):
+    """The history and trends tables that are not partitioned yet."""
+    tables = HISTORY_TABLES + TRENDS_TABLES
+    return [t for t in tables if catalog.table_exists(t) and not catalog.is_partitioned(t)]
+
+
+def convert_units(catalog, start=None):
+    """(table, date, statements) of every month convert copies."""
+    for table in unpartitioned_tables(catalog):
+        for date in backfill_months(start):
+            yield table, date, backfill_batches(table, date)
+
+
+def convert(pool, workers=1, journal=None):
+    """Partition every unpartitioned table, see the module docstring."""
+    catalog = pool.catalog
+    months = backfill_months()
+    future = future_months()
+    fresh = months[-3:]
+    sched = Scheduler(pool, workers=workers)
+    for table in unpartitioned_tables(catalog):
+        progress = Progress(table, estimate=catalog.relations[table].rows)
+        setup = sched.add_statements((table, "convert", "setup"), partial(convert_setup, table, months + future))
+
+        def future_indexes(table=table):
+            # The months to come are empty, their indexes are quick to build
+            for date in future:
+                kws = dict(table=table, year=date.year, month=date.month)
+                yield from ensure_btree_index(**kws, concurrently=False)
+                yield from ensure_brin_index(**kws)
+
+        done = [sched.add_statements((table, "convert", "future"), future_indexes, requires=[setup])]
+
+        for date in months:
+            def statements(table=table, date=date, progress=progress):
+                batches = backfill_batches(table, date, progress=progress)
+                # With a journal, a rerun skips what is already done
+                yield from journaled(journal, "convert", table, date.year, date.month, batches)
+
+                kws = dict(table=table, year=date.year, month=date.month)
+                yield from ensure_brin_index(**kws)
+                if date in fresh:
+                    # The months do_maintenance keeps a btree on
+                    yield from ensure_btree_index(**kws)
+
+            done.append(sched.add_statements(task_key(table, date, "backfill"), statements, requires=[setup]))
+
+        sched.add_statements((table, "convert", "swap"), partial(convert_swap, table, months + future),
+                             requires=done)
+    sched.run()
+
+
+def main():
+    setup_logging()
+    role_msg()
+    command = sys.argv[1] if len(sys.argv) > 1 else "help"
+    if command not in ("run", "progress"):
+        print(f"Usage: {sys.argv[0]} {{ run | progress }}")
+        print("")
+        print("run:      Partitions the history and trends tables that are not partitioned yet,")
+        print("          keeping their data, while Zabbix keeps writing to them")
+        print("progress: Lists what is left of the copy in the journal")
+        print("-")
+        print("set the number of months copied at the same time with 'HOUSEKEEPER_WORKERS' (default 1)")
+        print("set the path of a journal to resume the copy with 'HOUSEKEEPER_JOURNAL'")
+        sys.exit(1)
+
+    journal = get_journal()
+    if command == "progress" and journal is None:
+        print("Set HOUSEKEEPER_JOURNAL to the journal of the convert run")
+        sys.exit(1)
+
+    success = False
+    try:
+        workers = get_workers()
+        with ConnectionPool(housekeeper_connstring(), maxconn=workers) as pool:
+            catalog = pool.load_catalog()
+            if command == "run":
+                convert(pool, workers=workers, journal=journal)
+            elif command == "progress":
+                print_progress(journal, "convert", convert_units(catalog))
+        success = True
+    finally:
+        if journal is not None:
+            journal.close()
+        METRICS.write("convert", success=success)
+        TRACER.write("convert")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Finding and deleting duplicated rows in a history partition.
+
+The old dedupe SQL grouped the whole partition for every batch, and only
+filtered the groups on clock afterwards. Whether that stayed cheap depended on
+the planner pushing the clock filter down into the aggregate, otherwise the
+cost of a month grew with the square of the partition size.
+
+legacy: That old SQL, batch by batch. PostgreSQL 16 pushes the clock filter
+        down into the aggregate, and it measured faster than range at 1M, 5M
+        and 10M rows, so it is the default.
+
+The two other engines only read the rows they delete from, whatever the
+planner does:
+
+range:  Each batch groups the rows of its own clock range on (itemid, clock,
+        value, ns), and deletes all but the lowest ctid of each group. A group
+        always has a single clock value, so no duplicates are missed at the
+        batch edges.
+
+sorted: One sorted pass over the partition collects the ctid of every
+        duplicate into a side table, which is then deleted from the
+        partition in chunks. No other deletes may run on the partition
+        meanwhile, as a ctid freed by VACUUM can be reused.
+"""
+import os
+
+import structlog
+
+from .helpers import execute
+from .logs import log_state
+
+_log = structlog.get_logger(__name__)
+
+ENGINES = ("legacy", "range", "sorted")
+
+
+def get_dedupe_engine():
+    """
+    environment variable HOUSEKEEPER_DEDUPE selects the dedupe engine,
+    "legacy" (the default), "range" or "sorted"."""
+    engine = os.environ.get("HOUSEKEEPER_DEDUPE", "legacy")
+    if engine not in ENGINES:
+        raise ValueError(f"HOUSEKEEPER_DEDUPE must be one of {ENGINES}")
+    return engine
+
+
+def legacy_duplicates_sql(partition, start, stop):
+    return f"""DELETE
+FROM {partition} T1
+USING (
+      SELECT MIN(ctid) as ctid,
+             {partition}.*
+      FROM   {partition}
+      GROUP BY (
+             {partition}.itemid,
+             {partition}.clock,
+             {partition}.value,
+             {partition}.ns
+      )
+      HAVING COUNT(*) > 1 ) T2
+WHERE T1.ctid <> T2.ctid
+AND  T1.clock BETWEEN {start} AND {stop}
+AND  T2.clock BETWEEN {start} AND {stop}
+AND  T1.itemid = T2.itemid
+AND  T1.clock = T2.clock
+AND  T1.value = T2.value
+AND  T1.ns = T2.ns;"""
+
+
+def range_duplicates_sql(partition, start, stop):
+    return f"""DELETE
+FROM {partition} T1
+USING (
+      SELECT MIN(ctid) as ctid,
+             itemid, clock, value, ns
+      FROM   {partition}
+      WHERE  clock BETWEEN {start} AND {stop}
+      GROUP BY itemid, clock, value, ns
+      HAVING COUNT(*) > 1 ) T2
+WHERE T1.ctid <> T2.ctid
+AND  T1.clock BETWEEN {start} AND {stop}
+AND  T1.itemid = T2.itemid
+AND  T1.clock = T2.clock
+AND  T1.value = T2.value
+AND  T1.ns = T2.ns;"""
+
+
+class SortedDedupe:
+    """Delete duplicates found in one sorted pass, `chunk` rows at a time."""
+
+    def __init__(self, partition, chunk=100000):
+        self.partition = partition
+        self.dupes = f"{partition}_dupes"
+        self.chunk = chunk
+
+    def __str__(self):
+        return f"-- sorted dedupe of {self.partition} in chunks of {self.chunk}"
+
+    def __call__(self, cursor, catalog=None):
+        partition, dupes = self.partition, self.dupes
+        with log_state(step="sorted_dedupe", where=partition):
+            execute(cursor, f"DROP TABLE IF EXISTS {dupes};", catalog=catalog)
+            execute(cursor, f"""CREATE UNLOGGED TABLE {dupes} AS
+SELECT ctid AS dupe, itemid, clock,
+       (row_number() OVER (ORDER BY ctid) - 1) / {self.chunk} AS chunk
+FROM (
+      SELECT ctid, itemid, clock,
+             row_number() OVER (PARTITION BY itemid, clock, value, ns ORDER BY ctid) AS n
+      FROM {partition}
+      ) T
+WHERE T.n > 1;""", catalog=catalog)
+            execute(cursor, f"CREATE INDEX ON {dupes} (chunk);", catalog=catalog)
+            execute(cursor, f"SELECT COALESCE(MAX(chunk) + 1, 0) FROM {dupes};", catalog=catalog)
+            chunks = cursor.fetchone()[0]
+            _log.info("Found duplicates", chunks=chunks)
+
+            total = 0
+            for chunk in range(chunks):
+                with log_state(chunk=chunk, chunks=chunks):
+                    # itemid and clock are compared as well, as a guard
+                    # against ctids that have been reused.
+                    execute(cursor, f"""DELETE FROM {partition} T1
+USING {dupes} D
+WHERE D.chunk = {chunk}
+AND   T1.ctid = D.dupe
+AND   T1.itemid = D.itemid
+AND   T1.clock = D.clock;""", catalog=catalog)
+                    total += max(cursor.rowcount, 0)
+            execute(cursor, f"DROP TABLE {dupes};", catalog=catalog)
+        return total
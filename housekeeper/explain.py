@@ -0,0 +1,225 @@
+"""Capture the plans of the clean up DELETE statements, and flag regressions.
+
+A small change to the SQL of clean_old_items, clean_expired_items or
+clean_duplicate_items, or to the statistics, can flip the planner from a
+hashed subplan to a nested loop, and a batch that took a second takes an
+hour. With HOUSEKEEPER_EXPLAIN set to a number of batches, helpers.execute
+runs that many batches of each (step, table) as
+`EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)` instead. That runs the DELETE as
+usual, and returns its plan with timings and buffer counts. The 1st, 2nd,
+4th, 8th... batches are sampled, to spread the samples over the run.
+
+At exit the plans are stored in the journal. The first plans of a (step,
+table) become its baseline, later ones are compared with it:
+
+shape:   The plan tree differs, node types, join types, hashed or plain
+         subplans and the kind of index scanned.
+cost:    The planner's cost per hour of clock window is REGRESSION times
+         that of the baseline or more.
+buffers: Likewise for the buffers read or hit.
+
+Regressions are logged as warnings, `housekeeper plans` lists them, and
+`housekeeper baseline` makes the latest plans the baseline, after a change
+that was meant to change them.
+"""
+import collections
+import json
+import os
+import re
+import threading
+
+import structlog
+from structlog.contextvars import get_contextvars
+
+from .metrics import PARTITION, statement_labels
+
+_log = structlog.get_logger(__name__)
+
+# The steps whose DELETE statements are sampled
+STEPS = ("clean_old_items", "clean_expired_items", "clean_duplicate_items")
+# How much worse than the baseline a plan may be, before it is flagged
+REGRESSION = 2.0
+HOUR = 3600
+HASHED = re.compile(r"hashed (SubPlan \d+)")
+
+
+def get_explain_samples():
+    """
+    environment variable HOUSEKEEPER_EXPLAIN is the number of batches of each
+    clean up step and table that are run with EXPLAIN ANALYZE, and their plans
+    stored in the journal. When it is not set, none are."""
+    samples = int(os.environ.get("HOUSEKEEPER_EXPLAIN", "0"))
+    if samples < 0:
+        raise ValueError("HOUSEKEEPER_EXPLAIN must be 0 or more.")
+    return samples
+
+
+def explain_sql(query):
+    return f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}"
+
+
+def batch_window():
+    """Seconds of clock in the batch the generators put in the log context."""
+    ctx = get_contextvars()
+    for key, start in ctx.items():
+        if key.endswith("_start") and f"{key[:-6]}_stop" in ctx:
+            return max(int(ctx[f"{key[:-6]}_stop"]) - int(start), 1)
+    return HOUR
+
+
+def _unpartition(name):
+    """Partition names made into their table's, so plans of months compare."""
+    return PARTITION.sub(lambda m: m.group(2), name)
+
+
+def plan_shape(node, hashed=None):
+    """The plan tree as text, without costs, counts or partition names."""
+    if hashed is None:
+        hashed = set(HASHED.findall(json.dumps(node)))
+    label = node["Node Type"]
+    for key in ("Operation", "Join Type", "Strategy", "Scan Direction"):
+        if key in node and node[key] != "Forward":
+            label += f" {node[key]}"
+    if "Relation Name" in node:
+        label += f" on {_unpartition(node['Relation Name'])}"
+    if "Index Name" in node:
+        label += f" using {_unpartition(node['Index Name'])}"
+    if node.get("Parent Relationship") == "SubPlan":
+        name = node.get("Subplan Name", "")
+        kind = "hashed SubPlan" if name in hashed or name.startswith("hashed") else "SubPlan"
+        label = f"{kind}: {label}"
+    children = [plan_shape(child, hashed) for child in node.get("Plans", ())]
+    if children:
+        label += f" ({', '.join(children)})"
+    return label
+
+
+class Plan:
+    """The EXPLAIN ANALYZE result of one batch."""
+
+    def __init__(self, step, table, partition, explained, window=HOUR):
+        result, = explained
+        root = result["Plan"]
+        self.step = step
+        self.table = table
+        self.partition = partition
+        self.window = window
+        self.shape = plan_shape(root)
+        self.cost = root["Total Cost"]
+        self.milliseconds = result.get("Execution Time", root.get("Actual Total Time", 0.0))
+        self.buffers = root.get("Shared Hit Blocks", 0) + root.get("Shared Read Blocks", 0)
+        self.reads = root.get("Shared Read Blocks", 0)
+        self.temp = root.get("Temp Read Blocks", 0) + root.get("Temp Written Blocks", 0)
+        # The DELETE returns nothing, the rows it deleted come from below
+        below = root.get("Plans", [root])[0]
+        self.rows = below["Actual Rows"] * below["Actual Loops"]
+        self.explained = explained
+
+    def __repr__(self):
+        return f"Plan({self.step} on {self.partition}, {self.rows} rows)"
+
+
+# A plan as the journal stores it
+StoredPlan = collections.namedtuple(
+    "StoredPlan", "step table partition shape cost milliseconds buffers reads rows window recorded"
+)
+
+
+def per_hour(plan, field):
+    return getattr(plan, field) * HOUR / plan.window
+
+
+def regressions(plan, baseline):
+    """What got worse since the baseline, either may be a Plan or StoredPlan."""
+    found = []
+    if plan.shape != baseline.shape:
+        found.append("shape")
+    for field in ("cost", "buffers"):
+        if per_hour(plan, field) >= REGRESSION * max(per_hour(baseline, field), 1):
+            found.append(field)
+    return found
+
+
+class Explainer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+        self.plans = []
+
+    def samples(self):
+        return get_explain_samples()
+
+    def wanted(self, query):
+        """Whether to EXPLAIN ANALYZE this statement, counting it if so."""
+        samples = self.samples()
+        if not samples or not str(query).lstrip().upper().startswith("DELETE"):
+            return False
+        step, table, _ = statement_labels(query)
+        if step not in STEPS:
+            return False
+        with self._lock:
+            n = self.counts.get((step, table), 0)
+            self.counts[(step, table)] = n + 1
+        # Batch n is the sample number n.bit_length() of its step and table
+        return n & (n + 1) == 0 and n.bit_length() < samples
+
+    def record(self, query, explained):
+        step, table, partition = statement_labels(query)
+        plan = Plan(step, table, partition, explained, window=batch_window())
+        _log.info("Plan captured", shape=plan.shape, cost=plan.cost, milliseconds=plan.milliseconds,
+                  buffers=plan.buffers, reads=plan.reads, temp=plan.temp, deleted=plan.rows)
+        with self._lock:
+            self.plans.append(plan)
+        return plan
+
+    def save(self, journal):
+        """Store the plans in the journal, and warn about regressions."""
+        if not self.plans:
+            return
+        if journal is None:
+            _log.warning("Set HOUSEKEEPER_JOURNAL to store plans and compare them", plans=len(self.plans))
+            return
+        baselines = baseline_plans(journal)
+        regressed = 0
+        for plan in self.plans:
+            key = (plan.step, plan.table)
+            baseline = baselines.get(key)
+            found = []
+            if baseline is None:
+                baselines[key] = plan
+            else:
+                found = regressions(plan, baseline)
+            if found:
+                regressed += 1
+                _log.warning("Plan regression", step=plan.step, table=plan.table, partition=plan.partition,
+                             regressions=found, shape=plan.shape, baseline_shape=baseline.shape,
+                             cost=plan.cost, baseline_cost=baseline.cost)
+            journal.record_plan(plan.step, plan.table, plan.partition, plan.shape, plan.cost, plan.milliseconds,
+                                plan.buffers, plan.reads, plan.rows, plan.window, json.dumps(plan.explained),
+                                baseline=baseline is None, regressions=",".join(found))
+        _log.info("Stored plans", plans=len(self.plans), regressions=regressed)
+
+
+def baseline_plans(journal):
+    """The baseline StoredPlan of each (step, table)."""
+    return {(row[0], row[1]): StoredPlan(*row) for row in journal.plans(baseline=True)}
+
+
+def print_plans(journal):
+    """Print the latest plan of each step and table, against its baseline."""
+    baselines = baseline_plans(journal)
+    print(f"{'step':<22} {'table':<16} {'recorded':<20} {'ms/h':>10} {'cost/h':>12} {'buffers/h':>10}  regressions")
+    for row in journal.plans():
+        plan = StoredPlan(*row)
+        baseline = baselines.get((plan.step, plan.table))
+        found = ",".join(regressions(plan, baseline)) if baseline is not None else "no baseline"
+        print(f"{plan.step:<22} {plan.table:<16} {plan.recorded[:19]:<20} "
+              f"{per_hour(plan, 'milliseconds'):>10.1f} {per_hour(plan, 'cost'):>12.0f} "
+              f"{per_hour(plan, 'buffers'):>10.0f}  {found or '-'}")
+        if found and baseline is not None and plan.shape != baseline.shape:
+            print(f"    baseline: {baseline.shape}")
+            print(f"    now:      {plan.shape}")
+
+
+# Global state for the whole run, saved at exit by the tools.
+EXPLAIN = Explainer()
@@ -1,5 +1,6 @@
 import os
 import time
+import threading
 
 from contextlib import contextmanager
 from datetime import timedelta, date
@@ -8,7 +9,12 @@ import structlog
 import psycopg2
 
 
+from .catalog import Catalog
+from .explain import EXPLAIN, explain_sql
 from .logs import log_state
+from .metrics import METRICS, is_write
+from .progress import watch
+from .tracing import TRACER
 
 _log = structlog.get_logger(__name__)
 
@@ -47,6 +53,30 @@ def log_and_reset_notices(conn):
     conn.notices.clear()
 
 
+class RunStats:
+    """Counts the connections made and statements sent during a run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.round_trips = 0
+
+    def connected(self):
+        with self._lock:
+            self.connects += 1
+
+    def round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+
+    def log(self):
+        _log.info("Run statistics", connects=self.connects, round_trips=self.round_trips)
+
+
+# Global state for the whole run, reported at exit by the tools.
+STATS = RunStats()
+
+
 @contextmanager
 def connect_autocommit(connstr: str):
     """Yield a psycopg2 connection in autocommit mode.
@@ -56,6 +86,7 @@ def connect_autocommit(connstr: str):
     conn = None
     try:
         conn = psycopg2.connect(connstr)
+        STATS.connected()
         conn.set_session(autocommit=True)  # Don't implicitly open a transaction
         yield conn
     finally:
@@ -72,19 +103,77 @@ def prelude_cursor(conn):
     log_and_reset_notices(conn)
 
 
-def execute(cursor, query):
+def execute(cursor, query, catalog=None):
+    """Execute the query, logging the time it took.
+
+    If a catalog.Catalog is passed, statements that it knows would not change
+    anything are skipped, and executed statements are recorded in it.
+
+    The query may also be a callable that runs itself on the cursor, and is
+    passed the catalog to execute its own statements with.
+
+    A DELETE that explain.EXPLAIN samples runs under EXPLAIN ANALYZE, and its
+    explain.Plan is returned.
+    """
+    if callable(query):
+        # Statements that need the result of each batch, like
+        # batching.AdaptiveDelete, run themselves on the cursor.
+        return query(cursor, catalog=catalog)
+
     info = cursor.connection.info
     log = _log.bind(dbhost=info.host, dbname=info.dbname, dbuser=info.user, query=query)
 
+    if catalog is not None and catalog.is_noop(query):
+        log.info("Skipped, nothing to do")
+        return None
+
+    explained = EXPLAIN.wanted(query)
+    wal = METRICS.enabled() and is_write(query)
+    wal_start = wal_lsn(cursor) if wal else None
     start = time.monotonic()
     log.info("executing")
-    result = cursor.execute(query)
+    STATS.round_trip()
+    with TRACER.span("sql", str(query).lstrip().split(None, 1)[0].upper(), query=str(query)[:200]) as span:
+        with watch(cursor.connection, query):
+            result = cursor.execute(explain_sql(query) if explained else query)
+        if explained:
+            # The rowcount is of the plan's one row, the plan has the rows
+            result = EXPLAIN.record(query, cursor.fetchone()[0])
+        rows = result.rows if explained else cursor.rowcount
+        span["rows"] = rows
     end = time.monotonic()
     elapsed = end - start
     log.info("Done", result=result, elapsed=f"{elapsed:06.2f}")
+    wal_bytes = wal_since(cursor, wal_start) if wal_start is not None else 0
+    METRICS.statement(query, rows=rows, seconds=elapsed, wal_bytes=wal_bytes)
+    if catalog is not None:
+        catalog.observe(query)
     return result
 
 
+def wal_lsn(cursor):
+    """The current WAL position, from a cursor of its own, so the rowcount
+    and results of `cursor` are left alone. None if it can't be read, like
+    in an aborted transaction."""
+    try:
+        with cursor.connection.cursor() as curs:
+            STATS.round_trip()
+            curs.execute("SELECT pg_current_wal_lsn();")
+            return curs.fetchone()[0]
+    except psycopg2.Error:
+        return None
+
+
+def wal_since(cursor, lsn):
+    try:
+        with cursor.connection.cursor() as curs:
+            STATS.round_trip()
+            curs.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s);", (lsn,))
+            return int(curs.fetchone()[0])
+    except psycopg2.Error:
+        return 0
+
+
 def prelude_execute_transaction(conn, query):
     """Run the query in a transaction, after running the prelude"""
     with conn:
@@ -100,6 +189,127 @@ def prelude_execute(conn, query):
     return res
 
 
+class ConnectionPool:
+    """A pool of autocommit connections that have already run the prelude.
+
+    The prelude (SET ROLE, SET WORK_MEM) is session state, so it is run once
+    when a connection is opened, rather than before every statement. Up to
+    `maxconn` connections are opened, and callers wait for a free one after
+    that.
+
+    Connections are handed back in autocommit mode and outside of a
+    transaction, a connection left in a failed transaction is rolled back, and
+    a broken one is thrown away.
+    """
+
+    def __init__(self, connstr: str, maxconn: int = 1):
+        self.connstr = connstr
+        self.maxconn = maxconn
+        self.catalog = None
+        self._idle: list = []
+        self._count = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def load_catalog(self):
+        """Snapshot the catalog, used by `execute` and `table_exists` after this."""
+        with self.connection() as conn:
+            self.catalog = Catalog.load(conn)
+        return self.catalog
+
+    def _open(self):
+        conn = psycopg2.connect(self.connstr)
+        STATS.connected()
+        try:
+            conn.set_session(autocommit=True)
+            with conn.cursor() as curs:
+                for prelude in sql_prelude():
+                    execute(curs, prelude)
+            log_and_reset_notices(conn)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self._count >= self.maxconn:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._count += 1
+        try:
+            return self._open()
+        except Exception:
+            self._discard()
+            raise
+
+    def _discard(self):
+        with self._cond:
+            self._count -= 1
+            self._cond.notify()
+
+    def _release(self, conn):
+        if not conn.closed and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # A failed "BEGIN; ... COMMIT;" statement leaves the session in
+            # an aborted transaction, which would break the next user.
+            try:
+                with conn.cursor() as curs:
+                    curs.execute("ROLLBACK;")
+            except psycopg2.Error:
+                conn.close()
+        if conn.closed:
+            self._discard()
+            return
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Yield a connection, handing it back to the pool afterwards."""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def cursor(self):
+        """Yield a cursor on a pooled connection."""
+        with self.connection() as conn:
+            with conn.cursor() as curs:
+                yield curs
+            log_and_reset_notices(conn)
+
+    def execute(self, query):
+        """Run the query on a pooled connection."""
+        with self.cursor() as curs:
+            return execute(curs, query, catalog=self.catalog)
+
+    def execute_transaction(self, query):
+        """Run the query in a transaction on a pooled connection. On an
+        autocommit connection, `with conn` only opens one from psycopg2 2.9."""
+        with self.connection() as conn:
+            with conn:
+                with conn.cursor() as curs:
+                    res = execute(curs, query, catalog=self.catalog)
+            log_and_reset_notices(conn)
+        return res
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+        for conn in idle:
+            conn.close()
+
+
 def housekeeper_connstring():
     return env_connstring(prefix="HOUSEKEEPER")
 
@@ -128,20 +338,23 @@ def env_connstring(filename=DBCONFIG, prefix="MOOMIN"):
     return output
 
 
-def get_table_name(table="history", year=2011, month=12):
-    return f"{table}_y{year}m{month:02d}"
+def get_table_name(table="history", year=2011, month=12, part=""):
+    """`part` is the suffix of a week or day partition, see times.month_parts."""
+    return f"{table}_y{year}m{month:02d}{part}"
 
 
-def get_index_name(table="history", year=2011, month=12, kind="btree"):
-    tablename = get_table_name(table=table, year=year, month=month)
+def get_index_name(table="history", year=2011, month=12, part="", kind="btree"):
+    tablename = get_table_name(table=table, year=year, month=month, part=part)
     return f"{tablename}_{kind}_idx"
 
 
-def get_constraint_name(table="history", year=2011, month=12):
-    return f"{table}_y{year}m{month:02d}_check"
+def get_constraint_name(table="history", year=2011, month=12, part=""):
+    return f"{table}_y{year}m{month:02d}{part}_check"
 
 
-def table_exists(conn, table="history"):
+def table_exists(conn, table="history", catalog=None):
+    if catalog is not None:
+        return catalog.table_exists(table)
     select = f"select count(*)=1 from pg_tables where tablename='{table}';"
     with conn.cursor() as c:
         c.execute(select)
@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
+import os
 import sys
 import datetime
 
+from functools import partial, wraps
+
 from .helpers import (
-    connect_autocommit,
+    ConnectionPool,
+    STATS,
     housekeeper_connstring,
     execute,
-    prelude_cursor,
+    log_and_reset_notices,
     get_constraint_name,
     get_index_name,
     get_table_name,
@@ -15,15 +19,72 @@ from .helpers import (
 )
 
 from .times import (
+    GRANULARITIES,
+    month_parts,
     months_for_year_ahead,
     months_for_year_past,
     gen_last_month,
     get_start_and_stop,
     months_2014_to_current,
+    months_between,
 )
+from .batching import AdaptiveBatcher, AdaptiveDelete, get_batch_target
+from .brin import BrinTune, brin_index_sql, get_brin_tune
+from .dedupe import SortedDedupe, get_dedupe_engine, legacy_duplicates_sql, range_duplicates_sql
+from .explain import EXPLAIN, print_plans
+from .journal import get_journal, journaled, print_progress, print_transitions
 from .logs import log_state
+from .metrics import METRICS
+from .online import OnlineCatchUp, OnlineCluster, OnlineSwap, capture_sql
+from .policy import IndexTransition, KINDS, get_index_idle, get_index_policy, index_scans, stage_for, wanted_kinds
+from .scheduler import Scheduler, get_workers, task_key
+from .tracing import TRACER
 
 FAST_WINDOW = 14
+CLUSTER_MODES = ("classic", "fused", "online")
+HISTORY_TABLES = ("history", "history_uint", "history_text", "history_str")
+# Zabbix keeps one row per item and hour in these, with (itemid, clock) as
+# the primary key, so they have no duplicates to clean out.
+TRENDS_TABLES = ("trends", "trends_uint")
+
+
+def get_cluster_mode():
+    """
+    environment variable HOUSEKEEPER_CLUSTER_MODE selects how last month is
+    rewritten on cluster day, "classic" (the default), "fused" or "online"."""
+    mode = os.environ.get("HOUSEKEEPER_CLUSTER_MODE", "classic")
+    if mode not in CLUSTER_MODES:
+        raise ValueError(f"HOUSEKEEPER_CLUSTER_MODE must be one of {CLUSTER_MODES}")
+    return mode
+
+
+def get_granularity():
+    """
+    environment variable HOUSEKEEPER_GRANULARITY is how new partitions are
+    cut, "month" (the default), "week" or "day". Months that already have
+    partitions keep them, see do_maintenance."""
+    granularity = os.environ.get("HOUSEKEEPER_GRANULARITY", "month")
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"HOUSEKEEPER_GRANULARITY must be one of {GRANULARITIES}")
+    return granularity
+
+
+def is_trends(table):
+    """True for the trends tables, and their archive tables."""
+    return table.startswith(("trends", "archive_trends"))
+
+
+def item_period(table):
+    """The column of items that says how long the item's rows in `table` are kept."""
+    return "trends" if is_trends(table) else "history"
+
+
+def maintained_tables(catalog=None):
+    """The tables maintenance works on. The trends tables are only included
+    once they are partitioned (see partition.py), as Zabbix creates them as
+    plain tables."""
+    trends = tuple(t for t in TRENDS_TABLES if catalog is not None and catalog.is_partitioned(t))
+    return HISTORY_TABLES + trends
 
 
 def log_step(func):
@@ -34,6 +95,7 @@ def log_step(func):
 
     This one does the final step."""
 
+    @wraps(func)
     def wrapper(*args, **kws):
         with log_state(step=func.__name__):
             yield from func(*args, **kws)
@@ -41,8 +103,8 @@ def log_step(func):
     return wrapper
 
 
-def clean_old_indexes(table="history", year=2011, month=12):
-    tablename = get_table_name(table=table, year=year, month=month)
+def clean_old_indexes(table="history", year=2011, month=12, part=""):
+    tablename = get_table_name(table=table, year=year, month=month, part=part)
     oldindexes = [
         f"{tablename}_itemid_clock_idx",
         f"{tablename}_itemid_clock_idx1",
@@ -54,147 +116,225 @@ def clean_old_indexes(table="history", year=2011, month=12):
             yield cleanup.format(oldindex)
 
 
-def ensure_btree_index(table="history", year=2011, month=12, concurrently=True):
-    index = get_index_name(table=table, year=year, month=month, kind="btree")
-    table = get_table_name(table=table, year=year, month=month)
+def ensure_btree_index(table="history", year=2011, month=12, part="", concurrently=True):
+    index = get_index_name(table=table, year=year, month=month, part=part, kind="btree")
+    table = get_table_name(table=table, year=year, month=month, part=part)
     conc = "CONCURRENTLY" if concurrently else ""
     with log_state(step="ensure_btree_index", table=table, index=index):
         yield f"CREATE INDEX {conc} IF NOT EXISTS {index} on {table} using btree (itemid, clock);"
 
 
-def ensure_brin_index(table="history", year=2011, month=12):
-    index = get_index_name(table=table, year=year, month=month, kind="brin")
-    table = get_table_name(table=table, year=year, month=month)
+def ensure_brin_index(table="history", year=2011, month=12, part=""):
+    index = get_index_name(table=table, year=year, month=month, part=part, kind="brin")
+    table = get_table_name(table=table, year=year, month=month, part=part)
     with log_state(step="ensure_brin_index", index=index, table=table):
-        yield (
-            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} on {table} "
-            f"USING brin (itemid, clock) WITH (pages_per_range='16');"
-        )
+        yield brin_index_sql(index, table)
+
+
+def summarize_brin_index(table="history", year=2011, month=12, part=""):
+    """Summarize the page ranges filled since the index was built or last
+    summarized, which autovacuum would otherwise only get to later, leaving
+    the newest rows of the current partition to be read on every query."""
+    index = get_index_name(table=table, year=year, month=month, part=part, kind="brin")
+    with log_state(step="summarize_brin_index", index=index):
+        yield f"SELECT brin_summarize_new_values('{index}'::regclass);"
 
 
-def clean_btree_index(table="history", year=2011, month=12):
-    index = get_index_name(table=table, year=year, month=month, kind="btree")
+def tune_brin_index(table="history", year=2011, month=12, part=""):
+    """Choose the BRIN index of a past partition from its statistics, see brin.py."""
+    index = get_index_name(table=table, year=year, month=month, part=part, kind="brin")
+    table = get_table_name(table=table, year=year, month=month, part=part)
+    yield BrinTune(table, index)
+
+
+def clean_btree_index(table="history", year=2011, month=12, part=""):
+    index = get_index_name(table=table, year=year, month=month, part=part, kind="btree")
     with log_state(step="clean_btree_index", index=index):
         yield f"DROP INDEX IF EXISTS {index};"
 
 
-def clean_old_items(table="history", year=2011, month=12, batch_seconds=86399):
+def ensure_partial_index(table="history", year=2011, month=12, part=""):
+    """A btree on the last FAST_WINDOW days of the partition, see policy.py."""
+    index = get_index_name(table=table, year=year, month=month, part=part, kind="partial")
+    _, stop = get_start_and_stop(year=year, month=month, part=part)
+    table = get_table_name(table=table, year=year, month=month, part=part)
+    with log_state(step="ensure_partial_index", table=table, index=index):
+        yield (
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} on {table} using btree (itemid, clock) "
+            f"WHERE clock >= {stop - FAST_WINDOW * 86400};"
+        )
+
+
+def ensure_bloom_index(table="history_text", year=2011, month=12, part=""):
+    """A bloom filter on the value of a string table, see policy.py."""
+    index = get_index_name(table=table, year=year, month=month, part=part, kind="bloom")
+    table = get_table_name(table=table, year=year, month=month, part=part)
+    with log_state(step="ensure_bloom_index", table=table, index=index):
+        yield f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} on {table} using bloom (value);"
+
+
+INDEX_BUILDERS = {
+    "btree": ensure_btree_index,
+    "brin": ensure_brin_index,
+    "partial": ensure_partial_index,
+    "bloom": ensure_bloom_index,
+}
+
+
+def clean_index(table="history", year=2011, month=12, part="", kind="btree"):
+    index = get_index_name(table=table, year=year, month=month, part=part, kind=kind)
+    with log_state(step=f"clean_{kind}_index", index=index):
+        yield f"DROP INDEX CONCURRENTLY IF EXISTS {index};"
+
+
+def index_transition(kind, drop=False, journal=None, **kws):
+    """Build (or drop) the index of `kind`, recording the transition."""
+    func = partial(clean_index, kind=kind) if drop else INDEX_BUILDERS[kind]
+    index = get_index_name(kind=kind, **kws)
+    table = get_table_name(**kws)
+    for statement in func(**kws):
+        yield IndexTransition(statement, table, index, kind, journal=journal)
+
+
+def old_items_sql(partition, start, stop):
+    return f"""DELETE FROM {partition} T1
+WHERE T1.clock BETWEEN {start} AND {stop}
+AND T1.itemid NOT IN (SELECT itemid FROM items);"""
+
+
+def clean_old_items(table="history", year=2011, month=12, part="", batch_seconds=86399, target_seconds=None):
     """In small batches, delete removed items from history tables.
     The time logic is a bit hairy.
 
     We don't parse the entire month at once, but in minor batches to make life
     better for the database and cut down on amount of temp/sort space needed.
+
+    With `target_seconds`, the batches are sized to take about that long, see
+    batching.AdaptiveDelete.
     """
-    partition = get_table_name(table=table, year=year, month=month)
-    start_time, end_time = get_start_and_stop(year=year, month=month)
-    for start in range(start_time, end_time, batch_seconds):
-        stop = start + batch_seconds
-        with log_state(step="clean_old_items", where=table, delete_start=start, delete_stop=stop):
-            yield f"""DELETE FROM {partition} T1
-WHERE T1.clock BETWEEN {start} AND {stop}
-AND T1.itemid NOT IN (SELECT itemid FROM items);"""
+    partition = get_table_name(table=table, year=year, month=month, part=part)
+    start_time, end_time = get_start_and_stop(year=year, month=month, part=part)
+    if target_seconds:
+        batcher = AdaptiveBatcher(target=target_seconds, window=batch_seconds)
+        yield AdaptiveDelete(partial(old_items_sql, partition), start_time, end_time, batcher,
+                             step="clean_old_items", where=table)
+    else:
+        for start in range(start_time, end_time, batch_seconds):
+            stop = start + batch_seconds
+            with log_state(step="clean_old_items", where=table, delete_start=start, delete_stop=stop):
+                yield old_items_sql(partition, start, stop)
     # Always vacuum before we leave, as we may have caused churn on the table
-    yield from vacuum_table(table=table, year=year, month=month)
+    yield from vacuum_table(table=table, year=year, month=month, part=part)
 
 
-def vacuum_table(table="history", year=2011, month=12):
+def vacuum_table(table="history", year=2011, month=12, part=""):
     """Vacuums the table. Because you asked for it"""
-    table = get_table_name(table=table, year=year, month=month)
+    table = get_table_name(table=table, year=year, month=month, part=part)
     with log_state(step="vacuum_table", table=table):
         yield f"VACUUM ANALYZE {table};"
 
 
-def clean_duplicate_items(table="history", year=2011, month=12, batch_seconds=33613):
+def clean_duplicate_items(table="history", year=2011, month=12, part="", batch_seconds=33613,
+                          target_seconds=None, engine="legacy"):
     """In small batches, delete duplicated rows from history tables.
     The time logic is a bit hairy, and the DELETE SQL is worse than that.
 
     Group by all itemid, clock, value, ns (in a sub-select) to get all
-    duplicate rows, then use ctid to ensure uniqueness.
+    duplicate rows, then use ctid to ensure uniqueness, see
+    dedupe.legacy_duplicates_sql. The "range" engine restricts the sub-select
+    to the batch's clock range, see dedupe.range_duplicates_sql.
 
     We don't parse the entire month at once, but in minor batches to make life
     better for the database and cut down on amount of temp/sort space needed.
+
+    With `target_seconds`, the batches are sized to take about that long, see
+    batching.AdaptiveDelete. With the "sorted" engine, the duplicates are
+    found in one pass instead, see dedupe.SortedDedupe.
     """
-    if table in ("history_text", "archive_text"):
+    if table in ("history_text", "archive_text") or is_trends(table):
         return
-    partition = get_table_name(table=table, year=year, month=month)
-    start_time, end_time = get_start_and_stop(year=year, month=month)
-    count = 0
-    for start in range(start_time, end_time, batch_seconds):
-        stop = start + batch_seconds
-        with log_state(step="clean_duplicate_items",
-                       where=table, dedupe_start=start, dedupe_stop=stop, iteration=count):
-            # This operation may cause a LOT of churn and is helped by a
-            # functional vacuum.
-
-            # Because we batch on smaller groups, to consume less memory, it's
-            # important that we sometimes have working statistics, otherwise a
-            # delete query towards the end of a month will have enough churn in the
-            # blocks to cause DELETE queries to block for several days.
-            # 11 is a fun palindrome and prime.
-            if count % 11 == 0:
-                yield from vacuum_table(table=table, year=year, month=month)
-
-            yield f"""DELETE
-FROM {partition} T1
-USING (
-      SELECT MIN(ctid) as ctid,
-             {partition}.*
-      FROM   {partition}
-      GROUP BY (
-             {partition}.itemid,
-             {partition}.clock,
-             {partition}.value,
-             {partition}.ns
-      )
-      HAVING COUNT(*) > 1 ) T2
-WHERE T1.ctid <> T2.ctid
-AND  T1.clock BETWEEN {start} AND {stop}
-AND  T2.clock BETWEEN {start} AND {stop}
-AND  T1.itemid = T2.itemid
-AND  T1.clock = T2.clock
-AND  T1.value = T2.value
-AND  T1.ns = T2.ns;"""
-
-            count += 1
+    partition = get_table_name(table=table, year=year, month=month, part=part)
+    start_time, end_time = get_start_and_stop(year=year, month=month, part=part)
+    duplicates_sql = range_duplicates_sql if engine == "range" else legacy_duplicates_sql
+    if engine == "sorted":
+        yield SortedDedupe(partition)
+    elif target_seconds:
+        batcher = AdaptiveBatcher(target=target_seconds, window=batch_seconds)
+        vacuum, = vacuum_table(table=table, year=year, month=month, part=part)
+        yield AdaptiveDelete(partial(duplicates_sql, partition), start_time, end_time, batcher,
+                             step="clean_duplicate_items", where=table, vacuum=vacuum)
+    else:
+        count = 0
+        for start in range(start_time, end_time, batch_seconds):
+            stop = start + batch_seconds
+            with log_state(step="clean_duplicate_items",
+                           where=table, dedupe_start=start, dedupe_stop=stop, iteration=count):
+                # This operation may cause a LOT of churn and is helped by a
+                # functional vacuum.
+
+                # Because we batch on smaller groups, to consume less memory, it's
+                # important that we sometimes have working statistics, otherwise a
+                # delete query towards the end of a month will have enough churn in the
+                # blocks to cause DELETE queries to block for several days.
+                # 11 is a fun palindrome and prime.
+                if count % 11 == 0:
+                    yield from vacuum_table(table=table, year=year, month=month, part=part)
+
+                yield duplicates_sql(partition, start, stop)
+
+                count += 1
 
     # Always vacuum before we leave, as we may have caused churn on the table
-    yield from vacuum_table(table=table, year=year, month=month)
+    yield from vacuum_table(table=table, year=year, month=month, part=part)
 
 
-def clean_expired_items(table="history", year=2012, month=12,
-                        retention=FAST_WINDOW, batch_seconds=86399):
-    """Generates a DELETE statement on the table to clean out "old" data.
+def expired_items_sql(partition, start, stop, retention=FAST_WINDOW, period="history"):
+    # extract('epoch' from timestamp)  Gets the unix timestamp
+    # interval '14 days'  # is a range of 14-days
+    # item.history is in days, and item.trends for the trends tables
 
-    Old is defined as the zabbix way, "items.history" is a string of a
-    time interval (1, 1d, 1w) and compared to our `retention` input data which
-    is in n days.
-    """
-    retention = int(retention)
-    if retention < 14:
-        raise ValueError("We do not touch the 14 days of fast data.")
-    tablename = get_table_name(table=table, year=year, month=month)
-    start_time, end_time = get_start_and_stop(year=year, month=month)
-    for start in range(start_time, end_time, batch_seconds):
-        stop = start + batch_seconds
-        with log_state(step="clean_expired_items", where=table, clean_start=start, clean_stop=stop):
-            # extract('epoch' from timestamp)  Gets the unix timestamp
-            # interval '14 days'  # is a range of 14-days
-            # item.history is in days
-
-            # In the statement below, "(items.history::INTERVAL > INTERVAL 'd')
-            # is a guard statement against naked intervals ("2" ) which
-            # postgres thinks of as seconds, while zabbix has undefined.
-            # We hope they don't exist, but we should guard against it anyhow.
-            yield f"""DELETE FROM {tablename} T1
+    # In the statement below, "(items.history::INTERVAL > INTERVAL 'd')
+    # is a guard statement against naked intervals ("2" ) which
+    # postgres thinks of as seconds, while zabbix has undefined.
+    # We hope they don't exist, but we should guard against it anyhow.
+    return f"""DELETE FROM {partition} T1
 WHERE T1.clock BETWEEN {start} AND {stop}
 AND T1.itemid IN (
     SELECT itemid FROM items
-    WHERE items.history::INTERVAL > INTERVAL '1d'
-    AND   items.history::INTERVAL < INTERVAL '{retention} days'
+    WHERE items.{period}::INTERVAL > INTERVAL '1d'
+    AND   items.{period}::INTERVAL < INTERVAL '{retention} days'
 )
 AND T1.clock < EXTRACT('epoch' FROM current_timestamp - INTERVAL '{retention} days');"""
 
 
+def clean_expired_items(table="history", year=2012, month=12, part="",
+                        retention=FAST_WINDOW, batch_seconds=86399, target_seconds=None):
+    """Generates a DELETE statement on the table to clean out "old" data.
+
+    Old is defined as the zabbix way, "items.history" (or "items.trends" for
+    the trends tables) is a string of a time interval (1, 1d, 1w) and
+    compared to our `retention` input data which is in n days.
+
+    With `target_seconds`, the batches are sized to take about that long, see
+    batching.AdaptiveDelete.
+    """
+    retention = int(retention)
+    if retention < 14:
+        raise ValueError("We do not touch the 14 days of fast data.")
+    tablename = get_table_name(table=table, year=year, month=month, part=part)
+    start_time, end_time = get_start_and_stop(year=year, month=month, part=part)
+    if target_seconds:
+        batcher = AdaptiveBatcher(target=target_seconds, window=batch_seconds)
+        template = partial(expired_items_sql, tablename, retention=retention, period=item_period(table))
+        yield AdaptiveDelete(template, start_time, end_time, batcher,
+                             step="clean_expired_items", where=table)
+    else:
+        for start in range(start_time, end_time, batch_seconds):
+            stop = start + batch_seconds
+            with log_state(step="clean_expired_items", where=table, clean_start=start, clean_stop=stop):
+                yield expired_items_sql(tablename, start, stop, retention=retention, period=item_period(table))
+
+
 @log_step
 def create_item_statistics():
     yield "CREATE STATISTICS IF NOT EXISTS s_items ON itemid, name, key_, hostid FROM items;"
@@ -206,81 +346,83 @@ def create_statistics(table="history"):
 
 
 @log_step
-def create_table_partition(table="history", year=2011, month=12):
-    start, stop = get_start_and_stop(year=year, month=month)
-    tablename = get_table_name(table=table, year=year, month=month)
-    yield f"CREATE TABLE IF NOT EXISTS {tablename} PARTITION OF {table} FOR values FROM ({start}) TO ({stop});"
+def create_table_partition(table="history", year=2011, month=12, part="", parent=None):
+    """Create a partition of `table`, or of `parent` while it is named for `table`."""
+    start, stop = get_start_and_stop(year=year, month=month, part=part)
+    tablename = get_table_name(table=table, year=year, month=month, part=part)
+    parent = parent or table
+    yield f"CREATE TABLE IF NOT EXISTS {tablename} PARTITION OF {parent} FOR values FROM ({start}) TO ({stop});"
 
 
 @log_step
-def detach_partition(table="history", year=2011, month=12):
-    tablename = get_table_name(table=table, year=year, month=month)
+def detach_partition(table="history", year=2011, month=12, part=""):
+    tablename = get_table_name(table=table, year=year, month=month, part=part)
     detach = f"ALTER TABLE {table} DETACH PARTITION {tablename};"
     yield detach
 
 
 @log_step
-def drop_check_constraint(table="history", year=2011, month=12):
-    tablename = get_table_name(table=table, year=year, month=month)
-    constraint_name = get_constraint_name(table=table, year=year, month=month)
+def drop_check_constraint(table="history", year=2011, month=12, part=""):
+    tablename = get_table_name(table=table, year=year, month=month, part=part)
+    constraint_name = get_constraint_name(table=table, year=year, month=month, part=part)
     constraint = f"ALTER TABLE {tablename} DROP CONSTRAINT IF EXISTS {constraint_name};"
     yield constraint
 
 
-def add_check_constraint(table="history", year=2011, month=12):
-    tablename = get_table_name(table=table, year=year, month=month)
-    constraint_name = get_constraint_name(table=table, year=year, month=month)
-    start, stop = get_start_and_stop(year=year, month=month)
+def add_check_constraint(table="history", year=2011, month=12, part=""):
+    tablename = get_table_name(table=table, year=year, month=month, part=part)
+    constraint_name = get_constraint_name(table=table, year=year, month=month, part=part)
+    start, stop = get_start_and_stop(year=year, month=month, part=part)
     constraint = (
         f"ALTER TABLE {tablename} ADD CONSTRAINT {constraint_name} "
         f"CHECK (clock >= {start} AND clock < {stop});"
     )
-    yield from drop_check_constraint(table=table, year=year, month=month)
+    yield from drop_check_constraint(table=table, year=year, month=month, part=part)
     yield constraint
 
 
 @log_step
-def attach_partition(table="history", year=2011, month=12):
-    start, stop = get_start_and_stop(year=year, month=month)
-    partition_name = get_table_name(table=table, year=year, month=month)
+def attach_partition(table="history", year=2011, month=12, part=""):
+    start, stop = get_start_and_stop(year=year, month=month, part=part)
+    partition_name = get_table_name(table=table, year=year, month=month, part=part)
     attach = f"ALTER TABLE {table} ATTACH PARTITION {partition_name} FOR VALUES FROM ({start}) TO ({stop});"
     yield attach
 
 
-def do_cluster_operation(table="history", year=2011, month=12):
+def do_cluster_operation(table="history", year=2011, month=12, part=""):
     """Clusters a table by creating a btree_index on (itemid, clock) and then
     clustering it (locking it exclusively), finally removing the unnecessary
     index."""
-    tablename = get_table_name(table=table, year=year, month=month)
-    indexname = get_index_name(table=table, year=year, month=month, kind="btree")
-    start, stop = get_start_and_stop(year=year, month=month)
+    tablename = get_table_name(table=table, year=year, month=month, part=part)
+    indexname = get_index_name(table=table, year=year, month=month, part=part, kind="btree")
+    start, stop = get_start_and_stop(year=year, month=month, part=part)
 
-    yield from ensure_btree_index(table=table, year=year, month=month)
+    yield from ensure_btree_index(table=table, year=year, month=month, part=part)
     yield f"CLUSTER {tablename} USING {indexname};"
-    yield from add_check_constraint(table=table, year=year, month=month)
-    yield from clean_btree_index(table=table, year=year, month=month)
+    yield from add_check_constraint(table=table, year=year, month=month, part=part)
+    yield from clean_btree_index(table=table, year=year, month=month, part=part)
 
 
-def cluster_table(table="history", year=2011, month=12):
-    tablename = get_table_name(table=table, year=year, month=month)
-    start, stop = get_start_and_stop(year=year, month=month)
+def cluster_table(table="history", year=2011, month=12, part=""):
+    tablename = get_table_name(table=table, year=year, month=month, part=part)
+    start, stop = get_start_and_stop(year=year, month=month, part=part)
     temp_table = f"{tablename}_temp"
 
     with log_state(cluster_table=tablename, cluster_temp_table=temp_table):
         def query_detach():
             yield "BEGIN TRANSACTION;"
-            yield from detach_partition(table=table, year=year, month=month)
+            yield from detach_partition(table=table, year=year, month=month, part=part)
             yield f"CREATE TABLE IF NOT EXISTS {temp_table} PARTITION OF {table} for values from ({start}) to ({stop});"
             yield "COMMIT;"
 
         yield "\n".join(query_detach())
 
-        yield from do_cluster_operation(table=table, year=year, month=month)
+        yield from do_cluster_operation(table=table, year=year, month=month, part=part)
 
         def query_swap():
             yield "BEGIN TRANSACTION;"
             yield f"ALTER TABLE {table} DETACH PARTITION {temp_table};"
-            yield from attach_partition(table=table, year=year, month=month)
+            yield from attach_partition(table=table, year=year, month=month, part=part)
             yield "COMMIT;"
         yield "\n".join(query_swap())
 
@@ -293,7 +435,274 @@ def cluster_table(table="history", year=2011, month=12):
         yield "\n".join(query_cleanup())
 
     with log_state(cluster_table=tablename):
+        yield from drop_check_constraint(table=table, year=year, month=month, part=part)
+
+
+def fused_items_sql(source, dest, table="history", retention=FAST_WINDOW):
+    """Copy the rows we want to keep from `source` to `dest`, sorted.
+
+    Rows of removed items and expired rows (see expired_items_sql) are left
+    out, and duplicates are only copied once, except for text and trends
+    tables where clean_duplicate_items doesn't look either."""
+    dedupe = table not in ("history_text", "archive_text") and not is_trends(table)
+    period = item_period(table)
+    distinct = "DISTINCT ON (T1.itemid, T1.clock, T1.value, T1.ns) " if dedupe else ""
+    order = "T1.itemid, T1.clock, T1.value, T1.ns" if dedupe else "T1.itemid, T1.clock"
+    return f"""INSERT INTO {dest}
+SELECT {distinct}T1.*
+FROM {source} T1
+WHERE T1.itemid IN (SELECT itemid FROM items)
+AND NOT (
+    T1.clock < EXTRACT('epoch' FROM current_timestamp - INTERVAL '{retention} days')
+    AND T1.itemid IN (
+        SELECT itemid FROM items
+        WHERE items.{period}::INTERVAL > INTERVAL '1d'
+        AND   items.{period}::INTERVAL < INTERVAL '{retention} days'
+    )
+)
+ORDER BY {order};"""
+
+
+def fused_cluster_table(table="history", year=2011, month=12, part="", retention=FAST_WINDOW):
+    """Does clean_old_items, clean_expired_items, clean_duplicate_items and
+    cluster_table in a single rewrite of the partition.
+
+    Like cluster_table, the partition is detached and a temporary partition
+    takes the inserts meanwhile. The rows to keep are written to a new table
+    in (itemid, clock) order, which is then swapped in place of the old one.
+    As the new table is created in the same transaction it's filled in, a
+    server with wal_level=minimal skips the WAL for it.
+    """
+    tablename = get_table_name(table=table, year=year, month=month, part=part)
+    start, stop = get_start_and_stop(year=year, month=month, part=part)
+    temp_table = f"{tablename}_temp"
+    fused_table = f"{tablename}_fused"
+    constraint_name = get_constraint_name(table=table, year=year, month=month, part=part)
+
+    with log_state(cluster_table=tablename, cluster_temp_table=temp_table, cluster_fused_table=fused_table):
+        def query_detach():
+            yield "BEGIN TRANSACTION;"
+            yield from detach_partition(table=table, year=year, month=month, part=part)
+            yield f"CREATE TABLE IF NOT EXISTS {temp_table} PARTITION OF {table} for values from ({start}) to ({stop});"
+            yield "COMMIT;"
+
+        yield "\n".join(query_detach())
+
+        def query_rewrite():
+            yield "BEGIN TRANSACTION;"
+            yield f"DROP TABLE IF EXISTS {fused_table};"
+            yield f"CREATE TABLE IF NOT EXISTS {fused_table} (LIKE {tablename});"
+            yield fused_items_sql(tablename, fused_table, table=table, retention=retention)
+            # With the constraint in place, ATTACH doesn't have to scan the table
+            yield (
+                f"ALTER TABLE {fused_table} ADD CONSTRAINT {constraint_name} "
+                f"CHECK (clock >= {start} AND clock < {stop});"
+            )
+            yield "COMMIT;"
+
+        with log_state(step="fused_rewrite"):
+            yield "\n".join(query_rewrite())
+
+        def query_swap():
+            yield "BEGIN TRANSACTION;"
+            yield f"ALTER TABLE {table} DETACH PARTITION {temp_table};"
+            yield f"DROP TABLE {tablename};"
+            yield f"ALTER TABLE {fused_table} RENAME TO {tablename};"
+            yield from attach_partition(table=table, year=year, month=month, part=part)
+            yield "COMMIT;"
+        yield "\n".join(query_swap())
+
+        def query_cleanup():
+            yield "BEGIN TRANSACTION;"
+            yield f"INSERT INTO {tablename} SELECT * from {temp_table} order by itemid,clock;"
+            yield f"DROP TABLE {temp_table};"
+            yield "COMMIT;"
+
+        yield "\n".join(query_cleanup())
+
+    with log_state(cluster_table=tablename):
+        yield from drop_check_constraint(table=table, year=year, month=month, part=part)
+        # The indexes went with the old table
+        yield from ensure_brin_index(table=table, year=year, month=month, part=part)
+
+
+def online_cluster_table(table="history", year=2011, month=12, part=""):
+    """Does the same as cluster_table, while the partition stays attached and
+    writable. Only the final swap blocks writers, see online.py."""
+    tablename = get_table_name(table=table, year=year, month=month, part=part)
+    start, stop = get_start_and_stop(year=year, month=month, part=part)
+    delta_table = f"{tablename}_delta"
+    online_table = f"{tablename}_online"
+    constraint_name = get_constraint_name(table=table, year=year, month=month, part=part)
+
+    with log_state(cluster_table=tablename, cluster_delta_table=delta_table, cluster_online_table=online_table):
+        def query_build():
+            # All rows committed before this snapshot are in the copy, and
+            # their delta rows are deleted. Later ones stay in the delta.
+            yield "BEGIN TRANSACTION ISOLATION LEVEL REPEATABLE READ;"
+            yield f"DROP TABLE IF EXISTS {online_table};"
+            yield f"CREATE TABLE IF NOT EXISTS {online_table} (LIKE {tablename});"
+            yield f"INSERT INTO {online_table} SELECT * FROM {tablename} ORDER BY itemid, clock;"
+            yield f"DELETE FROM {delta_table};"
+            # With the constraint in place, ATTACH doesn't have to scan the table
+            yield (
+                f"ALTER TABLE {online_table} ADD CONSTRAINT {constraint_name} "
+                f"CHECK (clock >= {start} AND clock < {stop});"
+            )
+            yield "COMMIT;"
+
+        swap = [
+            # The delta table uses the row type of the partition
+            f"DROP TABLE {delta_table};",
+            f"ALTER TABLE {table} DETACH PARTITION {tablename};",
+            f"DROP TABLE {tablename};",
+            f"ALTER TABLE {online_table} RENAME TO {tablename};",
+            *attach_partition(table=table, year=year, month=month, part=part),
+        ]
+        # Whatever fails, the trigger, delta and copy are dropped again
+        yield OnlineCluster(tablename, delta_table, online_table, [
+            ("online_capture", capture_sql(tablename, delta_table)),
+            ("online_build", "\n".join(query_build())),
+            ("online_catch_up", OnlineCatchUp(delta_table, online_table)),
+            ("online_swap", OnlineSwap(table, delta_table, online_table, swap)),
+        ])
+
+    with log_state(cluster_table=tablename):
+        yield from drop_check_constraint(table=table, year=year, month=month, part=part)
+        # The indexes went with the old table
+        yield from ensure_brin_index(table=table, year=year, month=month, part=part)
+
+
+def merge_partitions(table="history", year=2011, month=12, parts=()):
+    """Merge the week or day partitions of a month into a single partition.
+
+    Like fused_cluster_table, a temporary partition takes the inserts while
+    the rows are copied, in (itemid, clock) order, so the merged partition is
+    clustered as well."""
+    tablename = get_table_name(table=table, year=year, month=month)
+    start, stop = get_start_and_stop(year=year, month=month)
+    temp_table = f"{tablename}_temp"
+    merge_table = f"{tablename}_merge"
+    constraint_name = get_constraint_name(table=table, year=year, month=month)
+    names = [get_table_name(table=table, year=year, month=month, part=part) for part in parts]
+
+    with log_state(merge_table=tablename, merge_parts=len(names)):
+        def query_detach():
+            yield "BEGIN TRANSACTION;"
+            for name in names:
+                yield f"ALTER TABLE {table} DETACH PARTITION {name};"
+            yield f"CREATE TABLE IF NOT EXISTS {temp_table} PARTITION OF {table} for values from ({start}) to ({stop});"
+            yield "COMMIT;"
+
+        with log_state(step="merge_detach"):
+            yield "\n".join(query_detach())
+
+        def query_merge():
+            yield "BEGIN TRANSACTION;"
+            yield f"DROP TABLE IF EXISTS {merge_table};"
+            yield f"CREATE TABLE IF NOT EXISTS {merge_table} (LIKE {table});"
+            union = "\n    UNION ALL ".join(f"SELECT * FROM {name}" for name in names)
+            yield f"INSERT INTO {merge_table}\n    {union}\nORDER BY itemid, clock;"
+            # With the constraint in place, ATTACH doesn't have to scan the table
+            yield (
+                f"ALTER TABLE {merge_table} ADD CONSTRAINT {constraint_name} "
+                f"CHECK (clock >= {start} AND clock < {stop});"
+            )
+            yield "COMMIT;"
+
+        with log_state(step="merge_rewrite"):
+            yield "\n".join(query_merge())
+
+        def query_swap():
+            yield "BEGIN TRANSACTION;"
+            yield f"ALTER TABLE {table} DETACH PARTITION {temp_table};"
+            for name in names:
+                yield f"DROP TABLE {name};"
+            yield f"ALTER TABLE {merge_table} RENAME TO {tablename};"
+            yield from attach_partition(table=table, year=year, month=month)
+            yield "COMMIT;"
+        yield "\n".join(query_swap())
+
+        def query_cleanup():
+            yield "BEGIN TRANSACTION;"
+            yield f"INSERT INTO {tablename} SELECT * from {temp_table} order by itemid,clock;"
+            yield f"DROP TABLE {temp_table};"
+            yield "COMMIT;"
+
+        yield "\n".join(query_cleanup())
+
+    with log_state(merge_table=tablename):
         yield from drop_check_constraint(table=table, year=year, month=month)
+        yield from ensure_brin_index(table=table, year=year, month=month)
+
+
+def split_partitions(table="history", year=2011, month=12, old_parts=("",), parts=()):
+    """Replace the empty partitions of a future month with finer ones.
+
+    Fails, and changes nothing, if any of them has rows."""
+    old_names = [get_table_name(table=table, year=year, month=month, part=part) for part in old_parts]
+
+    def query():
+        yield "BEGIN TRANSACTION;"
+        for name in old_names:
+            yield f"LOCK TABLE {name} IN ACCESS EXCLUSIVE MODE;"
+            yield (
+                f"DO $$ BEGIN IF EXISTS (SELECT 1 FROM {name}) THEN "
+                f"RAISE EXCEPTION 'Cannot split {name}, it has rows'; END IF; END $$;"
+            )
+        for name in old_names:
+            yield f"ALTER TABLE {table} DETACH PARTITION {name};"
+            yield f"DROP TABLE {name};"
+        for part in parts:
+            yield from create_table_partition(table=table, year=year, month=month, part=part)
+        yield "COMMIT;"
+
+    with log_state(step="split_partitions", split_table=table, split_parts=len(parts)):
+        yield "\n".join(query())
+
+
+def month_layout(catalog, table, date, granularity="month", split=False):
+    """The parts a month should be maintained as.
+
+    Months keep the partitions they have. A month without partitions gets
+    them at `granularity`, as does one that has coarser ones, with `split`.
+    Returns (parts, old_parts), where old_parts need splitting."""
+    want = month_parts(date.year, date.month, granularity)
+    have = catalog.parts(table, date.year, date.month) if catalog is not None else []
+    if not have:
+        return want, []
+    if split and len(have) < len(want):
+        return want, have
+    return have, []
+
+
+def past_parts(catalog, table, date):
+    """The parts of a month that may have data, [""] unless it is split."""
+    have = catalog.parts(table, date.year, date.month) if catalog is not None else []
+    return have or [""]
+
+
+def merge_units(catalog, tables, before):
+    """(table, date, parts) of the split months before `before`."""
+    for date in months_between(to_date=before):
+        for table in tables:
+            parts = catalog.parts(table, date.year, date.month)
+            if parts and parts != [""]:
+                yield table, date, [p for p in parts if p]
+
+
+def do_merge(pool, workers=1):
+    """Merge the week and day partitions of the months before last month
+    into monthly ones, once they are no longer written to."""
+    tables = maintained_tables(pool.catalog)
+    sched = Scheduler(pool, workers=workers)
+    last_month, = gen_last_month()
+    for table, date, parts in merge_units(pool.catalog, tables, last_month):
+        sched.add_statements(
+            task_key(table, date, "merge"),
+            partial(merge_partitions, table=table, year=date.year, month=date.month, parts=parts),
+        )
+    sched.run()
 
 
 @log_step
@@ -317,9 +726,9 @@ def migrate_config_items():
     yield "\n".join(query())
 
 
-def should_maintain(conn, table="history", year=2112, month=12):
-    tbname = get_table_name(table=table, year=year, month=month)
-    return table_exists(conn, tbname)
+def should_maintain(conn, table="history", year=2112, month=12, part="", catalog=None):
+    tbname = get_table_name(table=table, year=year, month=month, part=part)
+    return table_exists(conn, tbname, catalog=catalog)
 
 
 @log_step
@@ -327,116 +736,170 @@ def clean_old_sessions():
     yield """DELETE FROM sessions WHERE lastaccess < extract('epoch' from current_timestamp - interval '12 hours');"""
 
 
-def do_maintenance(connstr, cluster=False):
-    tables = ("history", "history_uint", "history_text", "history_str")
-
-    with connect_autocommit(connstr) as c:
-        # Delete old sessions. Zabbix API "logout" call implicitly logs out
-        # all sessions instead of just the current one.
-        with prelude_cursor(c) as curs:
-            for statement in clean_old_sessions():
-                execute(curs, statement)
-
-        # Create statistics ( let the auto-analyze function analyze later)
-        with prelude_cursor(c) as curs:
-            for x in create_item_statistics():
-                execute(curs, x)
-
-            for table in tables:
-                for x in create_statistics(table=table):
-                    execute(curs, x)
-
-        # Step into the future and make tables & indexes
-        for date in months_for_year_ahead():
-            for table in tables:
-                for x in create_table_partition(
-                    table=table, year=date.year, month=date.month
-                ):
-                    with prelude_cursor(c) as curs:
-                        execute(curs, x)
-
-                for x in ensure_btree_index(
-                    table=table, year=date.year, month=date.month
-                ):
-                    with prelude_cursor(c) as curs:
-                        execute(curs, x)
-
-                for x in clean_old_indexes(
-                    table=table, year=date.year, month=date.month
-                ):
-                    with prelude_cursor(c) as curs:
-                        execute(curs, x)
-
-                for x in ensure_brin_index(
-                    table=table, year=date.year, month=date.month
-                ):
-                    with prelude_cursor(c) as curs:
-                        execute(curs, x)
-
-        for n, date in enumerate(months_for_year_past()):
-            fresh_table = n <= 1
-            for table in tables:
+def add_index_transitions(sched, stage, age, journal=None, requires=(), **kws):
+    """Schedule the builds and drops that move a partition to `stage`, see
+    policy.py. The builds run one at a time, and indexes are only dropped
+    once the builds are done. Returns the tasks that do all that.
+
+    Partitions are checked to exist when the task runs, as the past months
+    may be missing."""
+    table, date = kws["table"], datetime.date(kws["year"], kws["month"], 1)
+    part = kws["part"]
+
+    def maintain(kind, drop=False):
+        # Should maintain uses the worker connection, so we cannot nest it
+        # inside the statement's cursor.
+        if should_maintain(sched.connection(), catalog=sched.pool.catalog, **kws):
+            yield from index_transition(kind, drop=drop, journal=journal, **kws)
+
+    built = list(requires)
+    for kind in wanted_kinds(stage, age):
+        built = [sched.add_statements(task_key(table, date, kind, part), partial(maintain, kind), requires=built)]
+    catalog = sched.pool.catalog
+    dropped = [
+        sched.add_statements(task_key(table, date, f"clean_{kind}_index", part), partial(maintain, kind, drop=True),
+                             requires=built)
+        for kind in KINDS
+        if kind not in stage.kinds and (catalog is None or catalog.has_index(get_index_name(kind=kind, **kws)))
+    ]
+    return built + dropped
+
+
+def schedule_maintenance(sched, tables, cluster=False, journal=None, scans=None, start=None):
+    """Add the partition, index and cluster day tasks of a maintenance run
+    to `sched`, as of `start` (default today). The planner (planner.py) plans
+    from the same tasks without running them. `scans` are the index scans
+    for HOUSEKEEPER_INDEX_IDLE."""
+    # Step into the future and make tables & indexes. Months after this one
+    # are still empty, and are split if the granularity got finer.
+    catalog = sched.pool.catalog
+    granularity = get_granularity()
+    tune = get_brin_tune()
+    policies = {table: get_index_policy(table) for table in tables}
+    this_month = None
+    for date in months_for_year_ahead(start):
+        this_month = this_month or date
+        for table in tables:
+            parts, old_parts = month_layout(catalog, table, date, granularity, split=date > this_month)
+            split = None
+            if old_parts:
+                split = sched.add_statements(
+                    task_key(table, date, "split"),
+                    partial(split_partitions, table=table, year=date.year, month=date.month,
+                            old_parts=old_parts, parts=parts),
+                )
+            for part in parts:
+                kws = dict(table=table, year=date.year, month=date.month, part=part)
+                partition = sched.add_statements(
+                    task_key(table, date, "partition", part), partial(create_table_partition, **kws),
+                    requires=[split] if split else (),
+                )
+                stage = stage_for(policies[table], age=0, **kws)
+                built = add_index_transitions(sched, stage, 0, journal, requires=[partition], **kws)
+                if date == this_month and "brin" in stage.kinds:
+                    sched.add_statements(
+                        task_key(table, date, "summarize_brin", part), partial(summarize_brin_index, **kws),
+                        requires=built,
+                    )
+                sched.add_statements(
+                    task_key(table, date, "clean_old_indexes", part), partial(clean_old_indexes, **kws),
+                    requires=[partition],
+                )
+
+    for n, date in enumerate(months_for_year_past(start)):
+        age = n + 1
+        for table in tables:
+            for part in past_parts(catalog, table, date):
+                kws = dict(table=table, year=date.year, month=date.month, part=part)
                 # Clean out undesired indexes
-                for x in clean_old_indexes(
-                    table=table, year=date.year, month=date.month
-                ):
-                    with prelude_cursor(c) as curs:
-                        execute(curs, x)
-
-                # Should maintain uses a connection, need to nest our cursor
-                # after this
-                if should_maintain(c, table=table, year=date.year, month=date.month):
-                    for x in ensure_brin_index(
-                        table=table, year=date.year, month=date.month
-                    ):
-                        with prelude_cursor(c) as curs:
-                            execute(curs, x)
-
-                if not fresh_table:
-                    for x in clean_btree_index(
-                        table=table, year=date.year, month=date.month
-                    ):
-                        with prelude_cursor(c) as curs:
-                            execute(curs, x)
-
-        if cluster:
-            for date in gen_last_month():
-                for table in tables:
-                    for x in clean_expired_items(
-                        table=table,
-                        year=date.year,
-                        month=date.month,
-                        retention=FAST_WINDOW,
-                    ):
-                        with prelude_cursor(c) as curs:
-                            execute(curs, x)
-
+                sched.add_statements(
+                    task_key(table, date, "clean_old_indexes", part), partial(clean_old_indexes, **kws)
+                )
+                stage = stage_for(policies[table], age, scans=scans, **kws)
+                done = add_index_transitions(sched, stage, age, journal, **kws)
+                if tune and "brin" in stage.kinds:
+                    sched.add_statements(
+                        task_key(table, date, "tune_brin", part), partial(tune_brin_index, **kws),
+                        requires=done,
+                    )
+
+    if cluster:
+        target = get_batch_target()
+        engine = get_dedupe_engine()
+        mode = get_cluster_mode()
+        for date in gen_last_month():
+            for table in tables:
+                # Wait for all index work on the partition before we start
+                # deleting & rewriting it.
+                partition = task_key(table, date, "")[:2]
+                busy = [k for k in sched.tasks if k[:2] == partition]
+                for part in past_parts(catalog, table, date):
+                    kws = dict(table=table, year=date.year, month=date.month, part=part)
+                    if mode == "fused":
+                        # Clean up, dedupe and cluster in a single rewrite
+                        sched.add_statements(
+                            task_key(table, date, "cluster_table", part),
+                            partial(fused_cluster_table, retention=FAST_WINDOW, **kws),
+                            requires=busy,
+                        )
+                        continue
+                    cluster_func = online_cluster_table if mode == "online" else cluster_table
+                    expired = sched.add_statements(
+                        task_key(table, date, "clean_expired_items", part),
+                        partial(clean_expired_items, retention=FAST_WINDOW, target_seconds=target, **kws),
+                        requires=busy,
+                    )
                     # Remove duplicated rows from tables before we cluster them
-                    for x in clean_duplicate_items(
-                        table=table, year=date.year, month=date.month
-                    ):
-                        with prelude_cursor(c) as curs:
-                            execute(curs, x)
-
+                    dedupe = sched.add_statements(
+                        task_key(table, date, "clean_duplicate_items", part),
+                        partial(clean_duplicate_items, target_seconds=target, engine=engine, **kws),
+                        requires=[expired],
+                    )
                     # Cluster the tables
-                    for x in cluster_table(
-                        table=table, year=date.year, month=date.month
-                    ):
-                        with prelude_cursor(c) as curs:
-                            execute(curs, x)
-
-
-def oneshot_maintenance_operation(table="history", year=2018, month=12):
-    yield from ensure_brin_index(table=table, year=year, month=month)
-    yield from clean_old_indexes(table=table, year=year, month=month)
-    yield from clean_old_items(table=table, year=year, month=month)
-    yield from clean_expired_items(table=table, year=year, month=month)
-    yield from clean_duplicate_items(table=table, year=year, month=month)
-    yield from cluster_table(table=table, year=year, month=month)
-
-
-def maintain_last_year():
-    tables = ("history", "history_uint", "history_text", "history_str")
+                    sched.add_statements(
+                        task_key(table, date, "cluster_table", part), partial(cluster_func, **kws),
+                        requires=[dedupe],
+                    )
+
+
+def do_maintenance(pool, cluster=False, workers=1, journal=None):
+    tables = maintained_tables(pool.catalog)
+
+    # Delete old sessions. Zabbix API "logout" call implicitly logs out
+    # all sessions instead of just the current one.
+    for statement in clean_old_sessions():
+        pool.execute(statement)
+
+    # Create statistics ( let the auto-analyze function analyze later)
+    for x in create_item_statistics():
+        pool.execute(x)
+
+    for table in tables:
+        for x in create_statistics(table=table):
+            pool.execute(x)
+
+    scans = None
+    if get_index_idle():
+        with pool.connection() as conn:
+            scans = index_scans(conn)
+    sched = Scheduler(pool, workers=workers)
+    schedule_maintenance(sched, tables, cluster=cluster, journal=journal, scans=scans)
+    sched.run()
+
+
+def oneshot_maintenance_operation(table="history", year=2018, month=12, part="", target_seconds=None,
+                                  engine="legacy"):
+    kws = dict(table=table, year=year, month=month, part=part)
+    yield from ensure_brin_index(**kws)
+    yield from clean_old_indexes(**kws)
+    yield from clean_old_items(**kws, target_seconds=target_seconds)
+    yield from clean_expired_items(**kws, target_seconds=target_seconds)
+    yield from clean_duplicate_items(**kws, target_seconds=target_seconds, engine=engine)
+    yield from cluster_table(**kws)
+
+
+def maintain_last_year(catalog=None):
+    tables = maintained_tables(catalog)
     for date in months_for_year_past():
         for table in tables:
             yield from oneshot_maintenance_operation(
@@ -444,8 +907,8 @@ def maintain_last_year():
             )
 
 
-def oneshot_maintenance():
-    tables = ("history", "history_uint", "history_text", "history_str")
+def oneshot_maintenance(catalog=None):
+    tables = maintained_tables(catalog)
     for date in months_2014_to_current():
         for table in tables:
             yield from oneshot_maintenance_operation(
@@ -453,35 +916,72 @@ def oneshot_maintenance():
             )
 
 
-def do_oneshot_maintenance(connstr):
-    tables = ("history", "history_uint", "history_text", "history_str")
-
-    with connect_autocommit(connstr) as c:
-
-        # Move config items out
-        with prelude_cursor(c) as curs:
-            for x in migrate_config_items():
-                execute(curs, x)
-
-        # Create statistics (let the auto-analyze function analyze later)
-        with prelude_cursor(c) as curs:
-            for x in create_item_statistics():
-                execute(curs, x)
-
+def oneshot_units(catalog, target=None, engine="legacy"):
+    """(table, date, statements) of every partition do_oneshot_maintenance handles."""
+    tables = maintained_tables(catalog)
+    for date in months_2014_to_current():
         for table in tables:
-            for x in create_statistics(table=table):
-                with prelude_cursor(c) as curs:
-                    execute(curs, x)
-
-        # And for all tables, do complete maintenance
+            for part in past_parts(catalog, table, date):
+                if catalog.table_exists(get_table_name(table=table, year=date.year, month=date.month, part=part)):
+                    statements = oneshot_maintenance_operation(
+                        table=table, year=date.year, month=date.month, part=part, target_seconds=target,
+                        engine=engine,
+                    )
+                    yield table, date, statements
+
+
+def do_oneshot_maintenance(pool, journal=None):
+    tables = maintained_tables(pool.catalog)
+
+    # Move config items out
+    for x in migrate_config_items():
+        pool.execute(x)
+
+    # Create statistics (let the auto-analyze function analyze later)
+    for x in create_item_statistics():
+        pool.execute(x)
+
+    for table in tables:
+        for x in create_statistics(table=table):
+            pool.execute(x)
+
+    # And for all tables, do complete maintenance
+    target = get_batch_target()
+    engine = get_dedupe_engine()
+    with pool.connection() as c:
         for date in months_2014_to_current():
             for table in tables:
-                if should_maintain(c, table=table, year=date.year, month=date.month):
-                    for x in oneshot_maintenance_operation(
-                        table=table, year=date.year, month=date.month
-                    ):
-                        with prelude_cursor(c) as curs:
-                            execute(curs, x)
+                for part in past_parts(pool.catalog, table, date):
+                    kws = dict(table=table, year=date.year, month=date.month, part=part)
+                    if not should_maintain(c, catalog=pool.catalog, **kws):
+                        continue
+                    statements = oneshot_maintenance_operation(**kws, target_seconds=target, engine=engine)
+                    month = task_key(table, date, "")[1]
+                    with TRACER.span("step", "oneshot", table=table, month=month, part=part):
+                        # With a journal, a rerun skips what is already done
+                        for x in journaled(journal, "oneshot", table, date.year, date.month, statements):
+                            with c.cursor() as curs:
+                                execute(curs, x, catalog=pool.catalog)
+                            log_and_reset_notices(c)
+
+
+def format_bytes(size):
+    for unit in ("B", "kB", "MB", "GB", "TB"):
+        if size < 1024 or unit == "TB":
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}"
+
+
+def print_status(catalog):
+    """Print all partitions of the history tables from the catalog."""
+    tables = HISTORY_TABLES + TRENDS_TABLES
+    print(f"{'partition':<32} {'size':>10} {'rows':>14}  {'indexes':<14} archived")
+    for table in tables:
+        for rel in catalog.partitions(table):
+            kinds = ",".join(sorted(set(rel.indexes.values()))) or "-"
+            archived = "yes" if rel.archived else "no"
+            print(f"{rel.name:<32} {format_bytes(rel.size):>10} {rel.rows:>14}  {kinds:<14} {archived}")
 
 
 def role_msg():
@@ -504,9 +1004,12 @@ def main():
     elif len(sys.argv) > 1:
         command = sys.argv[-1]
 
-    if command not in ("cron", "cluster", "oneshot"):
+    commands = ("cron", "cluster", "oneshot", "status", "plan", "progress", "merge", "transitions", "plans",
+                "baseline")
+    if command not in commands:
         print(f"Usage: {sys.argv[0]} {{ COMMAND }}")
-        print("where COMMAND := { cluster | oneshot | cluster_all }")
+        print("where COMMAND := { cluster | oneshot | cron | status | plan | progress | merge | transitions |")
+        print("                   plans | baseline }")
         print("")
         print(
             """
@@ -514,20 +1017,82 @@ oneshot: Sets up indexes, cleans out items, and clusters all tables from 2014 an
          Extremely heavy operation.
 cluster: Clusters last month, run in case you missed the cron job the 14th."
 cron:    Ensures indexes exist, table partitions exists for the")
-         future, and will cluster last month if the date is the 14th"""
+         future, and will cluster last month if the date is the 14th
+status:  Lists all partitions with their size, indexes, row estimate and
+         whether they are archived.
+plan:    Prints what cron would do today, with row, cost and runtime
+         estimates, without changing anything. Includes archiving clean up
+         when MODIO_ARCHIVE is set.
+progress: Lists what is left of the oneshot job in the journal.
+merge:   Merges the week or day partitions of the months before last month
+         into one partition per month.
+transitions: Lists the indexes built and dropped by the index policy, with
+         their size and build time, from the journal.
+plans:   Lists the latest captured plan of each clean up step and table, and
+         how it regressed from its baseline, from the journal.
+baseline: Makes the latest captured plans the baseline."""
         )
         print("-")
         print("set the role with the environment variable 'HOUSEKEEPER_ROLE'")
+        print("set the number of parallel connections with 'HOUSEKEEPER_WORKERS' (default 1)")
+        print("set the path of a journal to resume oneshot with 'HOUSEKEEPER_JOURNAL'")
+        print("set the partitions of new months to month (default), week or day with 'HOUSEKEEPER_GRANULARITY'")
+        print("set the index policy with 'HOUSEKEEPER_INDEX_POLICY' (default: btree+brin:3,brin)")
+        print("set the batches of each clean up step to EXPLAIN ANALYZE with 'HOUSEKEEPER_EXPLAIN' (default 0)")
         print("No arguments: run in cron mode")
         sys.exit(1)
 
-    if command == "cron":
-        should_cluster = datetime.datetime.utcnow().day == FAST_WINDOW
-        do_maintenance(connstr=connstr, cluster=should_cluster)
-    elif command == "cluster":
-        do_maintenance(connstr=connstr, cluster=True)
-    elif command == "oneshot":
-        do_oneshot_maintenance(connstr=connstr)
+    journal = get_journal()
+    if command == "progress" and journal is None:
+        print("Set HOUSEKEEPER_JOURNAL to the journal of the oneshot run")
+        sys.exit(1)
+    if command in ("transitions", "plans", "baseline"):
+        if journal is None:
+            print("Set HOUSEKEEPER_JOURNAL to the journal of the cron runs")
+            sys.exit(1)
+        if command == "transitions":
+            print_transitions(journal)
+        elif command == "plans":
+            print_plans(journal)
+        else:
+            print(f"{journal.rebaseline()} plans are the baseline now")
+        journal.close()
+        return
+
+    success = False
+    try:
+        workers = get_workers()
+        with ConnectionPool(connstr, maxconn=workers) as pool:
+            catalog = pool.load_catalog()
+            if command == "status":
+                print_status(catalog)
+            elif command == "plan":
+                # planner builds on the generators in this module
+                from .planner import plan
+
+                should_cluster = datetime.datetime.utcnow().day == FAST_WINDOW
+                tables = maintained_tables(catalog)
+                plan(pool, tables, cluster=should_cluster, workers=workers)
+            elif command == "cron":
+                should_cluster = datetime.datetime.utcnow().day == FAST_WINDOW
+                do_maintenance(pool=pool, cluster=should_cluster, workers=workers, journal=journal)
+            elif command == "cluster":
+                do_maintenance(pool=pool, cluster=True, workers=workers, journal=journal)
+            elif command == "oneshot":
+                do_oneshot_maintenance(pool=pool, journal=journal)
+            elif command == "merge":
+                do_merge(pool=pool, workers=workers)
+            elif command == "progress":
+                units = oneshot_units(catalog, target=get_batch_target(), engine=get_dedupe_engine())
+                print_progress(journal, "oneshot", units)
+        success = True
+    finally:
+        EXPLAIN.save(journal)
+        if journal is not None:
+            journal.close()
+        STATS.log()
+        METRICS.write("housekeeper", success=success)
+        TRACER.write("housekeeper")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,313 @@
+"""A journal of finished work, so long runs can resume after a crash.
+
+The oneshot jobs walk every month since 2014, and used to start over from
+the beginning after any crash or timeout. With HOUSEKEEPER_JOURNAL set to
+the path of a SQLite file, every statement that completes is recorded there
+for its (job, table, month), and a rerun skips it.
+
+Statements are recognised by a digest of their SQL, which includes the
+partition and batch range. A statement that a generator yields several
+times for the same month (like the VACUUM between dedupe batches) is
+counted, so each occurrence is journaled on its own. A statement is
+journaled as soon as it has run, see JournaledStatement.
+
+A batching.AdaptiveDelete sizes its own batches, so it is journaled as a
+whole, and each of its committed batches is journaled by its clock range as
+well. A rerun resumes it from the stop of the last of them.
+
+Only use it for the same job with the same settings: changing the batch
+size or target changes the statements, and the journal will not match.
+
+The index transitions of policy.py are kept in the journal as well, with
+the bytes each added or freed and the time it took, and so are the plans
+explain.py captures.
+"""
+import collections
+import datetime
+import hashlib
+import os
+import sqlite3
+import threading
+
+import structlog
+from structlog.contextvars import get_contextvars
+
+from .batching import AdaptiveDelete
+from .helpers import execute
+
+_log = structlog.get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS done (
+    job TEXT NOT NULL,
+    tbl TEXT NOT NULL,
+    month TEXT NOT NULL,
+    batch TEXT NOT NULL,
+    step TEXT,
+    batch_range TEXT,
+    finished TEXT NOT NULL,
+    PRIMARY KEY (job, tbl, month, batch)
+);"""
+
+TRANSITIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transitions (
+    tbl TEXT NOT NULL,
+    idx TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    action TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    finished TEXT NOT NULL
+);"""
+
+PLANS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    step TEXT NOT NULL,
+    tbl TEXT NOT NULL,
+    partition TEXT NOT NULL,
+    shape TEXT NOT NULL,
+    cost REAL NOT NULL,
+    milliseconds REAL NOT NULL,
+    buffers INTEGER NOT NULL,
+    reads INTEGER NOT NULL,
+    deleted INTEGER NOT NULL,
+    clock_window INTEGER NOT NULL,
+    recorded TEXT NOT NULL,
+    baseline INTEGER NOT NULL,
+    regressions TEXT NOT NULL,
+    explained TEXT NOT NULL
+);"""
+PLAN_COLUMNS = "step, tbl, partition, shape, cost, milliseconds, buffers, reads, deleted, clock_window, recorded"
+
+
+def get_journal():
+    """
+    environment variable HOUSEKEEPER_JOURNAL is the path of the SQLite journal
+    file. When it is not set, nothing is journaled."""
+    path = os.environ.get("HOUSEKEEPER_JOURNAL")
+    if not path:
+        return None
+    return Journal(path)
+
+
+def month_key(year, month):
+    return f"{year:04d}-{month:02d}"
+
+
+def statement_digest(statement):
+    return hashlib.sha1(str(statement).encode("utf-8")).hexdigest()[:16]
+
+
+def current_step():
+    """The step and batch range the generators have put in the log context."""
+    ctx = get_contextvars()
+    bounds = [str(v) for k, v in sorted(ctx.items()) if k.endswith(("_start", "_stop"))]
+    return ctx.get("step"), "-".join(bounds) or None
+
+
+class JournaledStatement:
+    """Run a statement, and journal it once it has run."""
+
+    def __init__(self, journal, job, table, year, month, batch, step, batch_range, statement):
+        self.journal = journal
+        self.unit = (job, table, year, month)
+        self.batch = batch
+        self.step = step
+        self.batch_range = batch_range
+        self.statement = statement
+
+    def __str__(self):
+        return str(self.statement)
+
+    def _batch_done(self, start, stop):
+        self.journal.record(*self.unit, f"{self.batch}@{start}-{stop}", step=self.step,
+                            batch_range=f"{start}-{stop}")
+
+    def __call__(self, cursor, catalog=None):
+        statement = self.statement
+        if isinstance(statement, AdaptiveDelete):
+            start = self.journal.resumed_start(*self.unit, self.batch)
+            if start is None:
+                start = statement.start
+            else:
+                _log.info("Resuming journaled batches", step=self.step, batch_start=start)
+            statement = statement.resume(start, self._batch_done)
+        result = execute(cursor, statement, catalog=catalog)
+        self.journal.record(*self.unit, self.batch, step=self.step, batch_range=self.batch_range)
+        return result
+
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Scheduler workers share the journal, access is serialised by _lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(SCHEMA)
+            self._db.execute(TRANSITIONS_SCHEMA)
+            self._db.execute(PLANS_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def done(self, job, table, year, month, batch):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM done WHERE job = ? AND tbl = ? AND month = ? AND batch = ?",
+                (job, table, month_key(year, month), batch),
+            ).fetchone()
+        return row is not None
+
+    def finished(self, job, table, year, month):
+        """All batches recorded for a month."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT batch FROM done WHERE job = ? AND tbl = ? AND month = ?",
+                (job, table, month_key(year, month)),
+            ).fetchall()
+        return {batch for batch, in rows}
+
+    def resumed_start(self, job, table, year, month, batch):
+        """The stop of the last batch journaled inside `batch`, or None."""
+        prefix = f"{batch}@"
+        stops = [int(key.rsplit("-", 1)[1]) for key in self.finished(job, table, year, month)
+                 if key.startswith(prefix)]
+        return max(stops, default=None)
+
+    def record(self, job, table, year, month, batch, step=None, batch_range=None):
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO done VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job, table, month_key(year, month), batch, step, batch_range, now),
+            )
+
+    def record_transition(self, table, index, kind, action, size, seconds):
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO transitions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (table, index, kind, action, size, seconds, now),
+            )
+
+    def transitions(self):
+        """(finished, table, index, kind, action, bytes, seconds), oldest first."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT finished, tbl, idx, kind, action, bytes, seconds FROM transitions ORDER BY finished"
+            ).fetchall()
+
+    def record_plan(self, step, table, partition, shape, cost, milliseconds, buffers, reads, deleted, window,
+                    explained, baseline=False, regressions=""):
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO plans VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (step, table, partition, shape, cost, milliseconds, buffers, reads, deleted, window, now,
+                 int(baseline), regressions, explained),
+            )
+
+    def plans(self, baseline=False):
+        """The latest plan, or baseline plan, of each (step, table), as
+        (step, table, partition, shape, cost, milliseconds, buffers, reads,
+        deleted, window, recorded)."""
+        with self._lock:
+            return self._db.execute(
+                f"SELECT {PLAN_COLUMNS} FROM plans WHERE rowid IN ("
+                "SELECT max(rowid) FROM plans WHERE baseline >= ? GROUP BY step, tbl"
+                ") ORDER BY step, tbl",
+                (int(baseline),),
+            ).fetchall()
+
+    def rebaseline(self):
+        """Make the latest plan of each (step, table) its baseline."""
+        with self._lock, self._db:
+            self._db.execute("UPDATE plans SET baseline = 0")
+            count = self._db.execute(
+                "UPDATE plans SET baseline = 1 WHERE rowid IN (SELECT max(rowid) FROM plans GROUP BY step, tbl)"
+            ).rowcount
+        return count
+
+    def batches(self, statements):
+        """Pair each statement with its batch key and step."""
+        seen = collections.Counter()
+        for statement in statements:
+            digest = statement_digest(statement)
+            seen[digest] += 1
+            step, batch_range = current_step()
+            yield f"{digest}:{seen[digest]}", step, batch_range, statement
+
+    def skip_done(self, job, table, year, month, statements):
+        """Yield the statements that are not journaled yet, each wrapped in a
+        JournaledStatement that journals it once it has run."""
+        finished = self.finished(job, table, year, month)
+        skipped = 0
+        for batch, step, batch_range, statement in self.batches(statements):
+            if batch in finished:
+                skipped += 1
+                continue
+            yield JournaledStatement(self, job, table, year, month, batch, step, batch_range, statement)
+        if skipped:
+            _log.info("Skipped journaled statements", job=job, table=table, month=month_key(year, month),
+                      skipped=skipped)
+
+    def pending(self, job, table, year, month, statements):
+        """The number of statements, and the (step, batch range) of those
+        that are not journaled yet."""
+        finished = self.finished(job, table, year, month)
+        total = 0
+        left = []
+        for batch, step, batch_range, _ in self.batches(statements):
+            total += 1
+            if batch not in finished:
+                left.append((step, batch_range))
+        return total, left
+
+
+def journaled(journal, job, table, year, month, statements):
+    """The statements, less those the journal has seen finish."""
+    if journal is None:
+        return statements
+    return journal.skip_done(job, table, year, month, statements)
+
+
+def print_progress(journal, job, units):
+    """Print what is left of a job.
+
+    `units` are (table, date, statements) for every month the job covers."""
+    print(f"Journal {journal.path}, job {job}")
+    print(f"{'table':<16} {'month':<8} {'done':>6} {'left':>6}  next step")
+    total = left_total = 0
+    for table, date, statements in units:
+        count, pending = journal.pending(job, table, date.year, date.month, statements)
+        total += count
+        left_total += len(pending)
+        if not pending:
+            continue
+        step, batch_range = pending[0]
+        step = f"{step} {batch_range}" if batch_range else str(step)
+        print(f"{table:<16} {month_key(date.year, date.month):<8} {count - len(pending):>6} {len(pending):>6}  {step}")
+    print(f"{total - left_total} of {total} statements done, {left_total} left")
+
+
+def print_transitions(journal):
+    """Print the index transitions in the journal, and what they added up to."""
+    print(f"{'finished':<20} {'index':<36} {'action':<6} {'MB':>10} {'seconds':>10}")
+    freed = built = seconds_total = 0.0
+    rows = journal.transitions()
+    for finished, _, index, _, action, size, seconds in rows:
+        print(f"{finished[:19]:<20} {index:<36} {action:<6} {size / 1e6:>10.1f} {seconds:>10.1f}")
+        if size < 0:
+            freed -= size
+        else:
+            built += size
+        seconds_total += seconds
+    print(f"{len(rows)} transitions, {built / 1e6:.1f} MB built, {freed / 1e6:.1f} MB freed, "
+          f"{seconds_total:.1f} seconds")
@@ -5,18 +5,26 @@ import logging
 from contextlib import contextmanager
 
 import structlog
-from structlog.contextvars import bind_contextvars, unbind_contextvars
+from structlog.contextvars import bind_contextvars, get_contextvars, unbind_contextvars
+
+from .tracing import state_span
 
 _log = structlog.get_logger(__name__)
 
 
 @contextmanager
 def log_state(*args, **kws):
+    # Nested states may bind the same keys, like "step", restore the outer
+    # values when leaving.
+    outer = {k: v for k, v in get_contextvars().items() if k in kws}
     bind_contextvars(**kws)
     try:
-        yield
+        # Steps and batches are also trace spans, see tracing.py
+        with state_span(kws):
+            yield
     finally:
         unbind_contextvars(*kws)
+        bind_contextvars(**outer)
 
 
 def add_thread_name(logger, method_name, event_dict):
@@ -0,0 +1,163 @@
+"""Rows, time, COPY bytes and WAL of the statements of a run.
+
+helpers.execute adds every statement it runs to METRICS, under the step in
+the log context, and the partition (and its table) the SQL names:
+
+rows:       The rows the statement affected (cursor.rowcount), 0 for DDL and
+            reads.
+seconds:    The time it took.
+copy_bytes: The bytes an archive COPY moved, see archiver.copy_relay.
+wal_bytes:  How far pg_current_wal_lsn moved while the statement ran. That
+            is all the WAL the server wrote meanwhile, Zabbix's included, so
+            it is an upper bound for the statement on a busy server.
+
+With HOUSEKEEPER_METRICS_DIR set, each tool writes them at exit as a
+Prometheus textfile (for the node exporter's textfile collector) and as a
+JSON summary of the run, `housekeeper_<tool>.prom` and `.json`, also when
+the run fails, with housekeeper_run_success 0. WAL is only measured then, it
+takes two more queries per statement.
+"""
+import datetime
+import json
+import os
+import re
+import threading
+import time
+
+import structlog
+from structlog.contextvars import get_contextvars
+
+_log = structlog.get_logger(__name__)
+
+FIELDS = ("statements", "rows", "seconds", "copy_bytes", "wal_bytes")
+# A partition name, also where it starts an index or constraint name
+PARTITION = re.compile(r"\b((\w+?)_y\d{4}m\d{2}(?:w\d(?!\d)|d\d\d)?)(?!\d)")
+# Statements that write no WAL of their own
+READ_VERBS = ("SELECT", "SET", "RESET", "SHOW", "EXPLAIN")
+
+HELP = {
+    "statements": "Statements run",
+    "rows": "Rows affected",
+    "seconds": "Seconds spent running statements",
+    "rows_per_second": "Rows affected per second of statement time",
+    "copy_bytes": "Bytes moved by COPY",
+    "wal_bytes": "WAL written while the statements ran, by all sessions",
+}
+
+
+def get_metrics_dir():
+    """
+    environment variable HOUSEKEEPER_METRICS_DIR is the directory the
+    Prometheus textfile and JSON summary of a run are written to. When it is
+    not set, nothing is written."""
+    return os.environ.get("HOUSEKEEPER_METRICS_DIR") or None
+
+
+def statement_labels(query):
+    """(step, table, partition) of a statement."""
+    ctx = get_contextvars()
+    step = ctx.get("step") or str(query).lstrip().split(None, 1)[0].lower()
+    m = PARTITION.search(str(query))
+    if m:
+        return step, m.group(2), m.group(1)
+    return step, ctx.get("table", ""), ""
+
+
+def is_write(query):
+    return not str(query).lstrip().upper().startswith(READ_VERBS)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.series = {}
+
+    def enabled(self):
+        return get_metrics_dir() is not None
+
+    def add(self, labels, **values):
+        with self._lock:
+            series = self.series.setdefault(labels, dict.fromkeys(FIELDS, 0))
+            for key, value in values.items():
+                series[key] += value
+
+    def statement(self, query, rows, seconds, wal_bytes=0):
+        # The rowcount of a SELECT is the rows it returned
+        rows = max(rows, 0) if is_write(query) else 0
+        self.add(statement_labels(query), statements=1, rows=rows, seconds=seconds, wal_bytes=wal_bytes)
+
+    def summary(self):
+        """The series, as dicts with their labels and rows per second."""
+        with self._lock:
+            items = sorted(self.series.items())
+        found = []
+        for (step, table, partition), series in items:
+            rate = series["rows"] / series["seconds"] if series["seconds"] > 0 else 0.0
+            found.append(dict(step=step, table=table, partition=partition, **series, rows_per_second=rate))
+        return found
+
+    def prometheus(self, tool, success=True):
+        summary = self.summary()
+        lines = []
+        for field in FIELDS + ("rows_per_second",):
+            name = f"housekeeper_{field}"
+            lines.append(f"# HELP {name} {HELP[field]}, in the last run.")
+            lines.append(f"# TYPE {name} gauge")
+            for series in summary:
+                labels = ",".join(
+                    f'{key}="{_escape(value)}"'
+                    for key, value in (("tool", tool), ("step", series["step"]), ("table", series["table"]),
+                                       ("partition", series["partition"]))
+                )
+                lines.append(f"{name}{{{labels}}} {series[field]:g}")
+        lines.append("# HELP housekeeper_last_run_timestamp_seconds When the last run finished.")
+        lines.append("# TYPE housekeeper_last_run_timestamp_seconds gauge")
+        lines.append(f'housekeeper_last_run_timestamp_seconds{{tool="{_escape(tool)}"}} {time.time():.0f}')
+        lines.append("# HELP housekeeper_last_run_duration_seconds How long the last run took.")
+        lines.append("# TYPE housekeeper_last_run_duration_seconds gauge")
+        lines.append(f'housekeeper_last_run_duration_seconds{{tool="{_escape(tool)}"}} '
+                     f"{time.time() - self.started:.1f}")
+        lines.append("# HELP housekeeper_run_success Whether the last run finished without an error.")
+        lines.append("# TYPE housekeeper_run_success gauge")
+        lines.append(f'housekeeper_run_success{{tool="{_escape(tool)}"}} {int(success)}')
+        return "\n".join(lines) + "\n"
+
+    def run_summary(self, tool, success=True):
+        summary = self.summary()
+        totals = {field: sum(s[field] for s in summary) for field in FIELDS}
+        return {
+            "tool": tool,
+            "started": datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).isoformat(),
+            "finished": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "seconds": time.time() - self.started,
+            "success": success,
+            "totals": totals,
+            "steps": summary,
+        }
+
+    def write(self, tool, success=True):
+        """Write the textfile and JSON summary to HOUSEKEEPER_METRICS_DIR,
+        `success` says whether the run finished without an error."""
+        path = get_metrics_dir()
+        if path is None:
+            return
+        for suffix, text in (
+            ("prom", self.prometheus(tool, success=success)),
+            ("json", json.dumps(self.run_summary(tool, success=success), indent=2)),
+        ):
+            filename = os.path.join(path, f"housekeeper_{tool}.{suffix}")
+            # The textfile collector may read at any time, never show it a
+            # half written file.
+            with open(f"{filename}.tmp", "w") as f:
+                f.write(text)
+            os.replace(f"{filename}.tmp", filename)
+        _log.info("Wrote metrics", path=path, tool=tool, series=len(self.series), success=success)
+
+
+# Global state for the whole run, written at exit by the tools.
+METRICS = Metrics()
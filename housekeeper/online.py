@@ -0,0 +1,184 @@
+"""Clustering a partition while it stays attached and writable.
+
+CLUSTER holds an ACCESS EXCLUSIVE lock for the whole rewrite. Online
+clustering instead builds a sorted copy next to the live partition:
+
+1. A trigger on the partition copies every inserted row into a delta table.
+2. A REPEATABLE READ transaction copies the partition in (itemid, clock)
+   order, and deletes the delta rows it can see, as those are in the copy.
+3. The delta rows that arrived meanwhile are moved into the copy, in rounds,
+   until a round finds only a few.
+4. The swap locks the parent table, moves what is left of the delta, and puts
+   the copy in place of the partition.
+
+Only the swap blocks writers. It waits at most `lock_timeout` seconds for its
+lock, so it doesn't queue Zabbix behind a long running query, and catches up
+again before the next attempt.
+
+Zabbix only ever inserts into history tables. Updates and deletes on the
+partition during the build are not carried over.
+
+When any of it fails, OnlineCluster rolls back, and drops the trigger, the
+delta table and the copy, so the partition is left as it was and the next
+run starts over.
+"""
+import time
+
+import psycopg2.errors
+import structlog
+
+from .helpers import execute
+from .logs import log_state
+
+_log = structlog.get_logger(__name__)
+
+
+def capture_sql(partition, delta):
+    """Create the delta table, and the trigger that fills it.
+
+    The trigger of a run that died is replaced, not added to."""
+    return f"""BEGIN TRANSACTION;
+DROP TRIGGER IF EXISTS {delta}_capture ON {partition};
+DROP TABLE IF EXISTS {delta};
+CREATE TABLE IF NOT EXISTS {delta} (r {partition});
+CREATE OR REPLACE FUNCTION {delta}_capture() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO {delta} (r) VALUES (NEW);
+    RETURN NULL;
+END $$;
+CREATE TRIGGER {delta}_capture AFTER INSERT ON {partition}
+    FOR EACH ROW EXECUTE PROCEDURE {delta}_capture();
+COMMIT;"""
+
+
+def catch_up_sql(delta, dest):
+    return f"""WITH moved AS (DELETE FROM {delta} RETURNING r)
+INSERT INTO {dest} SELECT (moved.r).* FROM moved;"""
+
+
+def release_sql(partition, delta, dest):
+    """Drop the trigger, delta table and copy, whatever the swap left.
+
+    After a swap the copy is the partition, and the trigger and delta table
+    went with the old one."""
+    return f"""BEGIN TRANSACTION;
+DROP TRIGGER IF EXISTS {delta}_capture ON {partition};
+DROP TABLE IF EXISTS {delta};
+DROP FUNCTION IF EXISTS {delta}_capture() CASCADE;
+DROP TABLE IF EXISTS {dest};
+COMMIT;"""
+
+
+class OnlineCluster:
+    """Run the steps of an online cluster, and clean up after them.
+
+    `steps` are (step name, statement) pairs. Whether they succeed or fail,
+    the trigger, delta table, function and copy are dropped afterwards. On a
+    failure, the open transaction is rolled back first."""
+
+    def __init__(self, partition, delta, dest, steps):
+        self.partition = partition
+        self.delta = delta
+        self.dest = dest
+        self.steps = list(steps)
+
+    def __str__(self):
+        return "\n".join([*(str(statement) for _, statement in self.steps),
+                          release_sql(self.partition, self.delta, self.dest)])
+
+    def __call__(self, cursor, catalog=None):
+        failed = True
+        try:
+            for step, statement in self.steps:
+                with log_state(step=step):
+                    execute(cursor, statement, catalog=catalog)
+            failed = False
+        finally:
+            with log_state(step="online_release"):
+                if failed:
+                    _log.warning("Online cluster failed, dropping what it built", where=self.dest)
+                self.release(cursor, failed)
+
+    def release(self, cursor, failed):
+        try:
+            if failed:
+                execute(cursor, "ROLLBACK;")
+            execute(cursor, release_sql(self.partition, self.delta, self.dest))
+        except psycopg2.Error:
+            if not failed:
+                raise
+            # Don't hide why the cluster failed
+            _log.exception("Could not clean up after the online cluster", where=self.dest)
+
+
+class OnlineCatchUp:
+    """Move rows from the delta table into the copy, until few are left.
+
+    Stops after a round that moved fewer than `threshold` rows, or after
+    `rounds` rounds, whichever comes first."""
+
+    def __init__(self, delta, dest, threshold=10000, rounds=10):
+        self.delta = delta
+        self.dest = dest
+        self.threshold = threshold
+        self.rounds = rounds
+
+    def __str__(self):
+        return f"-- catch up {self.dest} from {self.delta}"
+
+    def __call__(self, cursor, catalog=None):
+        total = 0
+        for n in range(self.rounds):
+            with log_state(step="online_catch_up", where=self.dest, round=n):
+                execute(cursor, catch_up_sql(self.delta, self.dest), catalog=catalog)
+                rows = max(cursor.rowcount, 0)
+            total += rows
+            if rows < self.threshold:
+                break
+        _log.info("Caught up", where=self.dest, rounds=n + 1, rows=total)
+        return total
+
+
+class OnlineSwap:
+    """Put the copy in place of the partition, in one short transaction.
+
+    `swap` are the statements that replace the partition, run after the
+    parent is locked and the last delta rows are moved. Waits at most
+    `lock_timeout` seconds for the lock, `attempts` times."""
+
+    def __init__(self, parent, delta, dest, swap, lock_timeout=5, attempts=5):
+        self.parent = parent
+        self.delta = delta
+        self.dest = dest
+        self.swap = list(swap)
+        self.lock_timeout = lock_timeout
+        self.attempts = attempts
+
+    def __str__(self):
+        return f"-- swap {self.dest} into {self.parent}"
+
+    def __call__(self, cursor, catalog=None):
+        catch_up = OnlineCatchUp(self.delta, self.dest)
+        for attempt in range(1, self.attempts + 1):
+            with log_state(step="online_swap", where=self.dest, attempt=attempt):
+                begin = time.monotonic()
+                try:
+                    execute(cursor, "BEGIN TRANSACTION;")
+                    execute(cursor, f"SET LOCAL lock_timeout = '{self.lock_timeout}s';")
+                    execute(cursor, f"LOCK TABLE {self.parent} IN ACCESS EXCLUSIVE MODE;")
+                except psycopg2.errors.LockNotAvailable:
+                    execute(cursor, "ROLLBACK;")
+                    _log.warning("Could not lock, catching up before retrying", timeout=self.lock_timeout)
+                    catch_up(cursor, catalog=catalog)
+                    continue
+                locked = time.monotonic()
+                execute(cursor, catch_up_sql(self.delta, self.dest))
+                moved = max(cursor.rowcount, 0)
+                for statement in self.swap:
+                    execute(cursor, statement, catalog=catalog)
+                execute(cursor, "COMMIT;")
+                done = time.monotonic()
+                _log.info("Swapped partition", rows=moved, lock_seconds=round(done - begin, 3),
+                          held_seconds=round(done - locked, 3))
+                return moved
+        raise RuntimeError(f"Could not lock {self.parent} in {self.attempts} attempts")
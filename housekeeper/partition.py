@@ -1,21 +1,22 @@
 #!/usr/bin/env python3
-from .housekeeper import create_table_partition, ensure_btree_index
-from .times import months_for_year_ahead
+from .housekeeper import create_table_partition, ensure_btree_index, get_granularity
+from .times import month_parts, months_for_year_ahead
 
 
-def gen_partitions(table="history_part"):
+def gen_partitions(table="history_part", granularity="month"):
     for date in months_for_year_ahead():
-        yield from create_table_partition(
-            table=table, year=date.year, month=date.month
-        )
+        for part in month_parts(date.year, date.month, granularity):
+            yield from create_table_partition(
+                table=table, year=date.year, month=date.month, part=part
+            )
 
-        yield from ensure_btree_index(
-            table=table, year=date.year, month=date.month, concurrently=False
-        )
+            yield from ensure_btree_index(
+                table=table, year=date.year, month=date.month, part=part, concurrently=False
+            )
 
 
-def gen_partition_database():
-    tables = ("history", "history_str", "history_text", "history_uint")
+def gen_partition_database(granularity="month"):
+    tables = ("history", "history_str", "history_text", "history_uint", "trends", "trends_uint")
     yield "-- PARTITION A PRISTINE ZABBIX DATABASE"
     yield "-- WARNING: Discards all historical data"
     yield "-- generated by https://gitlab.com/ModioAB/housekeeper"
@@ -26,12 +27,12 @@ def gen_partition_database():
         yield f"CREATE TABLE {to_table} (LIKE {table}) PARTITION BY range(clock);"
         yield f"DROP TABLE {table};"
         yield f"ALTER TABLE {to_table} RENAME TO {table};"
-        yield from gen_partitions(table=table)
+        yield from gen_partitions(table=table, granularity=granularity)
     yield "END TRANSACTION;"
 
 
 def main():
-    for line in gen_partition_database():
+    for line in gen_partition_database(granularity=get_granularity()):
         print(line)
 
 
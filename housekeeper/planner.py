@@ -0,0 +1,199 @@
+"""Plan maintenance, before running anything.
+
+The plan is built from the very tasks a maintenance run would schedule (see
+housekeeper.schedule_maintenance), and the clean up the archiver does before
+it moves a partition (see archiver.migrate_statements). Their statements are
+played on a copy of the catalog snapshot, and the ones it knows would change
+nothing are left out, like helpers.execute skips them in a real run. Only the
+steps with statements left end up in the plan.
+
+Every step gets a cost estimate: DELETE statements are run through EXPLAIN,
+and statements that cannot be explained (index builds, VACUUM, CLUSTER) are
+estimated from the size of the partition.
+"""
+import os
+import json
+
+from .archiver import archive_months, migrate_statements
+from .batching import AdaptiveDelete
+from .catalog import Catalog
+from .housekeeper import INDEX_BUILDERS, format_bytes, schedule_maintenance
+from .helpers import get_table_name
+from .policy import IndexTransition, get_index_idle, index_scans
+from .scheduler import Scheduler
+
+PAGE_SIZE = 8192
+
+# How many times the partition is read for a step that cannot be explained
+REWRITE_FACTOR = {
+    "ensure_btree_index": 2.0,
+    "ensure_brin_index": 1.0,
+    "ensure_partial_index": 0.5,
+    "ensure_bloom_index": 1.0,
+    "vacuum_table": 1.0,
+    "cluster_table": 3.0,
+    "fused_cluster_table": 1.0,
+    "online_cluster_table": 1.0,
+}
+
+
+def get_cost_seconds():
+    """
+    environment variable HOUSEKEEPER_PLAN_COST_SECONDS is how many seconds
+    one unit of planner cost takes. The default matches reading a page
+    (cost 1.0) at 160 MB/s."""
+    return float(os.environ.get("HOUSEKEEPER_PLAN_COST_SECONDS", "0.00005"))
+
+
+class PlanStep:
+    def __init__(self, partition, action, statements):
+        self.partition = partition
+        self.action = action
+        self.statements = list(statements)
+        self.rows = None
+        self.cost = 0.0
+        self.seconds = 0.0
+
+
+class PlanPool:
+    """Stands in for the pool of a Scheduler whose tasks are planned, not run."""
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+
+def task_partition(key):
+    """The partition a task_key is for."""
+    table, month, step = key
+    year, month = month.split("-")
+    return get_table_name(table=table, year=int(year), month=int(month), part=step.partition(":")[2])
+
+
+def task_action(task):
+    """The generator behind a task, or its step for the index clean ups."""
+    step = task.key[-1].partition(":")[0]
+    if step in INDEX_BUILDERS:
+        return INDEX_BUILDERS[step].__name__
+    func = getattr(task.statements, "func", None)
+    if func is None or step.startswith("clean_") and step.endswith("_index"):
+        return step
+    return func.__name__
+
+
+def changes(statements, catalog):
+    """The statements that would change something, observed on `catalog`
+    as if they were run."""
+    for statement in statements:
+        if isinstance(statement, IndexTransition):
+            statement = statement.statement
+        if isinstance(statement, str):
+            if catalog.is_noop(statement):
+                continue
+            catalog.observe(statement)
+        yield statement
+
+
+def maintenance_plan(catalog: Catalog, tables, cluster=False, scans=None, start=None, archive_retention=None,
+                     trends_retention=None):
+    """The steps a maintenance run as of `start` would take, and the clean up
+    before archiving after `archive_retention` and `trends_retention` days,
+    in the order they would be run."""
+    catalog = catalog.copy()
+    sched = Scheduler(PlanPool(catalog))
+    schedule_maintenance(sched, tables, cluster=cluster, scans=scans, start=start)
+    for task in sched.tasks.values():
+        if task.statements is not None:
+            statements = list(changes(task.statements(), catalog))
+            if statements:
+                yield PlanStep(task_partition(task.key), task_action(task), statements)
+
+    for table, date, retention in archive_months(archive_retention, trends_retention):
+        statements = migrate_statements(catalog, table, date, retention)
+        statements = list(changes(statements or (), catalog))
+        if statements:
+            name = get_table_name(table=table, year=date.year, month=date.month)
+            yield PlanStep(name, "migrate_cleanup", statements)
+
+
+def explain(curs, statement):
+    """Return (rows, total cost) from the planner."""
+    curs.execute(f"EXPLAIN (FORMAT JSON) {statement}")
+    result = curs.fetchone()[0]
+    if isinstance(result, str):
+        result = json.loads(result)
+    plan = result[0]["Plan"]
+    cost = plan["Total Cost"]
+    # The DELETE node itself returns no rows, the rows to delete come from
+    # the scan below it.
+    while plan["Node Type"] == "ModifyTable" and plan.get("Plans"):
+        plan = plan["Plans"][0]
+    return plan["Plan Rows"], cost
+
+
+def estimate(pool, catalog, steps):
+    """Fill in row and cost estimates for each step."""
+    cost_seconds = get_cost_seconds()
+    with pool.cursor() as curs:
+        for step in steps:
+            rel = catalog.relations.get(step.partition)
+            pages = rel.size / PAGE_SIZE if rel is not None else 0
+            for statement in step.statements:
+                if isinstance(statement, AdaptiveDelete):
+                    # Explained as one DELETE over its whole range
+                    statement = statement.template(statement.start, statement.stop)
+                elif callable(statement):
+                    # Runs its own statements, counted by the rewrite factor
+                    continue
+                verb = statement.lstrip().split(None, 1)[0].upper()
+                if verb == "DELETE" and rel is not None:
+                    rows, cost = explain(curs, statement)
+                    step.rows = (step.rows or 0) + rows
+                    step.cost += cost
+                elif verb == "VACUUM":
+                    step.cost += pages * REWRITE_FACTOR["vacuum_table"]
+            # The rewrite itself is counted once, however many statements
+            step.cost += pages * REWRITE_FACTOR.get(step.action, 0.0)
+            step.seconds = step.cost * cost_seconds
+    return steps
+
+
+def format_seconds(seconds):
+    hours, rest = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def print_plan(steps, catalog, workers=1):
+    print(f"{'partition':<32} {'step':<24} {'size':>10} {'rows':>12} {'cost':>14} {'runtime':>10}")
+    total = 0.0
+    for step in steps:
+        rel = catalog.relations.get(step.partition)
+        size = format_bytes(rel.size) if rel is not None else "-"
+        rows = "-" if step.rows is None else f"{step.rows:.0f}"
+        print(
+            f"{step.partition:<32} {step.action:<24} {size:>10} {rows:>12} "
+            f"{step.cost:>14.0f} {format_seconds(step.seconds):>10}"
+        )
+        total += step.seconds
+    print(f"{len(steps)} steps, projected runtime {format_seconds(total)}", end="")
+    if workers > 1:
+        print(f", about {format_seconds(total / workers)} with {workers} workers", end="")
+    print()
+
+
+def plan(pool, tables, cluster=False, workers=1):
+    """Print what maintenance would do, with estimates, without doing it."""
+    retention = os.environ.get("MODIO_ARCHIVE")
+    archive_retention = int(retention) if retention else None
+    retention = os.environ.get("MODIO_ARCHIVE_TRENDS")
+    trends_retention = int(retention) if retention else None
+    catalog = pool.catalog or pool.load_catalog()
+    scans = None
+    if get_index_idle():
+        with pool.connection() as conn:
+            scans = index_scans(conn)
+    steps = list(maintenance_plan(catalog, tables, cluster=cluster, scans=scans, archive_retention=archive_retention,
+                                  trends_retention=trends_retention))
+    estimate(pool, catalog, steps)
+    print_plan(steps, catalog, workers=workers)
+    return steps
@@ -0,0 +1,179 @@
+"""Which indexes a partition has, as it gets older.
+
+A policy is a list of stages, each with the index kinds a partition has
+while it is younger than the age (in months) of the stage:
+
+    btree+brin:3,brin
+
+keeps a btree and a BRIN index on the current month and the two before it,
+and only the BRIN index after that, which is what maintenance has always
+done. The last stage has no age, "none" is a stage without indexes:
+
+    btree+brin:3,partial+brin:6,brin:24,none
+
+The kinds are:
+
+btree:   (itemid, clock), what Zabbix queries use while a month is written.
+         Only built on the current and future months, older months keep the
+         one they have.
+brin:    (itemid, clock), see brin.py.
+partial: A btree on (itemid, clock) of the last FAST_WINDOW days of the
+         partition, for the graphs that keep reading the end of a month.
+bloom:   On the value of history_str and history_text, for lookups by value.
+         Needs the bloom extension.
+
+HOUSEKEEPER_INDEX_POLICY sets the policy of all tables, and
+HOUSEKEEPER_INDEX_POLICY_<TABLE> (like HOUSEKEEPER_INDEX_POLICY_HISTORY_TEXT)
+that of one table.
+
+With HOUSEKEEPER_INDEX_IDLE=on, a past month moves on to its next stage
+early when the indexes it would drop have not been scanned since they were
+built (or the statistics were reset), as nothing uses them.
+
+Every index built or dropped is logged with the time it took and its size,
+and with HOUSEKEEPER_JOURNAL set, recorded in the journal, where
+`housekeeper transitions` lists them.
+"""
+import os
+import time
+
+import structlog
+
+from .helpers import execute, get_index_name
+from .logs import log_state
+
+_log = structlog.get_logger(__name__)
+
+KINDS = ("btree", "brin", "partial", "bloom")
+DEFAULT_POLICY = "btree+brin:3,brin"
+# Tables with a text value column, that bloom can index
+STRING_TABLES = ("history_str", "history_text")
+IDLE_MODES = ("off", "on")
+
+
+class Stage:
+    def __init__(self, kinds, until=None):
+        self.kinds = frozenset(kinds)
+        # Age in months the partition stays in this stage, None for ever
+        self.until = until
+
+    def __repr__(self):
+        kinds = "+".join(k for k in KINDS if k in self.kinds) or "none"
+        return kinds if self.until is None else f"{kinds}:{self.until}"
+
+    def __eq__(self, other):
+        return (self.kinds, self.until) == (other.kinds, other.until)
+
+
+def parse_policy(text, table=None):
+    """The stages of a policy, see the module docstring."""
+    stages = []
+    for spec in text.replace(" ", "").split(","):
+        kinds, _, until = spec.partition(":")
+        kinds = set() if kinds == "none" else set(kinds.split("+"))
+        unknown = kinds - set(KINDS)
+        if unknown:
+            raise ValueError(f"Unknown index kinds {sorted(unknown)} in policy {text!r}, use {KINDS} or none")
+        if "bloom" in kinds and table is not None and table not in STRING_TABLES:
+            raise ValueError(f"bloom indexes the value of {STRING_TABLES}, not {table}")
+        stages.append(Stage(kinds, int(until) if until else None))
+
+    ages = [stage.until for stage in stages[:-1]]
+    if None in ages or stages[-1].until is not None:
+        raise ValueError(f"Only the last stage of policy {text!r} has no age")
+    if ages != sorted(set(ages)) or (ages and ages[0] < 1):
+        raise ValueError(f"The ages of policy {text!r} must grow from 1 month")
+    return stages
+
+
+def get_index_policy(table):
+    """
+    environment variable HOUSEKEEPER_INDEX_POLICY_<TABLE>, or for all tables
+    HOUSEKEEPER_INDEX_POLICY, is the index policy, by default
+    "btree+brin:3,brin"."""
+    text = os.environ.get(f"HOUSEKEEPER_INDEX_POLICY_{table.upper()}")
+    if text is None:
+        text = os.environ.get("HOUSEKEEPER_INDEX_POLICY", DEFAULT_POLICY)
+    return parse_policy(text, table=table)
+
+
+def get_index_idle():
+    """
+    environment variable HOUSEKEEPER_INDEX_IDLE is "on" to move past months
+    on to their next stage once the indexes they would drop are unused, or
+    "off" (the default)."""
+    mode = os.environ.get("HOUSEKEEPER_INDEX_IDLE", "off")
+    if mode not in IDLE_MODES:
+        raise ValueError(f"HOUSEKEEPER_INDEX_IDLE must be one of {IDLE_MODES}")
+    return mode == "on"
+
+
+def index_scans(conn):
+    """Index name: the number of scans of it."""
+    with conn.cursor() as curs:
+        curs.execute("SELECT indexrelname, idx_scan FROM pg_stat_user_indexes;")
+        return dict(curs.fetchall())
+
+
+def stage_for(policy, age, scans=None, **kws):
+    """The stage of a partition `age` months old, 0 for the current month.
+
+    With `scans` (see index_scans), a past partition whose indexes to drop
+    next have all gone unscanned is in the next stage already. `kws` are the
+    table, year, month and part that name its indexes."""
+    n = next(n for n, stage in enumerate(policy) if stage.until is None or age < stage.until)
+    if scans is not None and age >= 1 and n + 1 < len(policy):
+        dropped = policy[n].kinds - policy[n + 1].kinds
+        names = [get_index_name(kind=kind, **kws) for kind in dropped]
+        if names and all(scans.get(name) == 0 for name in names):
+            _log.info("Unused indexes, moving on", indexes=names, stage=repr(policy[n + 1]))
+            n += 1
+    return policy[n]
+
+
+def wanted_kinds(stage, age):
+    """The kinds to build on a partition in `stage`. Past months are not
+    written any more, and only keep a btree they already have."""
+    return [k for k in KINDS if k in stage.kinds and not (k == "btree" and age >= 1)]
+
+
+class IndexTransition:
+    """Build or drop an index, logging the time it took and the size it
+    added or freed, and recording them in the journal.
+
+    Statements the catalog knows would not change anything are skipped,
+    and are not recorded."""
+
+    def __init__(self, statement, table, index, kind, journal=None):
+        self.statement = statement
+        self.table = table
+        self.index = index
+        self.kind = kind
+        self.journal = journal
+
+    def __str__(self):
+        return self.statement
+
+    def _size(self, cursor):
+        cursor.execute("SELECT pg_relation_size(to_regclass(%s));", (self.index,))
+        return cursor.fetchone()[0] or 0
+
+    def __call__(self, cursor, catalog=None):
+        if catalog is not None and catalog.is_noop(self.statement):
+            return execute(cursor, self.statement, catalog=catalog)
+        dropping = self.statement.lstrip().upper().startswith("DROP")
+        action = "drop" if dropping else "build"
+        with log_state(step=f"{action}_{self.kind}_index", index=self.index):
+            before = self._size(cursor)
+            start = time.monotonic()
+            result = execute(cursor, self.statement, catalog=catalog)
+            seconds = time.monotonic() - start
+            after = self._size(cursor)
+            if before == after:
+                # IF [NOT] EXISTS found nothing to do
+                return result
+            _log.info("Index transition", action=action, kind=self.kind, bytes=after - before,
+                      seconds=round(seconds, 3))
+            if self.journal is not None:
+                self.journal.record_transition(self.table, self.index, self.kind, action, after - before, seconds)
+        return result
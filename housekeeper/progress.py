@@ -0,0 +1,172 @@
+"""Log the progress of long statements while they run.
+
+CREATE INDEX, CLUSTER, VACUUM, ANALYZE and COPY report how far they are in
+the pg_stat_progress_* views. helpers.execute runs them inside `watch`, which
+starts a thread that waits one interval, and if the statement still runs,
+polls the views for the backend running it on a connection of its own. Each
+poll logs the phase, the blocks (or tuples, or bytes) done of the total, the
+rate since the phase started, and an ETA at that rate.
+
+Statements that finish within the interval never open a connection.
+"""
+import contextvars
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+import psycopg2
+import structlog
+
+_log = structlog.get_logger(__name__)
+
+# Statements that report their progress to one of the VIEWS
+WATCHED = ("CREATE INDEX", "CREATE UNIQUE INDEX", "REINDEX", "CLUSTER", "VACUUM", "ANALYZE", "COPY")
+
+# (server version, view, SQL of (phase, done, total, unit) for a backend)
+VIEWS = (
+    (120000, "create_index", """
+        SELECT phase,
+            CASE WHEN blocks_total > 0 THEN blocks_done ELSE tuples_done END,
+            CASE WHEN blocks_total > 0 THEN blocks_total ELSE tuples_total END,
+            CASE WHEN blocks_total > 0 THEN 'blocks' ELSE 'tuples' END
+        FROM pg_stat_progress_create_index WHERE pid = %(pid)s"""),
+    # VACUUM FULL reports here too. Scanning through an index has no block
+    # count, then the estimated rows are the total.
+    (120000, "cluster", """
+        SELECT phase,
+            CASE WHEN phase = 'seq scanning heap' THEN heap_blks_scanned ELSE heap_tuples_scanned END,
+            CASE WHEN phase = 'seq scanning heap' THEN heap_blks_total
+                 ELSE (SELECT greatest(reltuples, 0)::bigint FROM pg_class WHERE oid = relid) END,
+            CASE WHEN phase = 'seq scanning heap' THEN 'blocks' ELSE 'tuples' END
+        FROM pg_stat_progress_cluster WHERE pid = %(pid)s"""),
+    (120000, "vacuum", """
+        SELECT phase,
+            CASE WHEN phase = 'vacuuming heap' THEN heap_blks_vacuumed ELSE heap_blks_scanned END,
+            heap_blks_total,
+            'blocks'
+        FROM pg_stat_progress_vacuum WHERE pid = %(pid)s"""),
+    (130000, "analyze", """
+        SELECT phase, sample_blks_scanned, sample_blks_total, 'blocks'
+        FROM pg_stat_progress_analyze WHERE pid = %(pid)s"""),
+    # COPY FROM STDIN and TO STDOUT have no total
+    (140000, "copy", """
+        SELECT command, bytes_processed, bytes_total, 'bytes'
+        FROM pg_stat_progress_copy WHERE pid = %(pid)s"""),
+)
+
+
+def get_progress_interval():
+    """
+    environment variable HOUSEKEEPER_PROGRESS_INTERVAL is the seconds between
+    progress lines of a long statement. Defaults to 30, 0 turns them off."""
+    interval = float(os.environ.get("HOUSEKEEPER_PROGRESS_INTERVAL", "30"))
+    if interval < 0:
+        raise ValueError("HOUSEKEEPER_PROGRESS_INTERVAL must be 0 or more.")
+    return interval
+
+
+def is_watched(query):
+    words = " ".join(str(query).split()[:3]).upper()
+    return words.startswith(WATCHED)
+
+
+def progress_sql(server_version):
+    """One query over the views of this server version."""
+    parts = [f"SELECT '{view}' AS view, * FROM ({sql}) AS {view}_progress"
+             for version, view, sql in VIEWS if server_version >= version]
+    return "\nUNION ALL\n".join(parts) + ";"
+
+
+class Estimate:
+    """Percent, rate and ETA from successive samples of a progress view.
+
+    The rate is taken over the current phase, as the phases of a statement
+    count different things at different speeds.
+    """
+
+    def __init__(self):
+        self.phase = None
+        self.first = (0, 0.0)
+
+    def update(self, view, phase, done, total, now):
+        if (view, phase) != self.phase:
+            self.phase = (view, phase)
+            self.first = (done, now)
+        first_done, first_time = self.first
+        rate = round((done - first_done) / (now - first_time), 1) if now > first_time else None
+        found = {"percent": None, "rate": rate, "eta_seconds": None}
+        if total:
+            # Totals from reltuples are estimates
+            found["percent"] = round(min(100.0 * done / total, 100.0), 1)
+            if rate:
+                found["eta_seconds"] = round(max(total - done, 0) / rate)
+        return found
+
+
+class ProgressMonitor:
+    def __init__(self, conn, query, interval):
+        self.pid = conn.info.backend_pid
+        self.server_version = conn.server_version
+        params = dict(conn.info.dsn_parameters)
+        if conn.info.password:
+            params["password"] = conn.info.password
+        self.params = params
+        self.query = query
+        self.interval = interval
+        self.estimate = Estimate()
+        self._done = threading.Event()
+        # The log lines carry the step of the statement
+        ctx = contextvars.copy_context()
+        self._thread = threading.Thread(target=ctx.run, args=(self._run,), daemon=True,
+                                        name=f"progress-{self.pid}")
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._done.set()
+        self._thread.join()
+
+    def _run(self):
+        if self._done.wait(self.interval):
+            return
+        log = _log.bind(pid=self.pid, query=self.query)
+        try:
+            conn = psycopg2.connect(**self.params)
+        except psycopg2.Error as exc:
+            log.warning("Cannot watch progress", error=str(exc))
+            return
+        try:
+            conn.set_session(autocommit=True)
+            sql = progress_sql(self.server_version)
+            while True:
+                with conn.cursor() as curs:
+                    curs.execute(sql, {"pid": self.pid})
+                    rows = curs.fetchall()
+                now = time.monotonic()
+                for view, phase, done, total, unit in rows:
+                    log.info("Progress", view=view, phase=phase, done=done, total=total, unit=unit,
+                             **self.estimate.update(view, phase, done, total, now))
+                if self._done.wait(self.interval):
+                    return
+        except psycopg2.Error as exc:
+            log.warning("Stopped watching progress", error=str(exc))
+        finally:
+            conn.close()
+
+
+@contextmanager
+def watch(conn, query):
+    """Log the progress of `query` on `conn` while the block runs it."""
+    interval = get_progress_interval()
+    if not interval or not is_watched(query):
+        yield
+        return
+    monitor = ProgressMonitor(conn, query, interval)
+    monitor.start()
+    try:
+        yield
+    finally:
+        monitor.stop()
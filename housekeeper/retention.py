@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""Expire history by dropping whole partitions.
+
+A month (or week, or day, see HOUSEKEEPER_GRANULARITY) is expired when all
+of it is older than HOUSEKEEPER_RETENTION days. Its partition is then detached and dropped (or truncated, with
+HOUSEKEEPER_RETENTION_MODE=truncate), which takes the same short time however
+many rows it holds, where deleting the rows would scan all of them.
+
+The trends tables, once partitioned, expire after their own
+HOUSEKEEPER_TRENDS_RETENTION days. Without it they are left alone.
+
+When archiving (MODIO_ARCHIVE, or MODIO_ARCHIVE_TRENDS for the trends), the
+archived partitions (foreign tables, see archiver.py) expire as well: their
+table is dropped (or truncated) on the archive, through the ARCHIVE_PG*
+connection, and then the foreign table here. A local partition past
+retention has not been moved to the archive yet, and holds the only copy of
+its data, so it is kept until the archiver has replaced it.
+
+Detached tables of a table, left behind by an interrupted archiver or
+retention run, may be the only copy of their month too. They are listed in
+the log, never dropped.
+"""
+import os
+import re
+import sys
+import datetime
+
+import structlog
+
+from .archiver import FOREIGN_NAMES
+from .helpers import ConnectionPool, archive_connstring, housekeeper_connstring
+from .housekeeper import FAST_WINDOW, HISTORY_TABLES, TRENDS_TABLES, format_bytes, role_msg
+from .logs import setup_logging, log_state
+from .metrics import METRICS
+from .times import get_start_and_stop, timestamp
+from .tracing import TRACER
+
+_log = structlog.get_logger(__name__)
+
+MODES = ("drop", "truncate")
+
+
+def get_retention():
+    """
+    environment variable HOUSEKEEPER_RETENTION in days is how old data may get
+    before its partition is removed. It has to be longer than the fast window,
+    and when archiving, longer than MODIO_ARCHIVE."""
+    retention = os.environ.get("HOUSEKEEPER_RETENTION")
+    if retention is None:
+        print("Set environment variable HOUSEKEEPER_RETENTION to amount of days to keep")
+        raise SystemExit(1)
+    retention = int(retention)
+    check_retention(retention, archive=os.environ.get("MODIO_ARCHIVE"))
+    return retention
+
+
+def get_trends_retention():
+    """
+    environment variable HOUSEKEEPER_TRENDS_RETENTION in days is how old
+    trends may get before their partition is removed, checked like
+    HOUSEKEEPER_RETENTION against MODIO_ARCHIVE_TRENDS. When it is not set,
+    trends are kept."""
+    retention = os.environ.get("HOUSEKEEPER_TRENDS_RETENTION")
+    if retention is None:
+        return None
+    retention = int(retention)
+    check_retention(retention, archive=os.environ.get("MODIO_ARCHIVE_TRENDS"))
+    return retention
+
+
+def get_mode():
+    """
+    environment variable HOUSEKEEPER_RETENTION_MODE is "drop" (the default)
+    to drop expired partitions, or "truncate" to keep them empty."""
+    mode = os.environ.get("HOUSEKEEPER_RETENTION_MODE", "drop")
+    if mode not in MODES:
+        raise ValueError(f"HOUSEKEEPER_RETENTION_MODE must be one of {MODES}")
+    return mode
+
+
+def check_retention(retention, archive=None):
+    """Refuse a retention that would remove the fast window, or data that the
+    archiver has yet to move."""
+    if retention <= FAST_WINDOW:
+        raise ValueError(f"Retention of {retention} days would remove the {FAST_WINDOW} day fast window")
+    if archive is not None and retention <= int(archive):
+        raise ValueError(f"Retention of {retention} days would remove data before it is archived "
+                         f"after MODIO_ARCHIVE={archive} days")
+
+
+def partition_month(table, name):
+    """The first day of the month of a partition of `table`, and the week or
+    day part of it ("" for a whole month), or None."""
+    m = re.fullmatch(rf"{table}_y(\d{{4}})m(\d{{2}})(w\d|d\d\d)?", name)
+    if m is None:
+        return None
+    return datetime.date(year=int(m.group(1)), month=int(m.group(2)), day=1), m.group(3) or ""
+
+
+def expired_partitions(catalog, retention, today, tables=HISTORY_TABLES, archive=None):
+    """(table, relation, date) of the partitions with only expired data.
+
+    Week and day partitions expire on their own. Only partitions attached to
+    their table are included, see leftover_tables for the detached ones. With
+    `archive`, the archived (foreign) partitions are included, and the local
+    partitions the archiver has not moved yet are left out."""
+    check_retention(retention, archive=archive)
+    cutoff = timestamp(today) - retention * 86400
+    for table in tables:
+        for rel in sorted(catalog.relations.values(), key=lambda r: r.name):
+            if rel.kind == "f":
+                found = partition_month(FOREIGN_NAMES[table], rel.name) if archive is not None else None
+            else:
+                found = partition_month(table, rel.name)
+            if found is None or rel.kind not in ("r", "f") or rel.parent != table:
+                continue
+            date, part = found
+            _, stop = get_start_and_stop(year=date.year, month=date.month, part=part)
+            if stop > cutoff:
+                continue
+            if archive is not None and rel.kind == "r":
+                # The archiver detaches the partition when it puts the
+                # foreign table in its place, one still attached is not moved.
+                _log.warning("Keeping expired partition, it is not archived yet", partition=rel.name)
+                continue
+            yield table, rel, date
+
+
+def leftover_tables(catalog, tables=HISTORY_TABLES):
+    """The partition tables of `tables` that are not attached to them."""
+    for table in tables:
+        for rel in sorted(catalog.relations.values(), key=lambda r: r.name):
+            if rel.kind == "r" and rel.parent is None and partition_month(table, rel.name) is not None:
+                yield rel
+
+
+def remove_partition(table, rel, mode="drop"):
+    """Remove the data of a partition without touching its rows. The data of
+    an archived partition is on the archive, see remove_archived."""
+    if mode == "truncate":
+        if rel.kind != "f":
+            yield f"TRUNCATE TABLE {rel.name};"
+        return
+
+    def query():
+        yield "BEGIN TRANSACTION;"
+        if rel.parent == table:
+            yield f"ALTER TABLE {table} DETACH PARTITION {rel.name};"
+        if rel.kind == "f":
+            yield f"DROP FOREIGN TABLE {rel.name};"
+        else:
+            yield f"DROP TABLE {rel.name};"
+        yield "COMMIT;"
+
+    yield "\n".join(query())
+
+
+def remove_archived(rel, mode="drop"):
+    """Remove the data of an archived partition on the archive. It goes
+    first, so a run that stops half way finds the foreign table still there,
+    and finishes the job on the next run."""
+    if mode == "truncate":
+        yield f"TRUNCATE TABLE {rel.name};"
+    else:
+        yield f"DROP TABLE IF EXISTS {rel.name};"
+
+
+def expire(pool, retention, mode="drop", dry_run=False, today=None, trends_retention=None, archive=None,
+           trends_archive=None, archive_pool=None):
+    """Remove the expired partitions, or with `dry_run` only list them.
+
+    The archived partitions are removed on `archive_pool` too."""
+    if today is None:
+        today = datetime.datetime.utcnow().date()
+    found = list(expired_partitions(pool.catalog, retention, today, archive=archive))
+    tables = HISTORY_TABLES
+    if trends_retention is not None:
+        found += expired_partitions(pool.catalog, trends_retention, today, tables=TRENDS_TABLES,
+                                    archive=trends_archive)
+        tables += TRENDS_TABLES
+    if archive_pool is None and not dry_run and any(rel.kind == "f" for _, rel, _ in found):
+        raise ValueError("Expiring archived partitions needs the archive connection")
+    for rel in leftover_tables(pool.catalog, tables):
+        _log.warning("Detached partition left behind, check it and drop it by hand", partition=rel.name,
+                     size=format_bytes(rel.size), rows=rel.rows)
+    if dry_run:
+        print(f"-- retention {retention} days, trends {trends_retention or '-'} days, mode {mode}, "
+              f"{len(found)} partitions")
+        print(f"-- {'partition':<32} {'size':>10} {'rows':>14}")
+    for table, rel, date in found:
+        if dry_run:
+            print(f"-- {rel.name:<32} {format_bytes(rel.size):>10} {rel.rows:>14}")
+        with log_state(step="retention", partition=rel.name, mode=mode):
+            if rel.kind == "f":
+                for x in remove_archived(rel, mode=mode):
+                    if dry_run:
+                        print(f"-- on the archive\n{x}")
+                    else:
+                        archive_pool.execute(x)
+            for x in remove_partition(table, rel, mode=mode):
+                if dry_run:
+                    print(x)
+                else:
+                    pool.execute(x)
+    _log.info("Expired partitions", partitions=len(found), dry_run=dry_run)
+    return found
+
+
+def main():
+    setup_logging()
+    role_msg()
+    command = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if command not in ("run", "dry-run"):
+        print(f"Usage: {sys.argv[0]} {{ run | dry-run }}")
+        print("")
+        print("run:     Removes the partitions older than HOUSEKEEPER_RETENTION days (default command)")
+        print("dry-run: Prints the partitions and SQL that run would remove, without removing anything")
+        print("-")
+        print("set the number of days to keep with 'HOUSEKEEPER_RETENTION' (longer than the 14 day fast window)")
+        print("set the number of days to keep trends with 'HOUSEKEEPER_TRENDS_RETENTION' (default: keep them)")
+        print("set 'HOUSEKEEPER_RETENTION_MODE' to drop (default) or truncate")
+        sys.exit(1)
+
+    retention = get_retention()
+    trends_retention = get_trends_retention()
+    mode = get_mode()
+    archive = os.environ.get("MODIO_ARCHIVE")
+    trends_archive = os.environ.get("MODIO_ARCHIVE_TRENDS")
+    archiving = archive is not None or (trends_archive is not None and trends_retention is not None)
+    # The archived partitions expire on the archive as well
+    archive_pool = ConnectionPool(archive_connstring()) if archiving else None
+    success = False
+    try:
+        with ConnectionPool(housekeeper_connstring()) as pool:
+            pool.load_catalog()
+            expire(pool, retention, mode=mode, dry_run=command == "dry-run", trends_retention=trends_retention,
+                   archive=archive, trends_archive=trends_archive, archive_pool=archive_pool)
+        success = True
+    finally:
+        if archive_pool is not None:
+            archive_pool.close()
+        METRICS.write("retention", success=success)
+        TRACER.write("retention")
+
+
+if __name__ == "__main__":
+    main()
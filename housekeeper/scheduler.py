@@ -0,0 +1,193 @@
+"""Run SQL generating steps as a dependency graph on a pool of workers.
+
+Each task is a function returning an iterator of SQL statements, like the
+generators in housekeeper.py. A task only starts when all the tasks it
+requires have finished, and at most `workers` tasks run at the same time, each
+task on its own connection from a helpers.ConnectionPool. Tasks can be put
+in a group, and `limits` caps how many tasks of a group run at the same time.
+
+The structlog contextvars (see logs.log_state) are copied when a task is
+added, and each task runs in its own copy of them, so the log lines from a
+worker carry the same context as if the statements were executed in line.
+"""
+import os
+import threading
+import contextvars
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import structlog
+
+from .helpers import execute, log_and_reset_notices
+from .logs import log_state
+from .tracing import TRACER
+
+_log = structlog.get_logger(__name__)
+
+
+def get_workers():
+    """
+    environment variable HOUSEKEEPER_WORKERS decides how many statements may
+    run at the same time, each on its own connection. Defaults to 1."""
+    workers = os.environ.get("HOUSEKEEPER_WORKERS", "1")
+    workers = int(workers)
+    if workers < 1:
+        raise ValueError("HOUSEKEEPER_WORKERS must be 1 or more.")
+    return workers
+
+
+def task_key(table, date, step, part=""):
+    """Key for a step on a partition, used to express dependencies. Steps on
+    the week or day partitions of a month share its first two elements."""
+    if part:
+        step = f"{step}:{part}"
+    return (table, f"{date.year}-{date.month:02d}", step)
+
+
+class Task:
+    def __init__(self, key, action, requires=(), group=None, statements=None):
+        self.key = key
+        self.action = action
+        self.requires = tuple(requires)
+        self.group = group
+        # The contextvars where the task was added, it runs in a copy of them
+        self.context = contextvars.copy_context()
+        # The SQL generator of a statement task, see planner.py
+        self.statements = statements
+
+    def __repr__(self):
+        return f"Task({'/'.join(self.key)})"
+
+
+class Scheduler:
+    """Collects tasks and runs them in dependency order.
+
+    Tasks are added with `add` or `add_statements`, and nothing runs until
+    `run` is called. Requiring a key that was never added is an error, as it
+    would otherwise silently never run.
+    """
+
+    def __init__(self, pool, workers=1, limits=None):
+        self.pool = pool
+        self.workers = workers
+        self.limits = dict(limits or {})
+        self.tasks = {}
+        self._local = threading.local()
+
+    def add(self, key, action, requires=(), group=None):
+        """Add a task that calls `action()` in a worker."""
+        if key in self.tasks:
+            raise ValueError(f"Duplicate task {key}")
+        self.tasks[key] = Task(key, action, requires, group)
+        return key
+
+    def add_statements(self, key, statements, requires=(), group=None):
+        """Add a task that executes the SQL from `statements()` in a worker.
+
+        `statements` is called in the worker, so that the log_state of the
+        generator is bound in the worker's context.
+        """
+        def action():
+            with self.pool.connection() as conn:
+                self._local.conn = conn
+                try:
+                    for x in statements():
+                        with conn.cursor() as curs:
+                            execute(curs, x, catalog=self.pool.catalog)
+                        log_and_reset_notices(conn)
+                finally:
+                    self._local.conn = None
+        self.add(key, action, requires, group)
+        self.tasks[key].statements = statements
+        return key
+
+    def connection(self):
+        """The connection of the statement task running in this thread, or
+        None outside of one."""
+        return getattr(self._local, "conn", None)
+
+    def _check(self):
+        for task in self.tasks.values():
+            for key in task.requires:
+                if key not in self.tasks:
+                    raise ValueError(f"{task} requires unknown task {key}")
+
+    def _has_room(self, task, running):
+        """Whether a worker, and a place in the task's group, is free."""
+        if len(running) >= self.workers:
+            return False
+        limit = self.limits.get(task.group)
+        if limit is None:
+            return True
+        return sum(1 for t in running.values() if t.group == task.group) < limit
+
+    def run(self):
+        """Run all tasks, then raise the first error, if any.
+
+        When a task fails, the tasks depending on it are skipped, while
+        unrelated tasks keep running to completion. Of the tasks that are
+        ready, those added first start first.
+        """
+        self._check()
+        pending = dict(self.tasks)
+        running = {}
+        done = set()
+        failed = set()
+        errors = []
+
+        log = _log.bind(workers=self.workers, tasks=len(pending))
+        log.info("Starting tasks")
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="housekeeper") as pool:
+            while pending or running:
+                self._skip_failed(pending, failed, log)
+                for key, task in list(pending.items()):
+                    if all(r in done for r in task.requires) and self._has_room(task, running):
+                        # A context can only be entered by one thread at a
+                        # time, so each task runs in a copy of its own.
+                        ctx = task.context.copy()
+                        future = pool.submit(ctx.run, self._run_task, task)
+                        running[future] = task
+                        del pending[key]
+
+                if not running:
+                    if pending:
+                        raise ValueError(f"Circular task requirements in {list(pending)}")
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    exc = future.exception()
+                    if exc is None:
+                        done.add(task.key)
+                    else:
+                        failed.add(task.key)
+                        errors.append(exc)
+
+        log.info("Tasks done", done=len(done), failed=len(failed))
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def _skip_failed(pending, failed, log):
+        """Skip the pending tasks that depend on a failed one, however
+        indirectly, whatever order they were added in."""
+        skipped = True
+        while skipped:
+            skipped = False
+            for key, task in list(pending.items()):
+                if any(r in failed for r in task.requires):
+                    log.warning("Skipping task, requirement failed", task=key)
+                    failed.add(key)
+                    del pending[key]
+                    skipped = True
+
+    def _run_task(self, task):
+        # Keys from task_key put the task in the span of its table and month
+        attrs = dict(zip(("table", "month"), task.key[:-1]))
+        with log_state(task="/".join(task.key)), TRACER.span("step", task.key[-1], **attrs):
+            try:
+                task.action()
+            except Exception:
+                _log.exception("Task failed")
+                raise
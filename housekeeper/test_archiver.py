@@ -0,0 +1,167 @@
+import os
+import struct
+import unittest
+
+from unittest import mock
+
+import psycopg2.errors
+
+from .archiver import (
+    DayChecksums,
+    RateLimit,
+    archive_months,
+    checksum_mismatches,
+    copy_relay,
+    prune_archive,
+    range_select,
+    set_layout,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestRateLimit(unittest.TestCase):
+    def test_takes_are_spread_at_the_rate(self):
+        clock = FakeClock()
+        throttle = RateLimit(1000, clock=clock, sleep=clock.sleep)
+        for _ in range(10):
+            throttle.take(500)
+        # The first take is let through at once, the other nine wait
+        assert clock.now == 104.5
+
+    def test_idle_time_is_not_saved_up(self):
+        clock = FakeClock()
+        throttle = RateLimit(1000, clock=clock, sleep=clock.sleep)
+        clock.now += 60
+        throttle.take(1000)
+        throttle.take(1000)
+        assert clock.now == 161.0
+
+
+class TestChecksums(unittest.TestCase):
+    def test_mismatches_are_the_days_that_differ(self):
+        source = {20000: (10, 123), 20001: (5, 77), 20002: (1, 9)}
+        archive = {20000: (10, 123), 20001: (5, 78), 20003: (1, 9)}
+        assert checksum_mismatches(source, archive) == [20001, 20002, 20003]
+        assert checksum_mismatches(source, dict(source)) == []
+
+    def sums(self, data, binary, chunk):
+        checksums = DayChecksums(1, binary=binary)
+        for n in range(0, len(data), chunk):
+            checksums.update(data[n:n + chunk])
+        return checksums.days
+
+    def test_rows_are_summed_however_the_stream_is_cut(self):
+        text = b"1\t86400\t1.5\n2\t86401\t\\N\n1\t172800\t2\n"
+        days = self.sums(text, False, len(text))
+        assert {day: rows for day, (rows, _) in days.items()} == {1: 2, 2: 1}
+        assert self.sums(text, False, 1) == days
+        # In another order, the sums are the same
+        assert self.sums(b"1\t172800\t2\n2\t86401\t\\N\n1\t86400\t1.5\n", False, 7) == days
+
+    def test_binary_rows(self):
+        def row(itemid, clock):
+            return struct.pack("!hiiii", 2, 4, itemid, 4, clock)
+
+        data = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!II", 0, 0)
+        data += row(1, 86400) + row(2, -1) + row(1, 172800)
+        # A NULL makes a row of another layout
+        data += struct.pack("!hiiiii", 3, 4, 3, 4, 86400, -1) + row(3, 86401) + struct.pack("!h", -1)
+        days = self.sums(data, True, len(data))
+        assert {day: rows for day, (rows, _) in days.items()} == {1: 3, -1: 1, 2: 1}
+        assert self.sums(data, True, 3) == days
+        assert self.sums(data, True, 30) == days
+
+
+class FakeCopyConnection:
+    """Its COPY writes `rows` lines to the file, or reads a little from it
+    and fails with `error`."""
+
+    def __init__(self, rows=0, error=None):
+        self.rows = rows
+        self.error = error
+        self.rowcount = rows
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def copy_expert(self, query, f, size=8192):
+        if self.error is not None:
+            f.read(10)
+            raise self.error
+        for n in range(self.rows):
+            f.write(b"1\t%d\t0.5\t0\n" % n)
+
+
+class TestCopyRelay(unittest.TestCase):
+    def test_archive_error_is_raised_over_the_broken_pipe(self):
+        src = FakeCopyConnection(rows=1000000)
+        dst = FakeCopyConnection(error=psycopg2.errors.DiskFull("could not extend file"))
+        with mock.patch.dict(os.environ, HOUSEKEEPER_PROGRESS_INTERVAL="0"):
+            with self.assertRaises(psycopg2.errors.DiskFull) as raised:
+                copy_relay(src, dst, "COPY history_y2018m02 TO STDOUT", "COPY archive_y2018m02 FROM STDIN")
+        assert isinstance(raised.exception.__cause__, BrokenPipeError)
+
+    def test_rows_are_relayed(self):
+        src = FakeCopyConnection(rows=1000)
+
+        class Sink(FakeCopyConnection):
+            def copy_expert(self, query, f, size=8192):
+                self.received = f.read()
+
+        dst = Sink(rows=1000)
+        with mock.patch.dict(os.environ, HOUSEKEEPER_PROGRESS_INTERVAL="0"):
+            rows, size, _ = copy_relay(src, dst, "COPY history_y2018m02 TO STDOUT", "COPY archive_y2018m02 FROM STDIN")
+        assert rows == 1000
+        assert size == len(dst.received) == sum(len(b"1\t%d\t0.5\t0\n" % n) for n in range(1000))
+
+
+class TestSortedCopy(unittest.TestCase):
+    def test_range_select(self):
+        sql = range_select("itemid, clock", "history_y2018m02", 10, 20, unique=True, ordered=True)
+        assert sql == (
+            "SELECT DISTINCT itemid, clock FROM history_y2018m02 WHERE clock >= 10 AND clock < 20 "
+            "ORDER BY itemid, clock"
+        )
+        assert "DISTINCT" not in range_select("itemid", "history_text_y2018m02", 10, 20, ordered=True)
+
+    def test_layout_comment(self):
+        sql, = set_layout("archive_y2018m02", {"unique", "sorted"})
+        assert sql == "COMMENT ON TABLE archive_y2018m02 IS 'housekeeper layout: sorted,unique';"
+        sql, = set_layout("archive_y2018m02")
+        assert sql.endswith("IS NULL;")
+
+    def test_prune_skips_what_the_layout_already_did(self):
+        kws = dict(table="history", year=2018, month=2)
+        everything = list(prune_archive(**kws))
+        assert any(x.startswith("DELETE") for x in everything)
+        assert any("CLUSTER" in x for x in everything)
+        assert not list(prune_archive(**kws, layout={"sorted", "unique"}))
+        unique = list(prune_archive(**kws, layout={"unique"}))
+        assert unique and not any(x.startswith("DELETE") for x in unique)
+
+
+class TestArchiveMonths(unittest.TestCase):
+    def test_trends_are_archived_after_their_own_retention(self):
+        months = archive_months(30, 400)
+        history = [date for table, date, days in months if table == "history"]
+        trends = [date for table, date, days in months if table == "trends"]
+        assert trends and max(trends) < max(history)
+        assert [date for _, date, _ in months] == sorted(date for _, date, _ in months)
+        assert {days for table, _, days in months if table.startswith("trends")} == {400}
+        assert not [table for table, _, _ in archive_months(30) if table.startswith("trends")]
@@ -0,0 +1,71 @@
+import unittest
+
+import psycopg2.errors
+import psycopg2.extensions
+
+from .batching import AdaptiveBatcher, AdaptiveDelete
+from . import housekeeper
+
+
+class FakeInfo:
+    host = dbname = user = "test"
+    transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeConnection:
+    info = FakeInfo()
+
+
+class FakeCursor:
+    """Times out on windows wider than `limit` seconds."""
+    connection = FakeConnection()
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.ranges = []
+        self.rowcount = -1
+
+    def execute(self, query):
+        start, stop = query
+        if stop - start > self.limit:
+            raise psycopg2.errors.QueryCanceled("canceling statement due to statement timeout")
+        self.ranges.append((start, stop))
+        self.rowcount = stop - start
+
+
+class TestAdaptiveBatcher(unittest.TestCase):
+    def test_slow_batches_shrink_window(self):
+        batcher = AdaptiveBatcher(target=10, window=1000, minimum=10)
+        assert batcher.record(20) == 500
+        # Never more than a factor two at once
+        assert batcher.record(1000) == 250
+
+    def test_fast_batches_grow_window_up_to_maximum(self):
+        batcher = AdaptiveBatcher(target=10, window=1000, maximum=3000)
+        assert batcher.record(5) == 2000
+        assert batcher.record(0) == 3000
+
+    def test_timeout_bisects_until_minimum(self):
+        batcher = AdaptiveBatcher(target=10, window=100, minimum=30)
+        assert batcher.timed_out()
+        assert batcher.window == 50
+        assert batcher.timed_out()
+        assert batcher.window == 30
+        assert not batcher.timed_out()
+
+
+class TestAdaptiveDelete(unittest.TestCase):
+    def test_timeouts_are_retried_and_range_is_covered(self):
+        curs = FakeCursor(limit=300)
+        batcher = AdaptiveBatcher(target=1000, window=1000, minimum=10)
+        delete = AdaptiveDelete(lambda a, b: (a, b), 0, 1000, batcher, step="test", where="history")
+        rows = delete(curs)
+        assert curs.ranges[0] == (0, 250)
+        assert curs.ranges[-1][1] == 1000
+        assert all(a[1] == b[0] for a, b in zip(curs.ranges, curs.ranges[1:]))
+        assert rows == 1000
+
+    def test_generators_yield_adaptive_batches(self):
+        stmts = list(housekeeper.clean_old_items(table="history", year=2018, month=2, target_seconds=60))
+        assert isinstance(stmts[0], AdaptiveDelete)
+        assert stmts[-1] == "VACUUM ANALYZE history_y2018m02;"
@@ -0,0 +1,73 @@
+import unittest
+
+from .brin import BrinStats, BrinTune, brin_index_sql, choose_brin, current_brin, tuned_comment
+
+
+class FakeCursor:
+    """Answers the index and statistics queries of BrinTune."""
+
+    def __init__(self, indexes, stats):
+        self.indexes = indexes
+        self.stats = stats
+        self.queries = []
+
+    def execute(self, query, args=None):
+        self.queries.append(query)
+
+    def fetchall(self):
+        return self.indexes
+
+    def fetchone(self):
+        return self.stats
+
+
+class TestChooseBrin(unittest.TestCase):
+    def test_range_balances_index_and_table_reads(self):
+        stats = BrinStats(pages=36_800, rows=5_000_000, version=160002, itemid_correlation=0.99,
+                          clock_correlation=0.1, width=24)
+        assert choose_brin(stats) == [(16, None)]
+        stats.pages = 4000
+        assert choose_brin(stats) == [(4, None)]
+        stats.pages = 10_000_000
+        assert choose_brin(stats) == [(128, None)]
+
+    def test_clock_order_uses_multi_minmax_where_there_is_one(self):
+        stats = BrinStats(pages=36_800, rows=5_000_000, version=160002, itemid_correlation=0.01,
+                          clock_correlation=0.98, width=24)
+        assert choose_brin(stats) == [(32, "int4_minmax_multi_ops"), (16, None)]
+        stats.version = 130010
+        assert choose_brin(stats) == [(16, None)]
+
+    def test_pages_from_the_row_width_before_vacuum(self):
+        stats = BrinStats(pages=0, rows=5_000_000, itemid_correlation=1.0, width=24)
+        assert round(stats.table_pages) == 35_265
+        assert choose_brin(stats) == [(16, None)]
+
+    def test_default_without_statistics_or_order(self):
+        assert choose_brin(BrinStats()) == [(16, None)]
+        stats = BrinStats(pages=1000, rows=-1, itemid_correlation=0.2, clock_correlation=0.3, width=24)
+        assert choose_brin(stats) == [(16, None)]
+
+    def test_current_brin_reads_the_indexdef(self):
+        sql = brin_index_sql("h_brin_idx", "h", pages_per_range=64, clock_ops="int4_minmax_multi_ops")
+        assert "USING brin (itemid, clock int4_minmax_multi_ops) WITH (pages_per_range='64')" in sql
+        indexdef = ("CREATE INDEX h_brin_idx ON public.h USING brin (itemid, clock int4_minmax_multi_ops) "
+                    "WITH (pages_per_range='64')")
+        assert current_brin(indexdef) == (64, "int4_minmax_multi_ops")
+        assert current_brin("CREATE INDEX h_brin_idx ON public.h USING brin (itemid, clock)") == (128, None)
+
+
+class TestBrinTune(unittest.TestCase):
+    stats = (36_800, 5_000_000, 160002, 0.01, 0.98, 24)
+
+    def test_measured_index_is_not_measured_again(self):
+        choices = [(32, "int4_minmax_multi_ops"), (16, None)]
+        assert tuned_comment(choices) == "housekeeper brin tuned for 32 int4_minmax_multi_ops, 16 minmax"
+        indexdef = "CREATE INDEX h_brin_idx ON public.h USING brin (itemid, clock) WITH (pages_per_range='64')"
+        curs = FakeCursor([("h_brin_idx", "brin", indexdef, tuned_comment(choices))], self.stats)
+        assert BrinTune("h", "h_brin_idx")(curs) == (64, None)
+        assert len(curs.queries) == 2
+
+    def test_btree_partitions_are_left_alone(self):
+        curs = FakeCursor([("h_brin_idx", "brin", "", None), ("h_btree_idx", "btree", "", None)], self.stats)
+        assert BrinTune("h", "h_brin_idx")(curs) is None
@@ -0,0 +1,77 @@
+import unittest
+
+from .catalog import Catalog
+from . import housekeeper
+
+
+def catalog():
+    rows = [
+        ("history", "p", None, 0, 0, [], []),
+        ("history_y2018m03", "r", "history", 8192, 100,
+         ["history_y2018m03_brin_idx:brin"], ["history_y2018m03_check"]),
+        ("archive_y2017m01", "f", "history", 0, 0, [], []),
+    ]
+    return Catalog(rows)
+
+
+class TestCatalog(unittest.TestCase):
+    def test_existing_index_is_noop(self):
+        cat = catalog()
+        stmt, = housekeeper.ensure_brin_index(table="history", year=2018, month=3)
+        assert cat.is_noop(stmt)
+        stmt, = housekeeper.ensure_btree_index(table="history", year=2018, month=3)
+        assert not cat.is_noop(stmt)
+
+    def test_observed_statements_update_snapshot(self):
+        cat = catalog()
+        stmt, = housekeeper.create_table_partition(table="history", year=2018, month=4)
+        assert not cat.is_noop(stmt)
+        cat.observe(stmt)
+        assert cat.is_noop(stmt)
+        assert cat.table_exists("history_y2018m04")
+
+        stmt, = housekeeper.clean_btree_index(table="history", year=2018, month=4)
+        assert cat.is_noop(stmt)
+        cat.observe(housekeeper.ensure_btree_index(table="history", year=2018, month=4).__next__())
+        assert not cat.is_noop(stmt)
+
+    def test_foreign_tables_are_archived_but_not_tables(self):
+        cat = catalog()
+        assert not cat.table_exists("archive_y2017m01")
+        assert [r.name for r in cat.partitions("history") if r.archived] == ["archive_y2017m01"]
+
+    def test_compound_statements_are_never_skipped(self):
+        cat = catalog()
+        stmts = list(housekeeper.cluster_table(table="history", year=2018, month=3))
+        assert not any(cat.is_noop(x) for x in stmts if ";" in x.rstrip(";"))
+
+    def test_fused_swap_keeps_the_partition(self):
+        cat = catalog()
+        for stmt in housekeeper.fused_cluster_table(table="history", year=2018, month=3):
+            assert not cat.is_noop(stmt)
+            cat.observe(stmt)
+        rel = cat.relations["history_y2018m03"]
+        assert rel.parent == "history"
+        assert rel.indexes == {"history_y2018m03_brin_idx": "brin"}
+        assert not cat.table_exists("history_y2018m03_fused")
+        assert not cat.table_exists("history_y2018m03_temp")
+
+    def test_merge_leaves_a_monthly_partition(self):
+        cat = Catalog([
+            ("history", "p", None, 0, 0, [], []),
+            ("history_y2018m02w1", "r", "history", 8192, 0, [], []),
+            ("history_y2018m02w2", "r", "history", 8192, 0, [], []),
+        ])
+        assert cat.parts("history", 2018, 2) == ["w1", "w2"]
+        for stmt in housekeeper.merge_partitions(table="history", year=2018, month=2, parts=["w1", "w2"]):
+            cat.observe(stmt)
+        assert cat.parts("history", 2018, 2) == [""]
+        assert cat.relations["history_y2018m02"].parent == "history"
+        assert not cat.table_exists("history_y2018m02_temp")
+
+    def test_trends_are_maintained_once_partitioned(self):
+        cat = Catalog([("trends", "r", None, 0, 0, [], []), ("trends_uint", "p", None, 0, 0, [], [])])
+        assert housekeeper.maintained_tables(cat) == housekeeper.HISTORY_TABLES + ("trends_uint",)
+        sql, = housekeeper.clean_expired_items(table="trends_uint", year=2018, month=3, batch_seconds=31 * 86400)
+        assert "items.trends::INTERVAL" in sql
+        assert not list(housekeeper.clean_duplicate_items(table="trends_uint", year=2018, month=3))
@@ -0,0 +1,25 @@
+import datetime
+import unittest
+
+from .convert import ConvertSwap, backfill_batches, convert_setup
+from .times import get_start_and_stop
+
+
+class TestConvert(unittest.TestCase):
+    def test_batches_cover_the_month_by_day(self):
+        batches = list(backfill_batches("history", datetime.date(2018, 2, 1)))
+        start, stop = get_start_and_stop(year=2018, month=2)
+        assert len(batches) == 28
+        assert batches[0].start == start and batches[-1].stop == stop
+        assert all(a.stop == b.start for a, b in zip(batches, batches[1:]))
+        assert str(batches[0]) == f"-- backfill history_y2018m02 from history {start}-{start + 86400}"
+
+    def test_only_trends_track_updates(self):
+        months = [datetime.date(2018, 1, 1), datetime.date(2018, 2, 1)]
+        *_, history = convert_setup("history", months)
+        *_, trends = convert_setup("trends", months)
+        assert "AFTER UPDATE" not in history
+        assert "CREATE TRIGGER trends_touch AFTER UPDATE ON trends" in trends
+        swap = list(ConvertSwap("trends", 0, 1).statements())
+        assert swap[0].startswith("DELETE FROM trends_part")
+        assert swap[-2:] == ["ALTER TABLE trends_part RENAME TO trends;", "DROP STATISTICS IF EXISTS s_trends;"]
@@ -116,3 +116,23 @@ class TestDateGeneration(unittest.TestCase):
         result = times.timestamp(start)
         assert isinstance(result, int)
         assert result == 1520467200  # Thu  8 Mar 01:00:00 CET 2018
+
+    def test_clock_ranges_cover_the_month(self):
+        start, stop = times.get_start_and_stop(year=2018, month=2)
+        ranges = times.clock_ranges(start, stop, 3)
+        assert ranges == [(start, start + 806400), (start + 806400, start + 1612800), (start + 1612800, stop)]
+        assert times.clock_ranges(start, stop, 1) == [(start, stop)]
+        assert times.clock_ranges(0, 2, 5) == [(0, 1), (1, 2)]
+
+    def test_month_parts_cover_the_month(self):
+        start, stop = times.get_start_and_stop(year=2018, month=2)
+        for granularity, count in (("month", 1), ("week", 4), ("day", 28)):
+            parts = times.month_parts(2018, 2, granularity)
+            assert len(parts) == count
+            bounds = [times.get_start_and_stop(year=2018, month=2, part=part) for part in parts]
+            assert bounds[0][0] == start and bounds[-1][1] == stop
+            assert all(a[1] == b[0] for a, b in zip(bounds, bounds[1:]))
+        # The last week runs to the end of the month
+        assert times.get_start_and_stop(year=2018, month=2, part="w4")[1] - \
+            times.get_start_and_stop(year=2018, month=2, part="w4")[0] == 7 * 86400
+        assert times.month_parts(2020, 2, "day")[-1] == "d29"
@@ -0,0 +1,70 @@
+import os
+import unittest
+
+from unittest import mock
+
+from .explain import Explainer, Plan, baseline_plans, plan_shape, regressions
+from .journal import Journal
+from .logs import log_state
+
+
+def explained(subplan="SubPlan 1", cost=100.0, buffers=50, rows=10):
+    scan = {
+        "Node Type": "Bitmap Heap Scan", "Relation Name": "history_y2018m02", "Actual Rows": rows,
+        "Actual Loops": 1, "Filter": f"(NOT ({subplan}))",
+        "Plans": [
+            {"Node Type": "Bitmap Index Scan", "Index Name": "history_y2018m02_brin_idx",
+             "Parent Relationship": "Outer"},
+            {"Node Type": "Seq Scan", "Relation Name": "items", "Parent Relationship": "SubPlan",
+             "Subplan Name": "SubPlan 1"},
+        ],
+    }
+    root = {"Node Type": "ModifyTable", "Operation": "Delete", "Relation Name": "history_y2018m02",
+            "Total Cost": cost, "Shared Hit Blocks": buffers, "Actual Rows": 0, "Plans": [scan]}
+    return [{"Plan": root, "Execution Time": 12.5}]
+
+
+class TestExplain(unittest.TestCase):
+    def test_shape(self):
+        plan = Plan("clean_old_items", "history", "history_y2018m02", explained("hashed SubPlan 1"))
+        assert plan.shape == ("ModifyTable Delete on history (Bitmap Heap Scan on history ("
+                              "Bitmap Index Scan using history_brin_idx, hashed SubPlan: Seq Scan on items))")
+        assert plan.rows == 10
+        assert plan_shape(explained()[0]["Plan"]) != plan.shape
+
+    def test_regressions(self):
+        baseline = Plan("clean_old_items", "history", "history_y2018m02", explained("hashed SubPlan 1"))
+        same = Plan("clean_old_items", "history", "history_y2017m12", explained("hashed SubPlan 1", cost=150))
+        assert regressions(same, baseline) == []
+        flipped = Plan("clean_old_items", "history", "history_y2017m12", explained(cost=500, buffers=90))
+        assert regressions(flipped, baseline) == ["shape", "cost"]
+        # Costs are compared per hour of clock window
+        wide = Plan("clean_old_items", "history", "history_y2017m12", explained("hashed SubPlan 1", cost=500),
+                    window=7200)
+        assert regressions(wide, baseline) == ["cost"]
+        wide.window = 4 * 3600
+        assert regressions(wide, baseline) == []
+
+    def test_samples_are_spread_out(self):
+        explainer = Explainer()
+        with mock.patch.dict(os.environ, {"HOUSEKEEPER_EXPLAIN": "3"}):
+            with log_state(step="clean_old_items"):
+                sampled = [explainer.wanted("DELETE FROM history_y2018m02 T1;") for _ in range(10)]
+                assert not explainer.wanted("VACUUM ANALYZE history_y2018m02;")
+            with log_state(step="clean_duplicate_items"):
+                assert explainer.wanted("DELETE FROM history_uint_y2018m02 T1;")
+        assert [n for n, x in enumerate(sampled) if x] == [0, 1, 3]
+
+    def test_first_plans_are_the_baseline(self):
+        explainer = Explainer()
+        explainer.plans = [
+            Plan("clean_old_items", "history", "history_y2018m02", explained("hashed SubPlan 1")),
+            Plan("clean_old_items", "history", "history_y2018m01", explained(cost=500)),
+        ]
+        with Journal(":memory:") as journal:
+            explainer.save(journal)
+            baseline, = baseline_plans(journal).values()
+            assert baseline.partition == "history_y2018m02"
+            assert journal.rebaseline() == 1
+            baseline, = baseline_plans(journal).values()
+            assert baseline.partition == "history_y2018m01"
@@ -0,0 +1,97 @@
+import os
+import unittest
+
+from unittest import mock
+
+import psycopg2
+
+from .batching import AdaptiveBatcher, AdaptiveDelete
+from .journal import Journal, journaled
+from .test_batching import FakeConnection
+from . import housekeeper
+
+
+def statements():
+    return housekeeper.clean_duplicate_items(table="history", year=2018, month=2)
+
+
+def adaptive():
+    batcher = AdaptiveBatcher(target=1, window=100, minimum=100, maximum=100)
+    yield AdaptiveDelete(lambda start, stop: f"DELETE {start} {stop}", 0, 1000, batcher, step="test",
+                         where="history")
+
+
+class FakeCursor:
+    """Crashes on the `crash` statement."""
+    connection = FakeConnection()
+
+    def __init__(self, crash=None):
+        self.crash = crash
+        self.queries = []
+        self.rowcount = 0
+
+    def execute(self, query):
+        if query == self.crash:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.queries.append(query)
+
+
+def run(journal, stmts, crash=None):
+    """Execute the statements the journal lets through, up to a crash."""
+    curs = FakeCursor(crash)
+    # No progress monitor on the fake connection
+    with mock.patch.dict(os.environ, HOUSEKEEPER_PROGRESS_INTERVAL="0"):
+        try:
+            for x in journaled(journal, "oneshot", "history", 2018, 2, stmts):
+                x(curs)
+        except psycopg2.OperationalError:
+            pass
+    return curs.queries
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.journal = Journal(":memory:")
+
+    def tearDown(self):
+        self.journal.close()
+
+    def test_rerun_skips_finished_statements(self):
+        # Crash while running the sixth statement
+        crash = list(statements())[5]
+        executed = run(self.journal, statements(), crash=crash)
+        assert len(executed) == 5
+        rerun = run(self.journal, statements())
+        assert rerun[0] == crash
+        assert executed + rerun == list(statements())
+
+    def test_repeated_statements_are_journaled_separately(self):
+        everything = list(statements())
+        vacuums = everything.count("VACUUM ANALYZE history_y2018m02;")
+        assert vacuums > 1
+        # The first VACUUM has run when the first DELETE crashes
+        first_delete = next(x for x in everything if x.startswith("DELETE"))
+        run(self.journal, statements(), crash=first_delete)
+        rerun = run(self.journal, statements())
+        assert rerun.count("VACUUM ANALYZE history_y2018m02;") == vacuums - 1
+
+    def test_adaptive_batches_resume_from_last_committed_stop(self):
+        executed = run(self.journal, adaptive(), crash="DELETE 500 600")
+        assert executed[-1] == "DELETE 400 500"
+        rerun = run(self.journal, adaptive())
+        assert rerun == [f"DELETE {n} {n + 100}" for n in range(500, 1000, 100)]
+        # Once all of it is done, it is skipped as a whole
+        assert not run(self.journal, adaptive())
+
+    def test_pending_reports_steps_and_ranges(self):
+        total, pending = self.journal.pending("oneshot", "history", 2018, 2, statements())
+        assert total == len(pending) == len(list(statements()))
+        # The VACUUM runs inside the first batch
+        assert pending[0] == ("vacuum_table", "1517443200-1517476813")
+        assert pending[1] == ("clean_duplicate_items", "1517443200-1517476813")
+        assert pending[-1] == ("vacuum_table", None)
+
+    def test_jobs_and_months_are_separate(self):
+        list(journaled(self.journal, "oneshot", "history", 2018, 2, statements()))
+        assert list(journaled(self.journal, "migrate", "history", 2018, 2, statements()))
+        assert not list(journaled(None, "oneshot", "history", 2018, 2, iter(())))
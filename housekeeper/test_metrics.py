@@ -0,0 +1,76 @@
+import os
+import unittest
+
+from unittest import mock
+
+from .helpers import STATS, execute
+from .logs import log_state
+from .metrics import Metrics, is_write, statement_labels
+from .test_batching import FakeInfo
+
+
+class FakeCursor:
+    """Counts its own statements, and those of the cursors of its connection."""
+
+    def __init__(self):
+        self.connection = self
+        self.info = FakeInfo()
+        self.sent = 0
+        self.rowcount = 1
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, query, args=None):
+        self.sent += 1
+
+    def fetchone(self):
+        return (0,)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_labels_come_from_the_step_and_sql(self):
+        with log_state(step="clean_expired_items"):
+            labels = statement_labels("DELETE FROM history_uint_y2018m02w1 WHERE clock < 1;")
+        assert labels == ("clean_expired_items", "history_uint", "history_uint_y2018m02w1")
+        assert statement_labels("VACUUM sessions;") == ("vacuum", "", "")
+        assert is_write("CLUSTER history_y2018m02;")
+        assert not is_write("  select 1")
+
+    def test_series_add_up(self):
+        metrics = Metrics()
+        with log_state(step="dedupe"):
+            metrics.statement("DELETE FROM history_y2018m02 WHERE x;", rows=300, seconds=1.5, wal_bytes=8192)
+            metrics.statement("DELETE FROM history_y2018m02 WHERE y;", rows=100, seconds=0.5)
+            metrics.statement("CREATE INDEX ON history_y2018m02;", rows=-1, seconds=1.0)
+        series, = metrics.summary()
+        assert series["statements"] == 3
+        assert series["rows"] == 400
+        assert series["rows_per_second"] == 400 / 3.0
+        text = metrics.prometheus("housekeeper")
+        assert ('housekeeper_rows{tool="housekeeper",step="dedupe",table="history",'
+                'partition="history_y2018m02"} 400') in text
+        assert "# TYPE housekeeper_wal_bytes gauge" in text
+        assert metrics.run_summary("housekeeper")["totals"]["wal_bytes"] == 8192
+        assert 'housekeeper_run_success{tool="housekeeper"} 1' in text
+        assert 'housekeeper_run_success{tool="housekeeper"} 0' in metrics.prometheus("housekeeper", success=False)
+        assert not metrics.run_summary("housekeeper", success=False)["success"]
+
+    def test_partition_of_an_index(self):
+        labels = statement_labels("SELECT brin_summarize_new_values('history_y2026m10_brin_idx'::regclass);")
+        assert labels[1:] == ("history", "history_y2026m10")
+        assert statement_labels("DROP TABLE trends_y2026m10d05;")[1:] == ("trends", "trends_y2026m10d05")
+
+    def test_wal_queries_are_round_trips(self):
+        curs = FakeCursor()
+        before = STATS.round_trips
+        with mock.patch.dict(os.environ, HOUSEKEEPER_METRICS_DIR="/nonexistent", HOUSEKEEPER_PROGRESS_INTERVAL="0"):
+            execute(curs, "DELETE FROM history_y2018m02 WHERE clock < 1;")
+        assert curs.sent == 3
+        assert STATS.round_trips - before == 3
@@ -0,0 +1,69 @@
+import unittest
+
+import psycopg2.errors
+
+from .online import OnlineCluster, OnlineSwap, capture_sql
+from .test_batching import FakeConnection
+
+
+class FakeCursor:
+    """The LOCK TABLE times out the first `busy` times."""
+    connection = FakeConnection()
+
+    def __init__(self, busy):
+        self.busy = busy
+        self.queries = []
+        self.rowcount = -1
+
+    def execute(self, query):
+        if query.startswith("LOCK TABLE") and self.busy:
+            self.busy -= 1
+            raise psycopg2.errors.LockNotAvailable("canceling statement due to lock timeout")
+        self.queries.append(query)
+        self.rowcount = 1
+
+
+def swap():
+    return OnlineSwap("history", "history_y2018m02_delta", "history_y2018m02_online", ["-- swap"], attempts=3)
+
+
+class TestOnlineSwap(unittest.TestCase):
+
+    def test_lock_timeouts_roll_back_and_catch_up(self):
+        curs = FakeCursor(busy=2)
+        swap()(curs)
+        assert curs.queries.count("ROLLBACK;") == 2
+        assert curs.queries[-2:] == ["-- swap", "COMMIT;"]
+        assert curs.queries[-3].startswith("WITH moved AS")
+
+    def test_gives_up_after_attempts(self):
+        curs = FakeCursor(busy=3)
+        with self.assertRaises(RuntimeError):
+            swap()(curs)
+        assert "-- swap" not in curs.queries
+
+
+class TestOnlineCluster(unittest.TestCase):
+    def cluster(self, statement):
+        return OnlineCluster("history_y2018m02", "history_y2018m02_delta", "history_y2018m02_online", [
+            ("online_capture", capture_sql("history_y2018m02", "history_y2018m02_delta")),
+            ("online_swap", statement),
+        ])
+
+    def test_capture_replaces_the_trigger(self):
+        sql = capture_sql("history_y2018m02", "history_y2018m02_delta")
+        assert sql.index("DROP TRIGGER IF EXISTS") < sql.index("CREATE TRIGGER")
+
+    def test_cleans_up_after_success(self):
+        curs = FakeCursor(busy=0)
+        self.cluster(swap())(curs)
+        assert "ROLLBACK;" not in curs.queries
+        assert "DROP TABLE IF EXISTS history_y2018m02_online;" in curs.queries[-1]
+
+    def test_cleans_up_after_failure(self):
+        curs = FakeCursor(busy=3)
+        with self.assertRaises(RuntimeError):
+            self.cluster(swap())(curs)
+        assert curs.queries[-2] == "ROLLBACK;"
+        assert "DROP TRIGGER IF EXISTS history_y2018m02_delta_capture" in curs.queries[-1]
+        assert "DROP TABLE IF EXISTS history_y2018m02_online;" in curs.queries[-1]
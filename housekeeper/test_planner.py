@@ -0,0 +1,75 @@
+import datetime
+import os
+import unittest
+
+from unittest import mock
+
+from .catalog import Catalog
+from . import planner
+
+
+class TestPlanner(unittest.TestCase):
+    start = datetime.date(2018, 3, 1)
+
+    def catalog(self):
+        rows = [
+            ("history", "p", None, 0, 0, [], []),
+            # A fresh month, keeps its btree
+            ("history_y2018m02", "r", "history", 8192, 0,
+             ["history_y2018m02_btree_idx:btree", "history_y2018m02_brin_idx:brin"], []),
+            # An older month with a btree and a legacy index left over
+            ("history_y2017m12", "r", "history", 8192, 0,
+             ["history_y2017m12_btree_idx:btree", "history_y2017m12_itemid_clock_idx:btree"], []),
+        ]
+        return Catalog(rows)
+
+    def plan(self, catalog, **env):
+        with mock.patch.dict(os.environ, env):
+            return [(s.partition, s.action) for s in planner.maintenance_plan(catalog, ("history",), start=self.start)]
+
+    def test_future_months_are_created_with_indexes(self):
+        steps = self.plan(self.catalog())
+        assert ("history_y2018m03", "create_table_partition") in steps
+        assert ("history_y2018m03", "ensure_btree_index") in steps
+        assert ("history_y2019m03", "ensure_brin_index") in steps
+
+    def test_only_changes_are_planned(self):
+        steps = self.plan(self.catalog())
+        past = [s for s in steps if s[0] < "history_y2018m03"]
+        assert past == [
+            ("history_y2017m12", "clean_old_indexes"),
+            ("history_y2017m12", "ensure_brin_index"),
+            ("history_y2017m12", "clean_btree_index"),
+        ]
+
+    def test_missing_past_months_are_not_created(self):
+        steps = self.plan(self.catalog())
+        assert not [s for s in steps if s[0] == "history_y2017m06"]
+
+    def test_empty_future_months_are_split(self):
+        catalog = self.catalog()
+        for month in ("history_y2018m03", "history_y2018m05"):
+            catalog.observe(f"CREATE TABLE IF NOT EXISTS {month} PARTITION OF history FOR values FROM (1) TO (2);")
+        steps = self.plan(catalog, HOUSEKEEPER_GRANULARITY="week")
+        # The current month keeps its partition, a later one is split in one step
+        assert ("history_y2018m03", "ensure_btree_index") in steps
+        assert not [s for s in steps if s[0].startswith("history_y2018m03w")]
+        assert ("history_y2018m05", "split_partitions") in steps
+        assert ("history_y2018m05w2", "create_table_partition") not in steps
+        # Missing months are created in weeks
+        assert ("history_y2018m04w4", "create_table_partition") in steps
+
+    def test_index_policy(self):
+        catalog = self.catalog()
+        steps = self.plan(catalog, HOUSEKEEPER_INDEX_POLICY="btree+brin:1,partial+brin:3,brin")
+        # Last month is already past the btree stage, and gets a partial btree
+        assert ("history_y2018m02", "ensure_partial_index") in steps
+        assert ("history_y2018m02", "clean_btree_index") in steps
+        assert ("history_y2018m03", "ensure_btree_index") in steps
+        assert ("history_y2017m12", "ensure_partial_index") not in steps
+
+    def test_the_plan_leaves_the_catalog_alone(self):
+        catalog = self.catalog()
+        self.plan(catalog)
+        assert "history_y2018m03" not in catalog.relations
+        assert catalog.has_index("history_y2017m12_itemid_clock_idx")
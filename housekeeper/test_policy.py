@@ -0,0 +1,40 @@
+import unittest
+
+from .policy import DEFAULT_POLICY, Stage, parse_policy, stage_for, wanted_kinds
+
+
+class TestPolicy(unittest.TestCase):
+    def test_parse(self):
+        policy = parse_policy("btree+brin:3, partial+brin:6,brin:24,none")
+        assert policy == [
+            Stage({"btree", "brin"}, 3),
+            Stage({"partial", "brin"}, 6),
+            Stage({"brin"}, 24),
+            Stage(()),
+        ]
+        assert repr(policy[1]) == "brin+partial:6"
+
+    def test_invalid_policies(self):
+        for text in ("btree+hash:3,brin", "btree:3,brin:2,none", "btree,brin", "btree:3,brin:6", "btree:0,brin"):
+            with self.assertRaises(ValueError):
+                parse_policy(text)
+        with self.assertRaises(ValueError):
+            parse_policy("bloom+brin:3,brin", table="history")
+        assert parse_policy("bloom+brin:3,brin", table="history_text")
+
+    def test_default_keeps_the_btree_of_the_two_last_months(self):
+        policy = parse_policy(DEFAULT_POLICY)
+        assert [wanted_kinds(stage_for(policy, age), age) for age in (-2, 0, 1, 2, 3)] == [
+            ["btree", "brin"], ["btree", "brin"], ["brin"], ["brin"], ["brin"],
+        ]
+        assert [sorted(stage_for(policy, age).kinds) for age in (2, 3)] == [["brin", "btree"], ["brin"]]
+
+    def test_unused_indexes_move_on_early(self):
+        policy = parse_policy(DEFAULT_POLICY)
+        kws = dict(table="history", year=2018, month=2, part="")
+        scans = {"history_y2018m02_btree_idx": 0}
+        assert stage_for(policy, 1, scans=scans, **kws) == policy[1]
+        # Never the current month, nor a btree in use or missing
+        assert stage_for(policy, 0, scans=scans, **kws) == policy[0]
+        assert stage_for(policy, 1, scans={"history_y2018m02_btree_idx": 3}, **kws) == policy[0]
+        assert stage_for(policy, 1, scans={}, **kws) == policy[0]
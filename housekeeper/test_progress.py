@@ -0,0 +1,31 @@
+import unittest
+
+from .progress import Estimate, is_watched, progress_sql
+
+
+class TestProgress(unittest.TestCase):
+    def test_watched_statements(self):
+        assert is_watched("CREATE INDEX CONCURRENTLY IF NOT EXISTS x ON y USING brin (clock);")
+        assert is_watched("\n  vacuum analyze history_y2018m02;")
+        assert is_watched("COPY history FROM STDIN")
+        assert not is_watched("DELETE FROM history_y2018m02 WHERE clock < 1;")
+        assert not is_watched("CREATE TABLE history_y2018m02 PARTITION OF history;")
+
+    def test_views_of_the_server_version(self):
+        assert "pg_stat_progress_copy" not in progress_sql(130000)
+        assert "pg_stat_progress_analyze" in progress_sql(130000)
+        assert "pg_stat_progress_copy" in progress_sql(160000)
+
+    def test_rate_and_eta_over_the_phase(self):
+        estimate = Estimate()
+        first = estimate.update("vacuum", "scanning heap", 100, 1100, now=10.0)
+        assert first == {"percent": 9.1, "rate": None, "eta_seconds": None}
+        second = estimate.update("vacuum", "scanning heap", 300, 1100, now=12.0)
+        assert second == {"percent": 27.3, "rate": 100.0, "eta_seconds": 8}
+        # A new phase starts over
+        assert estimate.update("vacuum", "vacuuming heap", 0, 1100, now=13.0)["rate"] is None
+        # Without a total, only the rate is known
+        estimate.update("copy", "COPY FROM", 0, 0, now=0.0)
+        assert estimate.update("copy", "COPY FROM", 5000, 0, now=1.0) == {
+            "percent": None, "rate": 5000.0, "eta_seconds": None,
+        }
@@ -0,0 +1,88 @@
+import datetime
+import unittest
+
+from .catalog import Catalog
+from .housekeeper import TRENDS_TABLES
+from .retention import check_retention, expired_partitions, leftover_tables, remove_archived, remove_partition
+
+
+def catalog(*rels):
+    return Catalog([(name, kind, parent, 0, 0, [], []) for name, kind, parent in rels])
+
+
+class TestRetention(unittest.TestCase):
+    def test_only_whole_months_past_retention_expire(self):
+        cat = catalog(
+            ("history", "p", None),
+            ("history_y2018m01", "r", "history"),
+            ("history_y2018m02", "r", "history"),
+            ("history_y2018m03", "r", "history"),
+            ("history_uint_y2018m01", "r", "history_uint"),
+            ("history_y2017m12", "f", "history"),
+            ("history_y2017m11", "r", None),
+        )
+        # 40 days before is 2018-02-27, so february is not all expired
+        today = datetime.date(2018, 4, 8)
+        found = [(table, rel.name) for table, rel, _ in expired_partitions(cat, 40, today)]
+        assert found == [
+            ("history", "history_y2018m01"),
+            ("history_uint", "history_uint_y2018m01"),
+        ]
+        # A detached table may hold the only copy of its month
+        assert [rel.name for rel in leftover_tables(cat)] == ["history_y2017m11"]
+
+    def test_archived_partitions_expire_and_unarchived_are_kept(self):
+        cat = catalog(
+            ("history", "p", None),
+            ("archive_y2017m12", "f", "history"),
+            ("archive_uint_y2017m12", "f", "history_uint"),
+            ("history_y2018m01", "r", "history"),
+        )
+        today = datetime.date(2018, 4, 8)
+        found = [(table, rel.name) for table, rel, _ in expired_partitions(cat, 40, today, archive="30")]
+        assert found == [("history", "archive_y2017m12"), ("history_uint", "archive_uint_y2017m12")]
+        # Without archiving, the foreign tables are not ours to remove
+        assert [rel.name for _, rel, _ in expired_partitions(cat, 40, today)] == ["history_y2018m01"]
+
+    def test_archived_partitions_are_removed_on_the_archive_first(self):
+        cat = catalog(("archive_y2017m12", "f", "history"))
+        rel = cat.relations["archive_y2017m12"]
+        assert list(remove_archived(rel)) == ["DROP TABLE IF EXISTS archive_y2017m12;"]
+        local, = remove_partition("history", rel)
+        assert "DETACH PARTITION archive_y2017m12" in local
+        assert "DROP FOREIGN TABLE archive_y2017m12;" in local
+        assert list(remove_archived(rel, mode="truncate")) == ["TRUNCATE TABLE archive_y2017m12;"]
+        assert not list(remove_partition("history", rel, mode="truncate"))
+
+    def test_fast_window_is_guarded(self):
+        with self.assertRaises(ValueError):
+            check_retention(14)
+        with self.assertRaises(ValueError):
+            check_retention(60, archive="90")
+        check_retention(15)
+
+    def test_detached_partitions_are_only_dropped(self):
+        cat = catalog(("history_y2018m01", "r", "history"), ("history_y2017m12", "r", None))
+        attached, = remove_partition("history", cat.relations["history_y2018m01"])
+        assert "DETACH PARTITION history_y2018m01" in attached
+        detached, = remove_partition("history", cat.relations["history_y2017m12"])
+        assert "DETACH" not in detached
+        truncate, = remove_partition("history", cat.relations["history_y2018m01"], mode="truncate")
+        assert truncate == "TRUNCATE TABLE history_y2018m01;"
+
+    def test_week_partitions_expire_on_their_own(self):
+        cat = catalog(("history_y2018m02w3", "r", "history"), ("history_y2018m02w4", "r", "history"))
+        # 40 days before is 2018-02-27, in the last week
+        found = [rel.name for _, rel, _ in expired_partitions(cat, 40, datetime.date(2018, 4, 8))]
+        assert found == ["history_y2018m02w3"]
+
+    def test_trends_expire_after_their_own_retention(self):
+        cat = catalog(
+            ("trends", "p", None),
+            ("trends_y2017m01", "r", "trends"),
+            ("trends_uint_y2017m06", "r", "trends_uint"),
+        )
+        today = datetime.date(2018, 4, 8)
+        assert not list(expired_partitions(cat, 40, today))
+        found = [rel.name for _, rel, _ in expired_partitions(cat, 400, today, tables=TRENDS_TABLES)]
+        assert found == ["trends_y2017m01"]
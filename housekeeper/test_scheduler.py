@@ -0,0 +1,104 @@
+import threading
+import time
+import unittest
+
+from structlog.contextvars import get_contextvars
+
+from .logs import log_state
+from .scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    def test_tasks_run_after_their_requirements(self):
+        order = []
+        lock = threading.Lock()
+
+        def step(name):
+            def action():
+                with lock:
+                    order.append(name)
+            return action
+
+        sched = Scheduler(pool=None, workers=4)
+        sched.add(("c",), step("c"), requires=[("b",)])
+        sched.add(("b",), step("b"), requires=[("a",)])
+        sched.add(("a",), step("a"))
+        sched.add(("d",), step("d"))
+        sched.run()
+
+        assert order.index("a") < order.index("b") < order.index("c")
+        assert sorted(order) == ["a", "b", "c", "d"]
+
+    def test_failure_skips_dependents_and_raises(self):
+        ran = []
+
+        def boom():
+            raise RuntimeError("boom")
+
+        sched = Scheduler(pool=None, workers=2)
+        sched.add(("a",), boom)
+        sched.add(("b",), lambda: ran.append("b"), requires=[("a",)])
+        sched.add(("c",), lambda: ran.append("c"))
+        with self.assertRaises(RuntimeError):
+            sched.run()
+        assert ran == ["c"]
+
+    def test_failure_skips_dependents_added_before_their_requirement(self):
+        ran = []
+
+        def boom():
+            raise RuntimeError("boom")
+
+        sched = Scheduler(pool=None, workers=2)
+        sched.add(("c",), lambda: ran.append("c"), requires=[("b",)])
+        sched.add(("b",), lambda: ran.append("b"), requires=[("a",)])
+        sched.add(("a",), boom)
+        # The failure of a, not a circular requirement
+        with self.assertRaisesRegex(RuntimeError, "boom"):
+            sched.run()
+        assert ran == []
+
+    def test_unknown_requirement_is_an_error(self):
+        sched = Scheduler(pool=None)
+        sched.add(("a",), lambda: None, requires=[("missing",)])
+        with self.assertRaises(ValueError):
+            sched.run()
+
+    def test_log_state_follows_task_into_worker(self):
+        seen = {}
+
+        def action():
+            seen.update(get_contextvars())
+
+        sched = Scheduler(pool=None, workers=2)
+        with log_state(stage="testing"):
+            sched.add(("history", "2018-03", "brin"), action)
+        # The context is the one the task was added in, not the one run in
+        with log_state(stage="running"):
+            sched.run()
+        assert seen["stage"] == "testing"
+        assert seen["task"] == "history/2018-03/brin"
+
+    def test_group_limits_cap_running_tasks(self):
+        lock = threading.Lock()
+        running = {"load": 0, "cleanup": 0}
+        most = {"load": 0, "cleanup": 0}
+
+        def step(group):
+            def action():
+                with lock:
+                    running[group] += 1
+                    most[group] = max(most[group], running[group])
+                time.sleep(0.01)
+                with lock:
+                    running[group] -= 1
+            return action
+
+        sched = Scheduler(pool=None, workers=4, limits={"load": 1, "cleanup": 3})
+        for n in range(6):
+            cleanup = sched.add(("cleanup", str(n)), step("cleanup"), group="cleanup")
+            sched.add(("load", str(n)), step("load"), requires=[cleanup], group="load")
+        sched.run()
+
+        assert most["load"] == 1
+        assert 1 < most["cleanup"] <= 3
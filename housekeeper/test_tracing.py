@@ -0,0 +1,57 @@
+import os
+import unittest
+
+from unittest import mock
+
+from .logs import log_state
+from .tracing import RUN, TRACER, Tracer
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {"HOUSEKEEPER_TRACE": "unused.json"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_spans_nest(self):
+        tracer = Tracer()
+        with tracer.span("step", "clean_expired_items", table="history", month="2018-02") as task:
+            with tracer.span("batch", "clean_expired_items", clean_start=1, clean_stop=2):
+                with tracer.span("sql", "DELETE") as sql:
+                    sql["rows"] = 12
+        with tracer.span("step", "cluster_table", table="history", month="2018-02"):
+            pass
+        with tracer.span("step", "vacuum"):
+            pass
+        sql, batch, expired, cluster, vacuum = tracer.spans
+        assert sql["parent"] == batch["id"] and batch["parent"] == expired["id"]
+        assert task == {"table": "history", "month": "2018-02"}
+        # Tasks of a month share its span, in the span of the table
+        month = tracer.groups[("history", "2018-02")]
+        assert expired["parent"] == cluster["parent"] == month["id"]
+        assert month["parent"] == tracer.groups[("history",)]["id"]
+        assert month["start"] == expired["start"] and month["end"] == cluster["end"]
+        assert vacuum["parent"] == RUN
+
+        events = tracer.events("housekeeper")
+        assert {e["ph"] for e in events} == {"M", "X", "b", "e"}
+        delete, = [e for e in events if e["name"] == "DELETE"]
+        assert delete["args"]["rows"] == 12 and delete["args"]["parent_id"] == batch["id"]
+
+    def test_log_state_opens_spans(self):
+        before = len(TRACER.spans)
+        with log_state(step="dedupe"):
+            with log_state(where="history_y2018m02"):
+                with log_state(step="dedupe", batch_start=1, batch_stop=2):
+                    pass
+        batch, step = TRACER.spans[before:]
+        assert (step["kind"], batch["kind"]) == ("step", "batch")
+        assert batch["parent"] == step["id"]
+        assert batch["attrs"]["batch_stop"] == 2
+
+    def test_nothing_is_kept_when_disabled(self):
+        tracer = Tracer()
+        with mock.patch.dict(os.environ, {"HOUSEKEEPER_TRACE": ""}):
+            with tracer.span("step", "vacuum") as attrs:
+                attrs["rows"] = 1
+        assert tracer.spans == []
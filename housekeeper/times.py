@@ -1,8 +1,12 @@
 from datetime import datetime, timedelta, date
-from typing import Iterator, Optional, Callable, Tuple
+from typing import Iterator, List, Optional, Callable, Tuple
 
 EPOCH = date(1970, 1, 1)
 MONTHISH = timedelta(days=31)
+GRANULARITIES = ("month", "week", "day")
+# First day of each week partition. The last one runs to the end of the
+# month, so that weeks, like days, always nest in a month.
+WEEK_STARTS = (1, 8, 15, 22)
 
 
 def this_day() -> date:
@@ -21,9 +25,35 @@ def next_month(day: date) -> date:
     return (day.replace(day=15) + MONTHISH).replace(day=1)
 
 
-def get_start_and_stop(*, year: int = 2011, month: int = 11) -> Tuple[int, int]:
+def month_parts(year: int, month: int, granularity: str = "month") -> List[str]:
+    """Suffixes of the partitions a month is split in, "" for the whole month,
+    "w1" to "w4" for weeks and "d01" onwards for days."""
+    if granularity == "month":
+        return [""]
+    if granularity == "week":
+        return [f"w{n}" for n in range(1, len(WEEK_STARTS) + 1)]
+    if granularity == "day":
+        first = date(year=year, month=month, day=1)
+        return [f"d{day:02d}" for day in range(1, (next_month(first) - first).days + 1)]
+    raise ValueError(f"Granularity must be one of {GRANULARITIES}")
+
+
+def part_granularity(part: str) -> str:
+    return {"": "month", "w": "week", "d": "day"}[part[:1]]
+
+
+def get_start_and_stop(*, year: int = 2011, month: int = 11, part: str = "") -> Tuple[int, int]:
     start = date(year=year, month=month, day=1)
     stop = next_month(start)
+    granularity = part_granularity(part)
+    if granularity == "week":
+        n = int(part[1:])
+        start = start.replace(day=WEEK_STARTS[n - 1])
+        if n < len(WEEK_STARTS):
+            stop = start.replace(day=WEEK_STARTS[n])
+    elif granularity == "day":
+        start = start.replace(day=int(part[1:]))
+        stop = start + timedelta(days=1)
     return timestamp(start), timestamp(stop)
 
 
@@ -113,3 +143,10 @@ def months_2014_to_current() -> Iterator[date]:
     start = date(year=2014, month=1, day=1)
     end = datetime.now().date().replace(day=1)
     yield from months_between(from_date=start, to_date=end)
+
+
+def clock_ranges(start: int, stop: int, count: int) -> List[Tuple[int, int]]:
+    """Split [start, stop) into `count` disjoint ranges of about the same size."""
+    count = max(1, min(count, stop - start))
+    bounds = [start + (stop - start) * n // count for n in range(count + 1)]
+    return list(zip(bounds, bounds[1:]))
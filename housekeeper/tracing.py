@@ -0,0 +1,179 @@
+"""Trace spans of a run, from the run down to the batches and statements.
+
+With HOUSEKEEPER_TRACE set to a file name, each tool writes a trace of its
+run there at exit, in the Chrome trace event format. Open it in Perfetto
+(https://ui.perfetto.dev) or chrome://tracing to see where the time went.
+
+The spans nest as:
+
+run:       The whole run of the tool.
+table:     All the tasks on one table.
+month:     All the tasks on one month of a table.
+step:      A scheduler task, or a log_state with a "step".
+batch:     A log_state with the bounds of a batch, like batching.AdaptiveDelete.
+sql:       A statement run by helpers.execute.
+
+Tasks on a table and month run on several workers, and overlap with the tasks
+on other months, so the table and month spans cover the first to the last of
+their tasks, and are written as async spans. The others are written on the
+thread that ran them. Every span has its id and the id of its parent in its
+args, next to its attributes.
+"""
+import contextvars
+import itertools
+import json
+import os
+import re
+import threading
+import time
+
+from contextlib import contextmanager, nullcontext
+
+import structlog
+
+_log = structlog.get_logger(__name__)
+
+# log_state keys that mark a batch, rather than a whole step
+BATCH_KEYS = ("batch_start", "delete_start", "clean_start", "copy_start", "backfill_start", "chunk")
+# The month in a scheduler.task_key
+MONTH = re.compile(r"^\d{4}-\d{2}$")
+# The id of the run span, the root of all others
+RUN = 0
+
+_current = contextvars.ContextVar("housekeeper_span", default=None)
+
+
+def get_trace_path():
+    """
+    environment variable HOUSEKEEPER_TRACE is the file the trace spans of a
+    run are written to, as Chrome trace event JSON. When it is not set, no
+    spans are kept."""
+    return os.environ.get("HOUSEKEEPER_TRACE") or None
+
+
+def _jsonable(value):
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+class Tracer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(RUN + 1)
+        self.started = time.time()
+        self._clock = time.perf_counter()
+        self.spans = []
+        # (table,) and (table, month) to their span
+        self.groups = {}
+
+    def enabled(self):
+        return get_trace_path() is not None
+
+    def _now(self):
+        """Microseconds since the start of the run."""
+        return (time.perf_counter() - self._clock) * 1e6
+
+    def _group(self, table, month, start, end):
+        """Widen the table and month spans to cover a task, return the month's id."""
+        parent = RUN
+        for key in ((table,), (table, month)):
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = {
+                    "id": next(self._ids), "parent": parent, "kind": "table" if len(key) == 1 else "month",
+                    "name": "/".join(key), "start": start, "end": end, "attrs": {"table": table},
+                }
+                if len(key) == 2:
+                    group["attrs"]["month"] = month
+            group["start"] = min(group["start"], start)
+            group["end"] = max(group["end"], end)
+            parent = group["id"]
+        return parent
+
+    @contextmanager
+    def span(self, kind, name, **attrs):
+        """A span around the block, nested in the current one.
+
+        Yields the attributes of the span, to add to while it runs. A span
+        with a table and month, outside of any other span of that month, is
+        put in the span of the month.
+        """
+        if not self.enabled():
+            yield attrs
+            return
+
+        parent = _current.get()
+        span = {"id": next(self._ids), "kind": kind, "name": name, "attrs": attrs,
+                "thread": threading.get_ident(), "thread_name": threading.current_thread().name}
+        _current.set(span)
+        span["start"] = self._now()
+        try:
+            yield attrs
+        except BaseException as exc:
+            attrs["error"] = repr(exc)
+            raise
+        finally:
+            span["end"] = self._now()
+            # Generators may be closed from another context, where a reset
+            # token is not valid, so set the outer span back instead.
+            _current.set(parent)
+            month = attrs.get("month")
+            with self._lock:
+                if parent is None and "table" in attrs and month is not None and MONTH.match(str(month)):
+                    span["parent"] = self._group(attrs["table"], month, span["start"], span["end"])
+                else:
+                    span["parent"] = RUN if parent is None else parent["id"]
+                self.spans.append(span)
+
+    def events(self, tool):
+        """The spans as a list of Chrome trace events."""
+        pid = os.getpid()
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s["start"])
+            groups = sorted(self.groups.values(), key=lambda g: g["start"])
+        end = self._now()
+        events = [
+            {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"housekeeper {tool}"}},
+            {"name": tool, "cat": "run", "ph": "X", "ts": 0, "dur": end, "pid": pid, "tid": 0,
+             "args": {"span_id": RUN, "parent_id": None, "started": self.started}},
+        ]
+        threads = {}
+        for span in spans:
+            threads[span["thread"]] = span["thread_name"]
+            args = {key: _jsonable(value) for key, value in span["attrs"].items()}
+            args.update(span_id=span["id"], parent_id=span["parent"])
+            events.append({"name": span["name"], "cat": span["kind"], "ph": "X", "ts": span["start"],
+                           "dur": span["end"] - span["start"], "pid": pid, "tid": span["thread"], "args": args})
+        for group in groups:
+            args = dict(group["attrs"], span_id=group["id"], parent_id=group["parent"])
+            common = {"name": group["name"], "cat": group["kind"], "id": group["id"], "pid": pid, "tid": 0}
+            events.append(dict(common, ph="b", ts=group["start"], args=args))
+            events.append(dict(common, ph="e", ts=group["end"]))
+        for tid, name in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+        return events
+
+    def write(self, tool):
+        """Write the trace to HOUSEKEEPER_TRACE."""
+        path = get_trace_path()
+        if path is None:
+            return
+        trace = {"traceEvents": self.events(tool), "displayTimeUnit": "ms"}
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(trace, f)
+        os.replace(f"{path}.tmp", path)
+        _log.info("Wrote trace", path=path, tool=tool, spans=len(self.spans))
+
+
+def state_span(state):
+    """The span for a logs.log_state, batches and steps get one."""
+    if any(key in state for key in BATCH_KEYS):
+        return TRACER.span("batch", state.get("step", "batch"), **state)
+    if "step" in state:
+        return TRACER.span("step", state["step"], **state)
+    return nullcontext({})
+
+
+# Global state for the whole run, written at exit by the tools.
+TRACER = Tracer()
@@ -1,7 +1,7 @@
 from setuptools import setup, find_packages
 
 requires = [
-    "psycopg2-binary >= 2.7.4",
+    "psycopg2-binary >= 2.9",
     "structlog >= 20.1.0",
 ]
 
@@ -23,6 +23,7 @@ setup(
             "retention = housekeeper.retention:main",
             "partition = housekeeper.partition:main",
             "archiver = housekeeper.archiver:main",
+            "convert = housekeeper.convert:main",
         ]
     },
 )